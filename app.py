@@ -1,288 +1,1129 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, g, request, jsonify, render_template, url_for
 import os
+import sys
+import base64
+from itertools import islice
 import time
-import jwt
-import requests
 from typing import Tuple
-import json
-from datetime import datetime
+from datetime import datetime, timedelta
+from urllib.parse import quote
+import sf_deadline
+import sf_http
+import sf_limits
+import storage
+import webhook_queue
+import npi_index
+from json_stream import iter_json_array
+import samples_cache
+import samples_report
+import org_replica
+import http_cache
+import log_store
+import app_logging
+import field_mapping
+import json_codec
+import metrics
+import sync_state
+import tenants
 
 app = Flask(__name__)
+app.json = json_codec.JSONProvider(app)
+app.wsgi_app = tenants.Middleware(app.wsgi_app)
+log = app_logging.get_logger("app")
 
-# Load from environment variables
-HUB_CLIENT_ID = os.environ.get("HUB_CLIENT_ID")
-HUB_USERNAME = os.environ.get("HUB_USERNAME")
-HUB_PRIVATE_KEY = os.environ.get("HUB_PRIVATE_KEY")  # Store the key content directly
-HUB_DOMAIN = os.environ.get("HUB_DOMAIN", "test")
+# Salesforce credentials (HUB_CLIENT_ID, HUB_USERNAME, HUB_PRIVATE_KEY,
+# HUB_DOMAIN, HUB_AUTH_URL, HUB_TOKEN_CACHE_FILE), the token settings and
+# SF_ORG_SOBJECT are read per org, see tenants.py
 
-# Store webhook logs in memory (last 50 requests)
-webhook_logs = []
-MAX_LOGS = 50
+# "sync" processes webhooks inside the request; "async" queues them for
+# background workers and answers 202 immediately
+WEBHOOK_MODE = os.environ.get("WEBHOOK_MODE", "sync")
 
-def get(endpoint, headers, instance_url):
+# Async mode only: coalesce queued webhooks for up to WEBHOOK_BATCH_WINDOW
+# seconds and upsert them by NPI through sObject Collections. Needs the API
+# name of the object behind MercyHealthOrgAPI, with NPI__c as an External ID.
+WEBHOOK_BATCH_WINDOW = float(os.environ.get("WEBHOOK_BATCH_WINDOW", 0))  # seconds, 0 = off
+SF_API_VERSION = sf_http.SF_API_VERSION
+UPSERT_CHUNK_SIZE = 200  # sObject Collections limit
+
+# Limiter priority of the Salesforce calls made by each route: webhook writes
+# go first, bulk reads are shed first as the API quota runs low
+ROUTE_PRIORITIES = {
+    "/webhook/hubspot": sf_limits.HIGH,
+    "/api/all": sf_limits.LOW,
+}
+
+# Breaker routes a synchronous webhook needs; while any is open, payloads
+# are queued for the background workers instead (see sf_breaker)
+WEBHOOK_UPSTREAM_ROUTES = ("token", "getByNPI", "update", "create")
+
+WEBHOOK_MAX_EVENTS = int(os.environ.get("WEBHOOK_MAX_EVENTS", 100))  # events per batch delivery
+
+# Payload echoes left out of webhook responses unless the caller passes
+# ?verbose=1 (they are always kept in the webhook log)
+WEBHOOK_ECHO_FIELDS = ("received_data", "processed_data", "salesforce_response")
+
+# Headers whose value identifies a delivery; retries with the same value are
+# answered from the first delivery's result (a payload "eventId" works too)
+IDEMPOTENCY_HEADERS = [h.strip() for h in os.environ.get(
+    "IDEMPOTENCY_HEADERS", "Idempotency-Key,X-HubSpot-Event-Id").split(",") if h.strip()]
+
+# /api/all pagination and streaming
+ALL_RECORDS_MAX_LIMIT = int(os.environ.get("ALL_RECORDS_MAX_LIMIT", 2000))
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes read from Salesforce at a time
+
+# /api/samples is cached by day or by queried range (see samples_cache). Set
+# SAMPLES_END_EXCLUSIVE=1 if the Apex 'end' date is exclusive.
+SAMPLES_MAX_RANGE_DAYS = int(os.environ.get("SAMPLES_MAX_RANGE_DAYS", 0))  # days per request, 0 = no cap
+SAMPLES_END_EXCLUSIVE = os.environ.get("SAMPLES_END_EXCLUSIVE", "0") == "1"
+
+# Webhook log entries go to log_store, which /logs reads across workers
+LOGS_PER_PAGE = 50
+
+# /logs/stream: live tail of the shared log store. Where a worker serves
+# many requests at once (gthread or gevent workers, the Flask dev server,
+# asgi.py) it is a Server-Sent Events stream held for LOG_STREAM_MAX_SECONDS;
+# a sync worker has a single thread, so there it answers at once with the
+# new entries and the page polls it every LOG_POLL_INTERVAL_MS instead.
+# The default stream length stays under gunicorn's 30 s worker timeout
+LOG_STREAM_MODE = os.environ.get("LOG_STREAM_MODE", "auto")  # "sse", "poll" or "auto"
+LOG_STREAM_POLL = float(os.environ.get("LOG_STREAM_POLL", 1))  # seconds between checks
+LOG_STREAM_MAX_SECONDS = float(os.environ.get("LOG_STREAM_MAX_SECONDS", 20))  # then the browser reconnects
+LOG_STREAM_MAX_CLIENTS = int(os.environ.get("LOG_STREAM_MAX_CLIENTS", 10))  # open streams per host
+LOG_POLL_INTERVAL_MS = int(os.environ.get("LOG_POLL_INTERVAL_MS", 2000))  # page refresh without streams
+LOG_STREAM_KEEPALIVE = 15  # seconds of silence before a keepalive comment
+LOG_STREAM_RETRY_MS = 1000  # browser reconnect delay
+# Shared by every worker on the host (flock slots, see tenants.HostSlots)
+log_stream_slots = tenants.HostSlots(os.path.join(storage.state_dir(""), "log_streams"), LOG_STREAM_MAX_CLIENTS)
+
+refresh_auth_header = tenants.refresh_auth_header
+
+# Calls go through the current tenant's client. `route` names the circuit
+# breaker and latency window of a call (see sf_http); `hedge` lets an
+# idempotent read race a second request past p95
+def get(endpoint, headers, instance_url, stream=False, route=None, hedge=False):
+    url = f"{instance_url}{endpoint}"
+    response = tenants.current().http.request("GET", url, headers=headers, stream=stream, route=route, hedge=hedge)
+    if response.status_code == 401 and refresh_auth_header(headers):
+        response.close()
+        response = tenants.current().http.request("GET", url, headers=headers, stream=stream, route=route, hedge=hedge)
+    return response
+
+def post(endpoint, headers, instance_url, data, route=None):
     url = f"{instance_url}{endpoint}"
-    response = requests.get(url, headers=headers)
+    response = tenants.current().http.request("POST", url, headers=headers, json=data, route=route)
+    if response.status_code == 401 and refresh_auth_header(headers):
+        response = tenants.current().http.request("POST", url, headers=headers, json=data, route=route)
     return response
 
-def post(endpoint, headers, instance_url, data):
+def put(endpoint, headers, instance_url, data, route=None):
     url = f"{instance_url}{endpoint}"
-    response = requests.post(url, headers=headers, json=data)
+    response = tenants.current().http.request("PUT", url, headers=headers, json=data, route=route)
+    if response.status_code == 401 and refresh_auth_header(headers):
+        response = tenants.current().http.request("PUT", url, headers=headers, json=data, route=route)
     return response
 
-def put(endpoint, headers, instance_url, data):
+def patch(endpoint, headers, instance_url, data, route=None):
     url = f"{instance_url}{endpoint}"
-    response = requests.put(url, headers=headers, json=data)
+    response = tenants.current().http.request("PATCH", url, headers=headers, json=data, route=route)
+    if response.status_code == 401 and refresh_auth_header(headers):
+        response = tenants.current().http.request("PATCH", url, headers=headers, json=data, route=route)
+    return response
+
+def upsertByNPI(headers, instance_url, records):
+    """Upsert up to 200 records keyed on NPI__c in one sObject Collections call
+
+    Returns the per-record results (same order as `records`) or the failed response.
+    """
+    org_sobject = tenants.current().org_sobject
+    body = {
+        "allOrNone": False,
+        "records": [{"attributes": {"type": org_sobject}, **record} for record in records],
+    }
+    response = patch(f"/services/data/v{SF_API_VERSION}/composite/sobjects/{org_sobject}/NPI__c",
+                     headers, instance_url, body, route="upsert")
+    if response.status_code == 200:
+        return json_codec.parse_response(response)
     return response
 
 def getByNPI(headers, instance_url, npi):
-    response = get(f"/services/apexrest/MercyHealthOrgAPI/npi/{npi}", headers, instance_url)
+    response = get(f"/services/apexrest/MercyHealthOrgAPI/npi/{npi}", headers, instance_url,
+                   route="getByNPI", hedge=True)
     if response.status_code == 200:
-        return response.json()
+        return json_codec.parse_response(response)
     return None
 
 def getAll(headers, instance_url):
-    response = get(f"/services/apexrest/MercyHealthOrgAPI", headers, instance_url)
+    response = get(f"/services/apexrest/MercyHealthOrgAPI", headers, instance_url, route="getAll", hedge=True)
     if response.status_code == 200:
-        return json.loads(response.text)
+        return json_codec.parse_response(response)
     return False
 
+def iterAll(headers, instance_url):
+    """Like getAll, but yields records while the body is still downloading"""
+    response = get(f"/services/apexrest/MercyHealthOrgAPI", headers, instance_url, stream=True, route="iterAll")
+    if response.status_code != 200:
+        response.close()
+        return False
+    return iter_response_array(response)
+
+def queryAll(headers, instance_url, soql):
+    """Yield every row of a SOQL queryAll (deleted rows included), page by page"""
+    response = get(f"/services/data/v{SF_API_VERSION}/queryAll?q={quote(soql)}", headers, instance_url,
+                   route="queryAll")
+    while True:
+        if response.status_code != 200:
+            raise RuntimeError(f"queryAll failed: {response.status_code} {response.text}")
+        body = json_codec.parse_response(response)
+        yield from body.get("records", [])
+        if not body.get("nextRecordsUrl"):
+            return
+        response = get(body["nextRecordsUrl"], headers, instance_url, route="queryAll")
+
+def iter_response_array(response):
+    try:
+        yield from iter_json_array(response.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+    finally:
+        response.close()
+
 def getSamplesForNonInternalBatches(headers, instance_url, start_date, end_date):
-    response = get(f"/services/apexrest/hubspotintegration/getsamplesfornoninternalbatches?start={start_date}&end={end_date}", headers, instance_url)
+    response = get(f"/services/apexrest/hubspotintegration/getsamplesfornoninternalbatches?start={start_date}&end={end_date}",
+                   headers, instance_url, route="samples", hedge=True)
     if response.status_code == 200:
-        return json.loads(response.text)
+        return json_codec.parse_response(response)
     return False
 
-def build_jwt(client_id: str, username: str, private_key: str) -> str:
-    payload = {
-        "iss": client_id,
-        "sub": username,
-        "aud": f"https://{HUB_DOMAIN}.salesforce.com",
-        "exp": int(time.time()) + 300,
-    }
-    return jwt.encode(payload, private_key, algorithm="RS256")
+def jwt_authenticate_HUB(stale_token=None) -> Tuple[str, str]:
+    """Return the current tenant's cached (access_token, instance_url), refreshing when needed"""
+    return tenants.authenticate(stale_token=stale_token)
 
-def jwt_authenticate_HUB() -> Tuple[str, str]:   
-    SF_AUTH_URL = f"https://{HUB_DOMAIN}.salesforce.com/services/oauth2/token"
-    
-    # Use private key directly from environment variable
-    jwt_token = build_jwt(HUB_CLIENT_ID, HUB_USERNAME, HUB_PRIVATE_KEY)
+def add_log(log_entry):
+    """Queue a log entry for the log store (written off the request path)"""
+    metrics.annotate(action=log_entry.get("action") or "")
+    log_store.write(log_entry)
 
-    response = requests.post(SF_AUTH_URL, data={
-        "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
-        "assertion": jwt_token,
-    })
+def created_record_id(salesforce_response):
+    """Record Id from a create response, if Salesforce returned one"""
+    if isinstance(salesforce_response, dict):
+        return salesforce_response.get('Id') or salesforce_response.get('id')
+    return None
 
-    if response.status_code != 200:
-        raise RuntimeError(f"Salesforce JWT auth failed: {response.status_code} {response.text}")
+def resolve_record_id(headers, instance_url, npi, attempts=3):
+    """Salesforce Id for `npi`, from the local index or replica, or via getByNPI.
 
-    data = response.json()
-    return data["access_token"], data["instance_url"]
+    Returns None when the record doesn't exist yet. The caller then holds
+    the create claim for the NPI and must store the new Id or release it;
+    concurrent webhooks for the same new NPI wait for that Id (no longer
+    than the request deadline allows) instead of creating a duplicate.
+    Raises npi_index.CreatePending, answered as a 503 or a queue retry, when
+    someone else is still creating the record after `attempts` waits.
+    """
+    record_id = npi_index.lookup(npi) or org_replica.lookup_npi(npi)
+    if record_id:
+        return record_id
+    
+    for _ in range(attempts):
+        existing_records = getByNPI(headers, instance_url, npi)
+        log.debug("webhook.lookup", npi=npi, matches=len(existing_records) if existing_records else 0)
+        if existing_records and len(existing_records) > 0:
+            # Use first match
+            record_id = existing_records[0]['Id']
+            npi_index.store(npi, record_id)
+            return record_id
+        if npi_index.claim_create(npi):
+            return None
+        record_id = npi_index.wait_for_create(npi, timeout=sf_deadline.remaining())
+        if record_id:
+            return record_id
+    raise npi_index.CreatePending(f"The record for NPI {npi} is still being created")
 
-def add_log(log_entry):
-    """Add a log entry and maintain max size"""
-    webhook_logs.insert(0, log_entry)  # Add to beginning
-    if len(webhook_logs) > MAX_LOGS:
-        webhook_logs.pop()  # Remove oldest
+class WebhookRun:
+    """Everything about syncing one HubSpot payload but the Salesforce calls.
 
-@app.route('/webhook/hubspot', methods=['POST'])
-def hubspot_webhook():
-    log_entry = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "received_data": None,
-        "processed_data": None,
-        "action": None,
-        "status": None,
-        "message": None,
-        "salesforce_response": None
-    }
+    process_webhook and its async twin in asgi.py make the calls and hand
+    each outcome to the matching method, which logs it, keeps the NPI index
+    and sync state up to date and returns the (result, status_code) to
+    answer with. The methods touch SQLite, so asgi.py runs them on threads.
+
+    With `queue_shed` a call the limiter refuses queues the payload (202)
+    instead of answering 503; the queue workers sync it later.
+    """
+
+    def __init__(self, webhook_data, queue_shed=False):
+        self.webhook_data = webhook_data
+        self.queue_shed = queue_shed
+        self.log_entry = {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "received_data": webhook_data,
+            "processed_data": None,
+            "action": None,
+            "status": None,
+            "message": None,
+            "salesforce_response": None
+        }
+        self.record_data = None
+        self.npi = None
+        self.changes = None
+        self.creating = False  # we hold the NPI's create claim
     
-    try:
-        # Get data from HubSpot webhook
-        webhook_data = request.json
-        log_entry["received_data"] = webhook_data
-        
-        # Print/log incoming data
-        print("=" * 80)
-        print("RECEIVED WEBHOOK DATA:")
-        print(json.dumps(webhook_data, indent=2))
-        print("=" * 80)
+    def _finish(self, status, action, message, salesforce_response=None):
+        self.log_entry.update(status=status, action=action, message=message,
+                              salesforce_response=salesforce_response)
+        add_log(self.log_entry)
+    
+    def prepare(self, mapped=None):
+        """Map the payload (batches arrive pre-mapped) and diff it against the
+        last sync. Returns the answer when Salesforce needn't be called: a
+        validation error or an unchanged payload. Otherwise None, with
+        `changes` holding the fields to send"""
+        log.debug("webhook.received", payload=self.webhook_data)
+        record_data, errors = mapped or field_mapping.mapping.transform(self.webhook_data)
+        if errors:
+            message = "; ".join(errors)
+            self._finish("error", None, message)
+            return {
+                "status": "error",
+                "message": message,
+                "received_data": self.webhook_data
+            }, 400
         
-        # Extract NPI from webhook data (adjust field name as needed)
-        npi = webhook_data.get('NPI__c') or webhook_data.get('npi')
+        self.record_data = record_data
+        self.npi = record_data["NPI__c"]
+        self.log_entry["processed_data"] = record_data
+        log.debug("webhook.prepared", npi=self.npi, record=record_data)
         
-        if not npi:
-            log_entry["status"] = "error"
-            log_entry["message"] = "NPI is required"
-            add_log(log_entry)
-            return jsonify({
-                "status": "error",
-                "message": "NPI is required",
-                "received_data": webhook_data
-            }), 400
+        # HubSpot often resends unchanged data: skip Salesforce entirely then
+        self.changes = sync_state.changes(self.npi, record_data)
+        if not self.changes:
+            self._finish("success", "unchanged", "No changes since the last sync")
+            log.info("webhook.unchanged", npi=self.npi)
+            return {
+                "status": "success",
+                "action": "unchanged",
+                "received_data": self.webhook_data,
+                "processed_data": record_data
+            }, 200
+        return None
+    
+    def stale(self, record_id):
+        """The update got a 404: drop the stale index entry, look the NPI up again"""
+        npi_index.invalidate(self.npi)
+        org_replica.invalidate(record_id)
+        sync_state.forget(self.npi)
+    
+    def updated(self, record_id, salesforce_response):
+        npi_index.store(self.npi, record_id)
+        sync_state.remember(self.npi, self.record_data)
+        self._finish("success", "updated", f"Record {record_id} updated successfully", salesforce_response)
+        result = {
+            "status": "success",
+            "action": "updated",
+            "record_id": record_id,
+            "changed_fields": sorted(self.changes),
+            "received_data": self.webhook_data,
+            "processed_data": self.record_data,
+            "salesforce_response": salesforce_response
+        }
+        log.info("webhook.updated", npi=self.npi, record_id=record_id)
+        log.debug("webhook.result", npi=self.npi, result=result)
+        return result, 200
+    
+    def update_failed(self, record_id, response):
+        self._finish("error", "update_failed", response.text)
+        log.warning("webhook.update_failed", npi=self.npi, record_id=record_id,
+                    sf_status=response.status_code, message=response.text)
+        return {
+            "status": "error",
+            "action": "update_failed",
+            "received_data": self.webhook_data,
+            "processed_data": self.record_data,
+            "message": response.text
+        }, response.status_code
+    
+    def created(self, salesforce_response):
+        new_record_id = created_record_id(salesforce_response)
+        if new_record_id:
+            npi_index.store(self.npi, new_record_id)
+            self.creating = False
+        else:
+            self.release_claim()
+        sync_state.remember(self.npi, self.record_data)
+        self._finish("success", "created", "New record created successfully", salesforce_response)
+        result = {
+            "status": "success",
+            "action": "created",
+            "received_data": self.webhook_data,
+            "processed_data": self.record_data,
+            "salesforce_response": salesforce_response
+        }
+        log.info("webhook.created", npi=self.npi, record_id=new_record_id)
+        log.debug("webhook.result", npi=self.npi, result=result)
+        return result, 201
+    
+    def create_failed(self, response):
+        self.release_claim()
+        self._finish("error", "create_failed", response.text)
+        log.warning("webhook.create_failed", npi=self.npi, sf_status=response.status_code,
+                    message=response.text)
+        return {
+            "status": "error",
+            "action": "create_failed",
+            "received_data": self.webhook_data,
+            "processed_data": self.record_data,
+            "message": response.text
+        }, response.status_code
+    
+    def shed(self, e):
+        self.release_claim()
+        if self.queue_shed:
+            log.warning("webhook.shed_queued", npi=self.npi, message=str(e))
+            start_webhook_workers()
+            return enqueue_webhook(self.webhook_data, (self.record_data, []))
+        self._finish("error", None, str(e))
+        log.warning("webhook.shed", npi=self.npi, message=str(e), retry_after=e.retry_after)
+        return {
+            "status": "error",
+            "message": f"{e}; retry in {e.retry_after}s",
+            "retry_after": e.retry_after,
+            "received_data": self.webhook_data
+        }, 503
+    
+    def failed(self, e):
+        self.release_claim()
+        self._finish("error", None, str(e))
+        log.error("webhook.exception", exc_info=e, payload=self.webhook_data)
+        return {
+            "status": "error",
+            "message": str(e),
+            "received_data": self.webhook_data
+        }, 500
+    
+    def release_claim(self):
+        """Give up the create claim, if we still hold it"""
+        if self.creating:
+            self.creating = False
+            npi_index.release_claim(self.npi)
+
+def process_webhook(webhook_data, mapped=None, queue_shed=False):
+    """Create or update the Salesforce record for one HubSpot payload.
+
+    Records the outcome in the webhook log and returns (result, status_code).
+    See WebhookRun for `queue_shed`.
+    """
+    run = WebhookRun(webhook_data, queue_shed)
+    try:
+        answer = run.prepare(mapped)
+        if answer is not None:
+            return answer
         
         # Authenticate with Salesforce
-        access_token, instance_url = jwt_authenticate_HUB()
+        with metrics.stage("auth"):
+            access_token, instance_url = jwt_authenticate_HUB()
         headers = {
             'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json'
         }
         
-        # Check if record exists by NPI
-        existing_records = getByNPI(headers, instance_url, npi)
-        
-        print(f"Existing records found: {len(existing_records) if existing_records else 0}")
-        
-        # Prepare record data (map HubSpot fields to Salesforce fields)
-        record_data = {
-            "City__c": webhook_data.get("City__c") or webhook_data.get("city"),
-            "Country__c": webhook_data.get("Country__c") or webhook_data.get("country"),
-            "Healthcare_Organization_Name__c": webhook_data.get("Healthcare_Organization_Name__c") or webhook_data.get("organization_name"),
-            "NPI__c": npi,
-            "Phone_Number__c": webhook_data.get("Phone_Number__c") or webhook_data.get("phone"),
-            "Provider_Name__c": webhook_data.get("Provider_Name__c") or webhook_data.get("provider_name"),
-            "Secure_Email__c": webhook_data.get("Secure_Email__c") or webhook_data.get("email"),
-            "Secure_Fax_Number__c": webhook_data.get("Secure_Fax_Number__c") or webhook_data.get("fax"),
-            "State__c": webhook_data.get("State__c") or webhook_data.get("state"),
-            "Street__c": webhook_data.get("Street__c") or webhook_data.get("street"),
-            "ZipCode__c": webhook_data.get("ZipCode__c") or webhook_data.get("zip"),
-            "Preferred_Contact_Method__c": webhook_data.get("Preferred_Contact_Method__c") or webhook_data.get("preferred_contact_method"),
-        }
-        
-        # Remove None values
-        record_data = {k: v for k, v in record_data.items() if v is not None}
-        log_entry["processed_data"] = record_data
-        
-        print(f"Prepared record data: {json.dumps(record_data, indent=2)}")
+        # Find the existing record, from the local NPI index when possible
+        with metrics.stage("lookup"):
+            record_id = resolve_record_id(headers, instance_url, run.npi)
         
-        if existing_records and len(existing_records) > 0:
-            # Update existing record (use first match)
-            record_id = existing_records[0]['Id']
-            print(f"Updating record ID: {record_id}")
+        if record_id:
+            # Update existing record: only the fields that differ from the last sync
+            log.debug("webhook.updating", npi=run.npi, record_id=record_id, fields=list(run.changes))
+            with metrics.stage("write"):
+                response = put(f"/services/apexrest/MercyHealthOrgAPI/{record_id}", 
+                              headers, instance_url, run.changes, route="update")
             
-            response = put(f"/services/apexrest/MercyHealthOrgAPI/{record_id}", 
-                          headers, instance_url, record_data)
-            
-            if response.status_code == 200:
-                log_entry["status"] = "success"
-                log_entry["action"] = "updated"
-                log_entry["message"] = f"Record {record_id} updated successfully"
-                log_entry["salesforce_response"] = response.json()
-                add_log(log_entry)
-                
-                result = {
-                    "status": "success",
-                    "action": "updated",
-                    "record_id": record_id,
-                    "received_data": webhook_data,
-                    "processed_data": record_data,
-                    "salesforce_response": response.json()
-                }
-                print(f"Update successful: {json.dumps(result, indent=2)}")
-                return jsonify(result), 200
-            else:
-                log_entry["status"] = "error"
-                log_entry["action"] = "update_failed"
-                log_entry["message"] = response.text
-                add_log(log_entry)
-                
-                result = {
-                    "status": "error",
-                    "action": "update_failed",
-                    "received_data": webhook_data,
-                    "processed_data": record_data,
-                    "message": response.text
-                }
-                print(f"Update failed: {json.dumps(result, indent=2)}")
-                return jsonify(result), response.status_code
-        else:
-            # Create new record
-            print("Creating new record")
+            if response.status_code == 404:
+                run.stale(record_id)
+                with metrics.stage("lookup"):
+                    record_id = resolve_record_id(headers, instance_url, run.npi)
+                if record_id:
+                    with metrics.stage("write"):
+                        response = put(f"/services/apexrest/MercyHealthOrgAPI/{record_id}", 
+                                      headers, instance_url, run.record_data, route="update")
             
+            if record_id:
+                if response.status_code == 200:
+                    return run.updated(record_id, json_codec.parse_response(response))
+                return run.update_failed(record_id, response)
+        
+        # Create new record (resolve_record_id gave us the create claim)
+        run.creating = True
+        log.debug("webhook.creating", npi=run.npi)
+        with metrics.stage("write"):
             response = post(f"/services/apexrest/MercyHealthOrgAPI", 
-                           headers, instance_url, record_data)
-            
-            if response.status_code in [200, 201]:
-                log_entry["status"] = "success"
-                log_entry["action"] = "created"
-                log_entry["message"] = "New record created successfully"
-                log_entry["salesforce_response"] = response.json()
-                add_log(log_entry)
-                
-                result = {
-                    "status": "success",
-                    "action": "created",
-                    "received_data": webhook_data,
-                    "processed_data": record_data,
-                    "salesforce_response": response.json()
-                }
-                print(f"Create successful: {json.dumps(result, indent=2)}")
-                return jsonify(result), 201
-            else:
-                log_entry["status"] = "error"
-                log_entry["action"] = "create_failed"
-                log_entry["message"] = response.text
-                add_log(log_entry)
-                
-                result = {
-                    "status": "error",
-                    "action": "create_failed",
-                    "received_data": webhook_data,
-                    "processed_data": record_data,
-                    "message": response.text
-                }
-                print(f"Create failed: {json.dumps(result, indent=2)}")
-                return jsonify(result), response.status_code
+                           headers, instance_url, run.record_data, route="create")
+        if response.status_code in [200, 201]:
+            return run.created(json_codec.parse_response(response))
+        return run.create_failed(response)
                 
+    except sf_limits.Overloaded as e:
+        return run.shed(e)
     except Exception as e:
-        log_entry["status"] = "error"
-        log_entry["message"] = str(e)
-        add_log(log_entry)
-        
-        error_result = {
+        return run.failed(e)
+
+def run_webhook_job(webhook_data):
+    """Queue handler: retry on Salesforce/transport errors, dead-letter 4xx"""
+    with metrics.trace("webhook_job"), sf_limits.priority(sf_limits.HIGH), \
+            sf_deadline.deadline(sf_deadline.SF_JOB_DEADLINE):
+        result, status_code = process_webhook(webhook_data)
+        metrics.annotate(status=status_code)
+    if status_code == 503 and result.get("retry_after"):
+        # Shed, breaker open or token endpoint down: retried later, not a failure of the job
+        raise sf_limits.Overloaded(result.get("message"), result["retry_after"])
+    if status_code == 429 or status_code >= 500:
+        raise RuntimeError(result.get("message") or f"Salesforce returned {status_code}")
+    if status_code >= 400:
+        raise webhook_queue.PermanentJobError(result.get("message") or f"Salesforce returned {status_code}")
+
+def run_webhook_batch(jobs):
+    """Queue batch handler: coalesce events per NPI and upsert them together.
+
+    Updates for the same NPI are merged in arrival order, so the latest value
+    of each field wins. Every original event still gets its own log entry.
+    Returns {job_id: None | exception} for the queue to ack, retry or
+    dead-letter each job.
+    """
+    with metrics.trace("webhook_batch"), sf_limits.priority(sf_limits.HIGH), \
+            sf_deadline.deadline(sf_deadline.SF_JOB_DEADLINE):
+        return coalesce_webhook_batch(jobs)
+
+def coalesce_webhook_batch(jobs):
+    outcomes = {}
+    events = []  # (job_id, webhook_data, npi, record_data)
+    merged = {}  # npi -> merged record_data
+    for job_id, webhook_data in jobs:
+        record_data, errors = field_mapping.mapping.transform(webhook_data)
+        if errors:
+            result, _ = process_webhook(webhook_data, (record_data, errors))
+            outcomes[job_id] = webhook_queue.PermanentJobError(result["message"])
+            continue
+        npi = record_data["NPI__c"]
+        merged.setdefault(npi, {}).update(record_data)
+        events.append((job_id, webhook_data, npi, record_data))
+
+    # Drop NPIs whose merged values Salesforce already has; send only changes
+    unchanged = set()
+    for npi in list(merged):
+        changes = sync_state.changes(npi, merged[npi])
+        if not changes:
+            unchanged.add(npi)
+            del merged[npi]
+        else:
+            changes["NPI__c"] = npi
+            merged[npi] = (changes, merged[npi])
+    
+    results = {npi: ("success", "unchanged", "No changes since the last sync", None, None) for npi in unchanged}
+    if not merged:
+        return log_batch_results(events, results, outcomes)
+
+    # Authenticate with Salesforce
+    with metrics.stage("auth"):
+        access_token, instance_url = jwt_authenticate_HUB()
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+
+    # results: npi -> (status, action, message, salesforce_response, error)
+    npis = list(merged)
+    for i in range(0, len(npis), UPSERT_CHUNK_SIZE):
+        chunk = npis[i:i + UPSERT_CHUNK_SIZE]
+        with metrics.stage("write"):
+            response = upsertByNPI(headers, instance_url, [merged[npi][0] for npi in chunk])
+        if not isinstance(response, list):
+            retryable = response.status_code == 429 or response.status_code >= 500
+            error_type = RuntimeError if retryable else webhook_queue.PermanentJobError
+            for npi in chunk:
+                results[npi] = ("error", "upsert_failed", response.text, None, error_type(response.text))
+            continue
+        for npi, item in zip(chunk, response):
+            if item.get("success"):
+                npi_index.store(npi, item.get("id"))
+                sync_state.remember(npi, merged[npi][1])
+                action = "created" if item.get("created") else "updated"
+                results[npi] = ("success", action, f"Record {item.get('id')} {action} successfully", item, None)
+            else:
+                message = "; ".join(e.get("message", "") for e in item.get("errors", [])) or "Upsert failed"
+                results[npi] = ("error", "upsert_failed", message, item, webhook_queue.PermanentJobError(message))
+
+    return log_batch_results(events, results, outcomes)
+
+def log_batch_results(events, results, outcomes):
+    """Log one entry per original event and fill in its queue outcome"""
+    coalesced = {}
+    for _, _, npi, _ in events:
+        coalesced[npi] = coalesced.get(npi, 0) + 1
+
+    for job_id, webhook_data, npi, record_data in events:
+        status, action, message, salesforce_response, error = results[npi]
+        if coalesced[npi] > 1:
+            message = f"{message} (coalesced {coalesced[npi]} events for NPI {npi})"
+        add_log({
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "received_data": webhook_data,
+            "processed_data": record_data,
+            "action": action,
+            "status": status,
+            "message": message,
+            "salesforce_response": salesforce_response
+        })
+        outcomes[job_id] = error
+    return outcomes
+
+def replica_headers():
+    access_token, instance_url = jwt_authenticate_HUB()
+    return {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }, instance_url
+
+def replica_fields():
+    """Fields a replica delta selects: Id, LastModifiedDate and the mapped
+    fields, applied onto the whole records of the last full load"""
+    return ["Id", "LastModifiedDate"] + [
+        field for field, *_ in field_mapping.mapping.fields if field not in ("Id", "LastModifiedDate")
+    ]
+
+def replica_full_load():
+    """Every MercyHealthOrgAPI record, streamed and kept whole, for a full replica load"""
+    headers, instance_url = replica_headers()
+    return iterAll(headers, instance_url)
+
+def replica_record(change):
+    """The whole MercyHealthOrgAPI record of a replica delta row, found by its NPI, or None"""
+    if not change.get("NPI__c"):
+        return None
+    headers, instance_url = replica_headers()
+    for record in getByNPI(headers, instance_url, change["NPI__c"]) or []:
+        if isinstance(record, dict) and record.get("Id") == change["Id"]:
+            return record
+    return None
+
+def replica_changes(since):
+    """Records modified (or deleted) at or after `since`, for a replica delta.
+
+    Selects the replica fields plus IsDeleted from the tenant's org_sobject;
+    `>=` re-reads the boundary second instead of missing it.
+    """
+    headers, instance_url = replica_headers()
+    since = since[:19] + "Z"  # SOQL datetime literal, UTC
+    soql = (f"SELECT {', '.join(replica_fields() + ['IsDeleted'])} FROM {tenants.current().org_sobject} "
+            f"WHERE LastModifiedDate >= {since} ORDER BY LastModifiedDate")
+    return queryAll(headers, instance_url, soql)
+
+def start_replica_sync(tenant):
+    """Keep `tenant`'s replica in sync from this process (once per process)"""
+    with tenants.use(tenant):
+        org_replica.start(tenants.bind(replica_full_load),
+                          tenants.bind(replica_changes) if tenant.org_sobject else None,
+                          tenants.bind(replica_record))
+
+@app.before_request
+def select_tenant():
+    """Work for the org named by the /t/<name> prefix or the tenant header"""
+    try:
+        tenant = tenants.get(request.environ.get("mercybio.tenant"))
+    except tenants.UnknownTenant as e:
+        return jsonify({
             "status": "error",
-            "message": str(e),
-            "received_data": request.json if request.json else None
-        }
-        print(f"Exception occurred: {json.dumps(error_result, indent=2)}")
-        return jsonify(error_result), 500
+            "message": str(e)
+        }), 404
+    tenants.activate(tenant)
+    ticket = tenant.enter()
+    if ticket is None:
+        response = jsonify({
+            "status": "error",
+            "message": f"Too many requests in flight for tenant '{tenant.name}'"
+        })
+        response.headers['Retry-After'] = "1"
+        return response, 503
+    g.tenant = tenant, ticket
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_flusher()
+    start_replica_sync(tenants.current())
+    if request.url_rule is not None:
+        metrics.begin(request.url_rule.rule)
+        sf_limits.set_priority(ROUTE_PRIORITIES.get(request.url_rule.rule, sf_limits.NORMAL))
+        sf_deadline.set_deadline(sf_deadline.SF_REQUEST_DEADLINE)
+
+@app.after_request
+def record_response_status(response):
+    metrics.annotate(status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    # The tenant stays active: a streamed body is still read after teardown
+    entered = g.pop("tenant", None)
+    if entered is not None:
+        tenant, ticket = entered
+        tenant.leave(ticket)
+    metrics.end()
+    sf_limits.set_priority(sf_limits.NORMAL)
+    sf_deadline.set_deadline(None)
+
+def queue_depth_metrics():
+    """Host-wide webhook queue depth per tenant, read from the shared queues at scrape time"""
+    lines = [
+        "# HELP mercybio_webhook_queue_depth Queued webhook jobs by tenant and status",
+        "# TYPE mercybio_webhook_queue_depth gauge",
+    ]
+    for tenant in tenants.all():
+        with storage.scoped(tenant.scope):
+            depth = webhook_queue.depth()
+        for status, count in sorted(depth.items()):
+            lines.append(f'mercybio_webhook_queue_depth{{status="{status}",tenant="{tenant.name}"}} {count}')
+    return lines
+
+metrics.register_collector(queue_depth_metrics)
+
+def idempotency_key(webhook_data=None, headers=None):
+    """Delivery key from the configured headers (default: this request's) or the event's eventId"""
+    headers = request.headers if headers is None else headers
+    for header in IDEMPOTENCY_HEADERS:
+        value = headers.get(header)
+        if value:
+            return f"{header.lower()}:{value}"
+    return event_key(webhook_data)
+
+def event_key(webhook_data):
+    if isinstance(webhook_data, dict) and webhook_data.get('eventId') is not None:
+        return f"eventid:{webhook_data['eventId']}"
+    return None
+
+def claim_delivery(key):
+    """Start a delivery with an idempotency key: (result, status_code, replayed)
+    to answer at once (a replay, or a 409 while it is in progress), or None
+    when the caller now owns the key and must finish_delivery() it"""
+    claimed, previous = sync_state.claim_key(key)
+    if previous:
+        return previous + (True,)
+    if not claimed:
+        return {
+            "status": "error",
+            "message": "A delivery with this idempotency key is still being processed"
+        }, 409, False
+    return None
+
+def finish_delivery(key, result, status_code):
+    """Keep the answer for replays, or let the retry of a transient failure through"""
+    if status_code == 429 or status_code >= 500:
+        sync_state.release_key(key)
+    else:
+        sync_state.complete_key(key, result, status_code)
+
+def run_idempotent(key, handler, *args):
+    """Run `handler(*args)` at most once per key; returns (result, status_code, replayed)"""
+    if not key:
+        return handler(*args) + (False,)
+
+    answer = claim_delivery(key)
+    if answer is not None:
+        return answer
 
-@app.route('/api/all', methods=['GET'])
-def all_records():
-    """Get all health organization records"""
     try:
-        access_token, instance_url = jwt_authenticate_HUB()
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        if not access_token or not instance_url:
+        result, status_code = handler(*args)
+    except Exception:
+        sync_state.release_key(key)
+        raise
+
+    finish_delivery(key, result, status_code)
+    return result, status_code, False
+
+def queues_webhooks():
+    """True when payloads go to the queue instead of being synced now: in
+    async mode, and in sync mode while a Salesforce breaker the sync needs
+    is open (the workers then sync them once it recovers)"""
+    if WEBHOOK_MODE == "async":
+        return True
+    if not tenants.current().http.breakers.is_open(*WEBHOOK_UPSTREAM_ROUTES):
+        return False
+    start_webhook_workers()
+    return True
+
+def enqueue_webhook(webhook_data, mapped=None):
+    """Validate and persist the payload for the workers; returns (result, status_code)"""
+    record_data, errors = mapped or field_mapping.mapping.transform(webhook_data)
+    if errors:
+        return process_webhook(webhook_data, (record_data, errors))
+
+    job_id = webhook_queue.enqueue(webhook_data)
+    return {
+        "status": "accepted",
+        "job_id": job_id
+    }, 202
+
+def handle_webhook(webhook_data, mapped=None):
+    """Sync the payload now, or queue it (see queues_webhooks, and when the
+    limiter sheds the sync); returns (result, status_code)"""
+    if queues_webhooks():
+        return enqueue_webhook(webhook_data, mapped)
+    return process_webhook(webhook_data, mapped, queue_shed=True)
+
+def handle_webhook_batch(events):
+    """Per-event results for a HubSpot batch delivery.
+
+    All events are mapped in one pass, then handled in order. The overall
+    status is 200/202 when every event succeeded, 503 when any failed
+    transiently (so HubSpot retries; finished events are replayed or found
+    unchanged) and 207 when some were rejected.
+    """
+    results = []
+    for index, (event, mapped) in enumerate(zip(events, field_mapping.mapping.transform_many(events))):
+        if isinstance(event, dict):
+            result, status_code, replayed = run_idempotent(event_key(event), handle_webhook, event, mapped)
+        else:
+            # Answered (and logged) as a validation error
+            result, status_code = process_webhook(event, mapped)
+            replayed = False
+        results.append(dict(result, index=index, status_code=status_code, replayed=replayed))
+    return webhook_batch_result(results)
+
+def webhook_batch_result(results):
+    """(body, status_code) summing up the per-event results of a batch"""
+    codes = [r["status_code"] for r in results]
+    if all(code < 400 for code in codes):
+        status, status_code = "success", 202 if all(code == 202 for code in codes) else 200
+    elif any(code == 429 or code >= 500 for code in codes):
+        status, status_code = "error", 503
+    else:
+        status, status_code = "partial", 207
+    return {"status": status, "results": results}, status_code
+
+def webhook_response_body(result, verbose=False):
+    """`result` without the payload echoes, unless `verbose`"""
+    if verbose:
+        return result
+    body = {k: v for k, v in result.items() if k not in WEBHOOK_ECHO_FIELDS}
+    if isinstance(body.get("results"), list):
+        body["results"] = [webhook_response_body(r) for r in body["results"]]
+    return body
+
+@app.route('/webhook/hubspot', methods=['POST'])
+def hubspot_webhook():
+    """Sync one HubSpot event object, or an array of them
+    
+    Query parameters:
+    - verbose: 1 to echo the received and processed payloads and the
+      Salesforce response in the result
+    """
+    # Get data from HubSpot webhook: one event object or an array of events
+    webhook_data = request.get_json(silent=True)
+    if isinstance(webhook_data, list):
+        if not webhook_data or len(webhook_data) > WEBHOOK_MAX_EVENTS:
             return jsonify({
                 "status": "error",
-                "message": "❌ Couldn't authenticate with Salesforce"
-            }), 401
+                "message": f"A batch must contain 1 to {WEBHOOK_MAX_EVENTS} events"
+            }), 400
+        handler = handle_webhook_batch
+    elif isinstance(webhook_data, dict):
+        handler = handle_webhook
+    else:
+        return jsonify({
+            "status": "error",
+            "message": "Request body must be a JSON object or an array of objects"
+        }), 400
+
+    # Retried deliveries with a known key get the original answer
+    result, status_code, replayed = run_idempotent(idempotency_key(webhook_data), handler, webhook_data)
+    response = jsonify(webhook_response_body(result, request.args.get('verbose') == '1'))
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    if status_code == 503 and result.get("retry_after"):
+        response.headers['Retry-After'] = str(result["retry_after"])
+    return response, status_code
+
+@app.route('/webhook/queue', methods=['GET'])
+def webhook_queue_status():
+    """Queue depth by status"""
+    return jsonify(webhook_queue.depth()), 200
+
+@app.route('/webhook/dead-letters', methods=['GET'])
+def webhook_dead_letters():
+    """Jobs that exhausted their retries or failed permanently"""
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify(webhook_queue.dead_letters(limit)), 200
+
+@app.route('/webhook/replay', methods=['POST'])
+def webhook_replay():
+    """Put dead letters back on the queue
+
+    Body (optional): {"ids": [1, 2, 3]} - replays every dead letter when omitted
+    """
+    body = request.get_json(silent=True) or {}
+    ids = body.get('ids')
+    if ids is not None and not (isinstance(ids, list) and all(isinstance(i, int) for i in ids)):
+        return jsonify({
+            "status": "error",
+            "message": "'ids' must be a list of job ids"
+        }), 400
+    replayed = webhook_queue.replay(ids)
+    return jsonify({
+        "status": "success",
+        "replayed": replayed
+    }), 200
+
+def encode_cursor(offset):
+    return base64.urlsafe_b64encode(f"o:{offset}".encode()).decode()
+
+def decode_cursor(cursor):
+    """Offset encoded in a cursor; raises ValueError for anything we didn't issue"""
+    kind, _, offset = base64.urlsafe_b64decode(cursor.encode()).decode().partition(":")
+    if kind != "o" or not offset.isdigit():
+        raise ValueError("Invalid cursor")
+    return int(offset)
+
+def slice_records(records, start, stop):
+    """islice() that stops the upstream download once the slice is complete"""
+    try:
+        yield from islice(records, start, stop)
+    finally:
+        records.close()
+
+def stream_records(records, stream_format, encoded=False):
+    """Serialize records one at a time as NDJSON or as a chunked JSON document
+
+    With `encoded`, records are already JSON bytes (replica rows) and are
+    written as they are.
+    """
+    pending = []
+    count = 0
+    if stream_format == "json":
+        yield b'{"status": "success", "data": ['
+    for record in records:
+        data = record if encoded else json_codec.dumps(record)
+        if stream_format == "json":
+            yield (b"," if count else b"") + data
+        else:
+            yield data + b"\n"
+        count += 1
+        if not encoded and isinstance(record, dict):
+            pending.append((record.get('NPI__c'), record.get('Id')))
+        if len(pending) >= 500:
+            npi_index.store_many(pending)
+            pending = []
+    npi_index.store_many(pending)
+    if stream_format == "json":
+        yield f'], "count": {count}}}'.encode()
+
+def records_response(fields, records, encoded=False):
+    """http_cache response of `fields` plus "data": records, encoded once"""
+    items = records if encoded else [json_codec.dumps(r) for r in records]
+    return http_cache.encoded_response(json_codec.envelope(fields, "data", items))
+
+class InvalidArguments(ValueError):
+    """Bad query parameters; `body` is the 400 response"""
+
+    def __init__(self, message, **extra):
+        super().__init__(message)
+        self.body = {"status": "error", "message": message, **extra}
+
+def all_records_args(args):
+    """(limit, cursor, offset, stream_format) from /api/all query args"""
+    limit = args.get('limit', type=int)
+    cursor = args.get('cursor')
+    stream_format = args.get('stream')
+    
+    if stream_format not in (None, "ndjson", "json"):
+        raise InvalidArguments("'stream' must be 'ndjson' or 'json'")
+    if limit is not None and not 0 < limit <= ALL_RECORDS_MAX_LIMIT:
+        raise InvalidArguments(f"'limit' must be between 1 and {ALL_RECORDS_MAX_LIMIT}")
+    try:
+        offset = decode_cursor(cursor) if cursor else 0
+    except ValueError:
+        raise InvalidArguments("Invalid cursor")
+    return limit, cursor, offset, stream_format
+
+def all_records_body(records, limit, cursor, offset, from_replica):
+    """(fields, records) of an unstreamed /api/all response: one page or everything"""
+    if limit is not None or cursor:
+        # Read one extra record to know whether there is a next page
+        page = list(slice_records(records, offset, offset + limit + 1 if limit else None))
+        next_cursor = encode_cursor(offset + limit) if limit and len(page) > limit else None
+        page = page[:limit] if limit else page
+        if not from_replica:
+            npi_index.store_many((r.get('NPI__c'), r.get('Id')) for r in page if isinstance(r, dict))
         
-        records = getAll(headers, instance_url)
+        return {
+            "status": "success",
+            "count": len(page),
+            "next_cursor": next_cursor
+        }, page
+    
+    records = list(records) if from_replica else records or []
+    if not from_replica:
+        # Warm the NPI index with every record we just fetched
+        npi_index.store_many((r.get('NPI__c'), r.get('Id')) for r in records if isinstance(r, dict))
+    
+    return {
+        "status": "success",
+        "count": len(records)
+    }, records
+
+@app.route('/api/all', methods=['GET'])
+def all_records():
+    """Get all health organization records
+    
+    Optional query parameters:
+    - limit: Page size (max ALL_RECORDS_MAX_LIMIT); the response carries
+      next_cursor while more records remain
+    - cursor: next_cursor from the previous page
+    - stream: "ndjson" (one record per line) or "json" (same document as the
+      unstreamed response, written while records are read from Salesforce)
+    
+    - live: 1 to read from Salesforce even when the local replica is fresh
+    
+    Pages are offsets into the result order, Id order when served from the
+    replica (X-Data-Source says which). The replica is only used while it
+    holds every record whole (org_replica.is_complete). When a Salesforce
+    call is shed (open breaker, deadline, limiter) a stale replica is served
+    instead, with X-Replica-Synced-At. Unstreamed responses carry an ETag
+    (304 on If-None-Match) and are compressed per Accept-Encoding.
+    """
+    try:
+        limit, cursor, offset, stream_format = all_records_args(request.args)
+    except InvalidArguments as e:
+        return jsonify(e.body), 400
+    
+    try:
+        # Served from the local replica while it is fresh enough and holds
+        # every record whole, as the Apex API returns it
+        live = request.args.get('live') == '1'
+        complete = not live and org_replica.is_complete()
+        from_replica = complete and org_replica.is_fresh()
+        stale = False
+        if not from_replica:
+            try:
+                with metrics.stage("auth"):
+                    access_token, instance_url = jwt_authenticate_HUB()
+                headers = {
+                    'Authorization': f'Bearer {access_token}',
+                    'Content-Type': 'application/json'
+                }
+                
+                if not access_token or not instance_url:
+                    return jsonify({
+                        "status": "error",
+                        "message": "❌ Couldn't authenticate with Salesforce"
+                    }), 401
+                
+                with metrics.stage("fetch"):
+                    if limit is not None or cursor or stream_format:
+                        records = iterAll(headers, instance_url)
+                    else:
+                        records = getAll(headers, instance_url)
+            except sf_limits.Overloaded:
+                # Shed, circuit open or out of time: an old replica beats a 503
+                if not complete or org_replica.synced_at() is None:
+                    raise
+                stale = from_replica = True
+            else:
+                if records is False:
+                    return jsonify({
+                        "status": "error",
+                        "message": "Failed to retrieve records"
+                    }), 500
+        if from_replica:
+            with metrics.stage("replica"):
+                # Stored JSON goes out as is, never parsed and re-encoded
+                records = org_replica.iter_records(raw=True)
         
-        if records is False:
-            return jsonify({
-                "status": "error",
-                "message": "Failed to retrieve records"
-            }), 500
+        if stream_format:
+            mimetype = "application/x-ndjson" if stream_format == "ndjson" else "application/json"
+            records = slice_records(records, offset, offset + limit if limit else None)
+            response = Response(stream_records(records, stream_format, encoded=from_replica), mimetype=mimetype)
+        else:
+            response = records_response(*all_records_body(records, limit, cursor, offset, from_replica),
+                                        encoded=from_replica)
         
-        return jsonify({
-            "status": "success",
-            "count": len(records) if records else 0,
-            "data": records
-        }), 200
+        response.headers['X-Data-Source'] = "replica" if from_replica else "salesforce"
+        if stale:
+            response.headers['X-Replica-Synced-At'] = datetime.fromtimestamp(
+                org_replica.synced_at()).strftime("%Y-%m-%d %H:%M:%S")
+        return response
         
+    except sf_limits.Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
-        app.logger.error(f"Error retrieving all records: {str(e)}")
+        log.error("api_all.exception", exc_info=e)
         return jsonify({
             "status": "error",
             "message": str(e)
         }), 500
 
+@app.route('/api/search', methods=['GET'])
+def search_records():
+    """Search health organization records in the local replica
+    
+    Query parameters (all optional, combined with AND):
+    - state, city: exact match, case-insensitive
+    - name: organization name prefix, case-insensitive
+    - npi: NPI prefix
+    - limit: page size (default 50, max ALL_RECORDS_MAX_LIMIT)
+    - cursor: next_cursor from the previous page
+    
+    Never calls Salesforce; answers 503 until the replica has been loaded.
+    """
+    limit = request.args.get('limit', 50, type=int)
+    if not 0 < limit <= ALL_RECORDS_MAX_LIMIT:
+        return jsonify({
+            "status": "error",
+            "message": f"'limit' must be between 1 and {ALL_RECORDS_MAX_LIMIT}"
+        }), 400
+    try:
+        offset = decode_cursor(request.args['cursor']) if request.args.get('cursor') else 0
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "Invalid cursor"
+        }), 400
+    
+    stamp = org_replica.synced_at()
+    if stamp is None:
+        return jsonify({
+            "status": "error",
+            "message": "The organization replica has not been loaded yet"
+        }), 503
+    
+    with metrics.stage("replica"):
+        records, has_more = org_replica.search(
+            state=request.args.get('state'),
+            city=request.args.get('city'),
+            name=request.args.get('name'),
+            npi_prefix=request.args.get('npi'),
+            limit=limit,
+            offset=offset,
+            raw=True,
+        )
+    # The sync stamp goes in a header so it doesn't change the ETag
+    response = records_response({
+        "status": "success",
+        "count": len(records),
+        "next_cursor": encode_cursor(offset + limit) if has_more else None
+    }, records, encoded=True)
+    response.headers['X-Replica-Synced-At'] = datetime.fromtimestamp(stamp).strftime("%Y-%m-%d %H:%M:%S")
+    return response
+
+def overloaded_response(e):
+    """503 for a call the Salesforce limiter shed, telling the client when to retry"""
+    response = jsonify({
+        "status": "error",
+        "message": str(e)
+    })
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+def samples_day_end(day):
+    """'end' parameter that makes the samples query cover exactly `day`"""
+    if not SAMPLES_END_EXCLUSIVE:
+        return day
+    return (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
 @app.route('/api/samples', methods=['GET'])
 def get_samples():
     """Get samples for non-internal batches by date range
@@ -290,48 +1131,59 @@ def get_samples():
     Query parameters:
     - start: Start date (YYYY-MM-DD) - required
     - end: End date (YYYY-MM-DD) - required
+    - refresh: 1 to bypass the per-day cache and refetch every day
+    - format: "json" (default), or "ndjson"/"csv" streamed one row per line
+    - fields: comma-separated fields to keep in each row
+    - group_by: comma-separated fields; returns one row per group with
+      "count" and "sum_<field>" totals instead of the samples
+    - sum: with group_by, the fields to total (default: every numeric field)
+    
+    JSON responses carry an ETag (304 on If-None-Match) and are compressed
+    per Accept-Encoding. When a Salesforce call is shed (open breaker,
+    deadline, limiter), cached days are served whatever their age
+    (X-Data-Source: stale-cache).
     
-    Example: /api/samples?start=2025-09-25&end=2025-10-25
+    Examples: /api/samples?start=2025-09-25&end=2025-10-25
+              /api/samples?start=2025-09-01&end=2025-09-30&group_by=Batch__c&format=csv
     """
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
     try:
-        # Get date parameters from query string
-        start_date = request.args.get('start')
-        end_date = request.args.get('end')
-        
-        # Validate required parameters
-        if not start_date or not end_date:
-            return jsonify({
-                "status": "error",
-                "message": "Both 'start' and 'end' date parameters are required",
-                "example": "/api/samples?start=2025-09-25&end=2025-10-25"
-            }), 400
+        params = samples_args(request.args)
         
-        # Validate date format (basic check)
+        stale = False
         try:
-            datetime.strptime(start_date, '%Y-%m-%d')
-            datetime.strptime(end_date, '%Y-%m-%d')
-        except ValueError:
-            return jsonify({
-                "status": "error",
-                "message": "Invalid date format. Use YYYY-MM-DD",
-                "example": "/api/samples?start=2025-09-25&end=2025-10-25"
-            }), 400
-        
-        # Authenticate with Salesforce
-        access_token, instance_url = jwt_authenticate_HUB()
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        if not access_token or not instance_url:
-            return jsonify({
-                "status": "error",
-                "message": "❌ Couldn't authenticate with Salesforce"
-            }), 401
-        
-        # Get samples data
-        samples = getSamplesForNonInternalBatches(headers, instance_url, start_date, end_date)
+            # Authenticate with Salesforce
+            with metrics.stage("auth"):
+                access_token, instance_url = jwt_authenticate_HUB()
+            headers = {
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/json'
+            }
+            
+            if not access_token or not instance_url:
+                return jsonify({
+                    "status": "error",
+                    "message": "❌ Couldn't authenticate with Salesforce"
+                }), 401
+            
+            # Get samples data through the per-day cache; runs of missing days
+            # are fetched on pool threads, which spend this request's deadline
+            expires_at = sf_deadline.expires_at()
+            
+            @tenants.bind
+            def fetch_range(first_day, last_day):
+                with sf_deadline.until(expires_at):
+                    return getSamplesForNonInternalBatches(headers, instance_url, first_day, samples_day_end(last_day))
+            
+            with metrics.stage("fetch"):
+                samples = samples_cache.get_range(start_date, end_date, fetch_range, refresh=params["refresh"])
+        except sf_limits.Overloaded:
+            # Shed, circuit open or out of time: answer from the cache, however old
+            samples = samples_cache.get_cached_range(start_date, end_date)
+            if samples is None:
+                raise
+            stale = True
         
         if samples is False:
             return jsonify({
@@ -339,153 +1191,273 @@ def get_samples():
                 "message": "Failed to retrieve samples"
             }), 500
         
-        return jsonify({
-            "status": "success",
-            "start_date": start_date,
-            "end_date": end_date,
-            "count": len(samples) if samples else 0,
-            "data": samples
-        }), 200
+        mimetype, body, extra_headers = samples_output(params, samples)
+        if mimetype == "application/json":
+            response = http_cache.json_response(body)
+        else:
+            response = Response(body, mimetype=mimetype)
+        response.headers.extend(extra_headers)
+        if stale:
+            response.headers['X-Data-Source'] = "stale-cache"
+        return response
         
+    except InvalidArguments as e:
+        return jsonify(e.body), 400
+    except sf_limits.Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
-        app.logger.error(f"Error retrieving samples: {str(e)}")
+        log.error("api_samples.exception", exc_info=e, start=start_date, end=end_date)
         return jsonify({
             "status": "error",
             "message": str(e)
         }), 500
 
+def samples_args(args):
+    """Validated /api/samples query args"""
+    example = "/api/samples?start=2025-09-25&end=2025-10-25"
+    start_date = args.get('start')
+    end_date = args.get('end')
+    
+    # Validate required parameters
+    if not start_date or not end_date:
+        raise InvalidArguments("Both 'start' and 'end' date parameters are required", example=example)
+    
+    # Validate date format (basic check)
+    try:
+        days = (datetime.strptime(end_date, '%Y-%m-%d') - datetime.strptime(start_date, '%Y-%m-%d')).days + 1
+    except ValueError:
+        raise InvalidArguments("Invalid date format. Use YYYY-MM-DD", example=example)
+    
+    if days <= 0:
+        raise InvalidArguments("'end' must be on or after 'start'", example=example)
+    if SAMPLES_MAX_RANGE_DAYS and days > SAMPLES_MAX_RANGE_DAYS:
+        raise InvalidArguments(f"The range may cover at most {SAMPLES_MAX_RANGE_DAYS} days", example=example)
+    
+    params = {
+        "start": start_date,
+        "end": end_date,
+        "refresh": args.get('refresh') == '1',
+        "format": args.get('format', 'json'),
+        "fields": samples_report.parse_fields(args.get('fields')),
+        "group_by": samples_report.parse_fields(args.get('group_by')),
+        "sum": samples_report.parse_fields(args.get('sum')),
+    }
+    if params["format"] not in ("json", "ndjson", "csv"):
+        raise InvalidArguments("'format' must be 'json', 'ndjson' or 'csv'")
+    if params["sum"] and not params["group_by"]:
+        raise InvalidArguments("'sum' needs 'group_by'")
+    return params
+
+def samples_output(params, samples):
+    """(mimetype, body, headers) for `samples` in the requested format
+
+    The body is the JSON payload for "json" and an iterator of encoded
+    chunks for "ndjson" and "csv".
+    """
+    samples = samples or []
+    fields, group_by = params["fields"], params["group_by"]
+    rows = samples
+    if group_by:
+        with metrics.stage("aggregate"):
+            rows = samples_report.aggregate(samples, group_by, params["sum"])
+    
+    if params["format"] == "ndjson":
+        return "application/x-ndjson", samples_report.iter_ndjson(samples_report.project(rows, fields)), []
+    if params["format"] == "csv":
+        columns = fields or samples_report.columns_of(rows)
+        filename = f"samples_{params['start']}_{params['end']}.csv"
+        return ("text/csv", samples_report.iter_csv(samples_report.project(rows, fields), columns),
+                [('Content-Disposition', f'attachment; filename="{filename}"')])
+    
+    result = {
+        "status": "success",
+        "start_date": params["start"],
+        "end_date": params["end"],
+        "count": len(rows),
+        "data": list(samples_report.project(rows, fields))
+    }
+    if group_by:
+        result["group_by"] = group_by
+        result["samples"] = len(samples)
+    return "application/json", result, []
+
 @app.route('/logs', methods=['GET'])
 def view_logs():
-    """Display webhook logs on a web page"""
-    html_template = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Webhook Logs</title>
-        <meta http-equiv="refresh" content="30">
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                margin: 20px;
-                background-color: #f5f5f5;
-            }
-            h1 {
-                color: #333;
-            }
-            .log-entry {
-                background-color: white;
-                border-radius: 8px;
-                padding: 15px;
-                margin-bottom: 20px;
-                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            }
-            .log-header {
-                display: flex;
-                justify-content: space-between;
-                margin-bottom: 10px;
-                padding-bottom: 10px;
-                border-bottom: 2px solid #eee;
-            }
-            .timestamp {
-                color: #666;
-                font-size: 14px;
-            }
-            .status {
-                padding: 5px 10px;
-                border-radius: 4px;
-                font-weight: bold;
-                font-size: 12px;
-            }
-            .status-success {
-                background-color: #d4edda;
-                color: #155724;
-            }
-            .status-error {
-                background-color: #f8d7da;
-                color: #721c24;
-            }
-            .action {
-                color: #007bff;
-                font-weight: bold;
-                margin-bottom: 10px;
-            }
-            .message {
-                color: #333;
-                margin-bottom: 10px;
-            }
-            pre {
-                background-color: #f8f9fa;
-                padding: 10px;
-                border-radius: 4px;
-                overflow-x: auto;
-                font-size: 12px;
-            }
-            .section-title {
-                font-weight: bold;
-                color: #555;
-                margin-top: 10px;
-                margin-bottom: 5px;
-            }
-            .no-logs {
-                text-align: center;
-                color: #999;
-                padding: 40px;
-            }
-            .refresh-info {
-                color: #666;
-                font-size: 14px;
-                margin-bottom: 20px;
-            }
-        </style>
-    </head>
-    <body>
-        <h1>🔔 Webhook Logs</h1>
-        <div class="refresh-info">Auto-refreshes every 30 seconds | Showing last {{ logs|length }} requests</div>
-        
-        {% if logs %}
-            {% for log in logs %}
-            <div class="log-entry">
-                <div class="log-header">
-                    <span class="timestamp">⏰ {{ log.timestamp }}</span>
-                    <span class="status status-{{ log.status }}">{{ log.status|upper }}</span>
-                </div>
-                
-                {% if log.action %}
-                <div class="action">📝 Action: {{ log.action|upper }}</div>
-                {% endif %}
-                
-                {% if log.message %}
-                <div class="message">💬 {{ log.message }}</div>
-                {% endif %}
-                
-                {% if log.received_data %}
-                <div class="section-title">📥 Received Data:</div>
-                <pre>{{ log.received_data|tojson(indent=2) }}</pre>
-                {% endif %}
-                
-                {% if log.processed_data %}
-                <div class="section-title">⚙️ Processed Data:</div>
-                <pre>{{ log.processed_data|tojson(indent=2) }}</pre>
-                {% endif %}
-                
-                {% if log.salesforce_response %}
-                <div class="section-title">✅ Salesforce Response:</div>
-                <pre>{{ log.salesforce_response|tojson(indent=2) }}</pre>
-                {% endif %}
-            </div>
-            {% endfor %}
-        {% else %}
-            <div class="no-logs">No webhook requests received yet</div>
-        {% endif %}
-    </body>
-    </html>
+    """Display webhook logs on a web page
+    
+    Query parameters (all optional):
+    - npi, status, action: exact-match filters
+    - since, until: YYYY-MM-DD or YYYY-MM-DD HH:MM:SS (until is exclusive)
+    - page: 1-based page of LOGS_PER_PAGE entries
+    - format: "json" for the raw entries
+    
+    The HTML page shows summaries, fetches payloads when an entry is
+    expanded and, on the first page, adds new entries live from /logs/stream.
+    """
+    filters = {key: request.args.get(key) or None for key in ('npi', 'status', 'action')}
+    page = max(request.args.get('page', 1, type=int), 1)
+    try:
+        since = log_store.parse_time(request.args['since']) if request.args.get('since') else None
+        until = log_store.parse_time(request.args['until']) if request.args.get('until') else None
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+    
+    if request.args.get('format') == 'json':
+        logs, has_more = log_store.query(since=since, until=until, limit=LOGS_PER_PAGE,
+                                         offset=(page - 1) * LOGS_PER_PAGE, **filters)
+        return jsonify({
+            "status": "success",
+            "page": page,
+            "has_more": has_more,
+            "count": len(logs),
+            "data": logs
+        }), 200
+    
+    # The page lists summaries; payloads load from /logs/<id> when expanded
+    logs, has_more = log_store.query(since=since, until=until, limit=LOGS_PER_PAGE,
+                                     offset=(page - 1) * LOGS_PER_PAGE, summary=True, **filters)
+    
+    # Keep the active filters in the paging links
+    query_args = {k: v for k, v in request.args.items() if k != 'page' and v}
+    prev_url = url_for('view_logs', page=page - 1, **query_args) if page > 1 else None
+    next_url = url_for('view_logs', page=page + 1, **query_args) if has_more else None
+    
+    # The newest page tails new entries live unless it is bounded in time
+    live = page == 1 and until is None
+    after = logs[0]["id"] if logs else log_store.latest_id()
+    stream_url = url_for('logs_stream', after=after, **{k: v for k, v in filters.items() if v})
+    
+    return render_template("logs.html", logs=logs, page=page, prev_url=prev_url, next_url=next_url,
+                           live=live, stream_url=stream_url, per_page=LOGS_PER_PAGE,
+                           streaming=streams_logs(request.environ), poll_interval_ms=LOG_POLL_INTERVAL_MS)
+
+@app.route('/logs/<int:entry_id>', methods=['GET'])
+def log_entry(entry_id):
+    """One full log entry, payloads included"""
+    entry = log_store.get(entry_id)
+    if entry is None:
+        return jsonify({
+            "status": "error",
+            "message": "Log entry not found"
+        }), 404
+    return jsonify(entry), 200
+
+def streams_logs(environ):
+    """True when this worker can hold a request open for a /logs/stream tail"""
+    if LOG_STREAM_MODE in ("sse", "poll"):
+        return LOG_STREAM_MODE == "sse"
+    if environ.get("wsgi.multithread"):
+        return True
+    monkey = sys.modules.get("gevent.monkey")
+    return bool(monkey and monkey.is_module_patched("socket"))
+
+@app.route('/logs/stream', methods=['GET'])
+def logs_stream():
+    """New log entries from every worker, as Server-Sent Events or one JSON poll
+    
+    Query parameters (all optional):
+    - npi, status, action: exact-match filters
+    - after: only entries with a larger id (default: entries from now on)
+    
+    Where the worker can hold the request (see streams_logs) the answer is
+    an event stream with one "log" event per entry: the shared log store is
+    polled every LOG_STREAM_POLL seconds, and the stream ends after
+    LOG_STREAM_MAX_SECONDS; EventSource then reconnects and resumes from
+    Last-Event-ID, so no entry is missed. At most LOG_STREAM_MAX_CLIENTS
+    streams are open on the host. Otherwise (sync workers) the entries
+    written so far are returned at once as JSON, with the id to pass as
+    `after` next time.
     """
-    return render_template_string(html_template, logs=webhook_logs)
+    filters = {key: request.args.get(key) or None for key in ('npi', 'status', 'action')}
+    after = request.headers.get('Last-Event-ID', type=int)
+    if after is None:
+        after = request.args.get('after', type=int)
+    if after is None:
+        after = log_store.latest_id()
+    
+    if not streams_logs(request.environ):
+        entries = log_store.summaries_after(after, **filters)
+        return jsonify({
+            "status": "success",
+            "after": entries[-1]["id"] if entries else after,
+            "poll_interval_ms": LOG_POLL_INTERVAL_MS,
+            "data": entries
+        }), 200
+    
+    slot = log_stream_slots.acquire()
+    if slot is None:
+        response = jsonify({
+            "status": "error",
+            "message": "Too many open log streams"
+        })
+        response.headers['Retry-After'] = '10'
+        return response, 503
+    
+    def events(after):
+        yield f"retry: {LOG_STREAM_RETRY_MS}\n\n"
+        deadline = time.time() + LOG_STREAM_MAX_SECONDS
+        quiet_since = time.time()
+        while time.time() < deadline:
+            entries = log_store.summaries_after(after, **filters)
+            for entry in entries:
+                after = entry["id"]
+                yield f"id: {after}\nevent: log\ndata: {json_codec.dumps(entry).decode()}\n\n"
+            if entries:
+                quiet_since = time.time()
+            elif time.time() - quiet_since >= LOG_STREAM_KEEPALIVE:
+                # Comment line: keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                quiet_since = time.time()
+            time.sleep(LOG_STREAM_POLL)
+    
+    response = Response(events(after), mimetype="text/event-stream")
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(lambda: log_stream_slots.release(slot))
+    return response
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy"}), 200
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus exposition of latency histograms and counters for all workers"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/metrics/slow', methods=['GET'])
+def slow_requests():
+    """Stage breakdown of this worker's most recent slow requests"""
+    return jsonify(list(metrics.slow_traces)), 200
+
+@app.route('/health/samples-cache', methods=['GET'])
+def samples_cache_stats():
+    """Per-day samples cache hit/miss counters for this worker"""
+    return jsonify(samples_cache.stats()), 200
+
+@app.route('/health/replica', methods=['GET'])
+def replica_stats():
+    """Record count and sync stamps of the local organization replica"""
+    return jsonify(org_replica.stats()), 200
+
+@app.route('/health/http-cache', methods=['GET'])
+def http_cache_stats():
+    """Compressed-body cache and 304 counters for this worker"""
+    return jsonify(http_cache.stats()), 200
+
+@app.route('/health/pool', methods=['GET'])
+def pool_stats():
+    """Salesforce connection pool, retry and limiter statistics of the tenant's client, for sizing the pool"""
+    return jsonify(tenants.current().http.stats()), 200
+
+@app.route('/health/tenants', methods=['GET'])
+def tenant_stats():
+    """In-flight and rejected requests of every tenant in this worker"""
+    return jsonify(tenants.stats()), 200
+
 @app.route('/')
 def index():
     """Home page with links"""
@@ -557,6 +1529,7 @@ def index():
                 <span class="method">POST</span>
                 <strong>/webhook/hubspot</strong>
                 <p>Receives webhook data from HubSpot and creates/updates Salesforce records</p>
+                <p><strong>Parameters:</strong> <code>verbose=1</code> to echo the payloads in the response</p>
             </div>
             
             <div class="endpoint">
@@ -579,6 +1552,14 @@ def index():
                 <p><strong>Example:</strong> <a href="/api/samples?start=2025-09-25&end=2025-10-25">/api/samples?start=2025-09-25&end=2025-10-25</a></p>
             </div>
             
+            <div class="endpoint">
+                <span class="method method-get">GET</span>
+                <strong>/api/search</strong>
+                <p>Search the local replica of the organization records</p>
+                <p><strong>Parameters:</strong> <code>state</code>, <code>city</code>, <code>name</code> (prefix), <code>npi</code> (prefix), <code>limit</code>, <code>cursor</code></p>
+                <p><strong>Example:</strong> <a href="/api/search?state=TX&city=Austin">/api/search?state=TX&city=Austin</a></p>
+            </div>
+            
             <div class="endpoint">
                 <span class="method method-get">GET</span>
                 <strong><a href="/health">/health</a></strong>
@@ -590,6 +1571,20 @@ def index():
     """
     return html
 
+def start_webhook_workers():
+    """Start the queue workers of every tenant, each working for its own org"""
+    for tenant in tenants.all():
+        with tenants.use(tenant):
+            if WEBHOOK_BATCH_WINDOW > 0 and tenant.org_sobject:
+                webhook_queue.start_workers(tenants.bind(run_webhook_job),
+                                            batch_handler=tenants.bind(run_webhook_batch),
+                                            batch_window=WEBHOOK_BATCH_WINDOW)
+            else:
+                webhook_queue.start_workers(tenants.bind(run_webhook_job))
+
+if WEBHOOK_MODE == "async":
+    start_webhook_workers()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,157 @@
+"""Structured, queue-backed logging that keeps serialization off request threads.
+
+Callers log an event name plus keyword fields. The record is handed to a
+QueueHandler, and a listener thread turns it into one JSON line on stdout,
+so the request thread never encodes payloads or blocks on the stream.
+
+Configuration:
+- LOG_LEVEL: minimum level (default INFO)
+- LOG_SAMPLE_RATES: per-level sampling, e.g. "DEBUG=0.05,INFO=0.5"
+- LOG_PAYLOAD_MAX_CHARS: fields longer than this once encoded are truncated
+- LOG_FULL_PAYLOADS=1: never truncate (debug mode, expect large output)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATES = os.environ.get("LOG_SAMPLE_RATES", "")
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", 2048))
+LOG_FULL_PAYLOADS = os.environ.get("LOG_FULL_PAYLOADS", "0") == "1"
+
+ROOT_LOGGER = "mercybio"
+
+
+def parse_sample_rates(spec):
+    """{levelno: rate} from "DEBUG=0.1,INFO=1" """
+    rates = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        level, _, rate = part.partition("=")
+        rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a random fraction of records at each configured level"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, event and the event's fields"""
+
+    def __init__(self, max_chars=LOG_PAYLOAD_MAX_CHARS, full_payloads=LOG_FULL_PAYLOADS):
+        super().__init__()
+        self.max_chars = max_chars
+        self.full_payloads = full_payloads
+
+    def format(self, record):
+        line = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        for key, value in getattr(record, "fields", {}).items():
+            line[key] = self._field(value)
+        if record.exc_info:
+            line["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line["exc"] = record.exc_text
+        return json.dumps(line, default=str)
+
+    def _field(self, value):
+        if self.full_payloads or isinstance(value, (int, float, bool)) or value is None:
+            return value
+        encoded = value if isinstance(value, str) else json.dumps(value, default=str)
+        if len(encoded) <= self.max_chars:
+            return value
+        return f"{encoded[:self.max_chars]}... [truncated {len(encoded) - self.max_chars} chars]"
+
+
+class StructuredLogger:
+    """`log.info("event.name", key=value, ...)` on top of a stdlib logger"""
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def is_enabled(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, event, exc_info=None, **fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, exc_info=None, **fields):
+        self.log(logging.ERROR, event, exc_info=exc_info, **fields)
+
+
+class _EventQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Skip the default formatting: the listener thread does all the work.
+        # Tracebacks are rendered here because exc_info can't cross threads.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_handler = None
+_listener = None
+
+
+def _start_listener():
+    global _listener
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    _handler.queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(_handler.queue, stream)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def setup():
+    """Install the queue handler on the service's root logger (idempotent)"""
+    global _handler
+    if _handler is not None:
+        return
+    _handler = _EventQueueHandler(queue.SimpleQueue())
+    _handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(_handler)
+    root.propagate = False
+    _start_listener()
+    atexit.register(_stop_listener)
+    # The listener thread doesn't survive fork(); give each child its own
+    os.register_at_fork(after_in_child=_start_listener)
+
+
+def get_logger(name):
+    setup()
+    return StructuredLogger(logging.getLogger(f"{ROOT_LOGGER}.{name}"))
@@ -0,0 +1,829 @@
+"""ASGI entry point: the same service on an event loop.
+
+    uvicorn asgi:app --workers 4
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+The routes that wait on Salesforce - /webhook/hubspot, /api/all,
+/api/samples - and /health are served natively. Their Salesforce calls go
+through one httpx.AsyncClient per process, so a request waiting on
+Salesforce costs a coroutine instead of a worker thread and one process
+holds thousands of them. Each upstream route (getByNPI, update, samples,
+...) has its own concurrency bound, ASGI_UPSTREAM_CONCURRENCY or its entry
+in ASGI_UPSTREAM_LIMITS ("samples=10,getAll=2"); a call that can't get a
+slot within its priority's SF_LIMIT_WAIT_* is shed with
+sf_limits.Overloaded. The adaptive limiter (API quota and concurrency),
+circuit breakers and the retry budget are shared with the sync client
+(sf_http) that the background jobs keep using, and
+every request spends one SF_REQUEST_DEADLINE (sf_deadline, per task) on
+its calls, so /api/all and /api/samples fall back to stale data as they
+do under WSGI.
+
+Every other route (/logs and its live stream, /metrics, /api/search, the
+queue and health pages) only does local I/O and runs the Flask app from
+app.py on ASGI_WSGI_THREADS threads. Under gunicorn's sync workers app.py
+is served exactly as before.
+
+Tenants (see tenants.py) are picked by the /t/<name> prefix or the
+tenant header as under WSGI. Each gets its own upstream slots per route,
+so one org's slow calls can't use up another's; limiter, breakers and
+the retry budget are those of the tenant's sync client. TENANT_MAX_IN_FLIGHT only
+caps the routes run on the thread pool, since native requests don't hold
+a thread.
+
+Differences from the WSGI app: reads are not hedged, and a live /api/all
+downloads the whole body before streaming (ndjson/json) it back; replica
+reads are streamed as they are read.
+
+httpx and an ASGI server (uvicorn) are only needed for this mode.
+"""
+import asyncio
+import contextvars
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.http import parse_accept_header, parse_etags
+
+try:
+    import httpx
+except ImportError:  # optional: only this entry point needs it
+    httpx = None
+
+import app as wsgi
+import app_logging
+import field_mapping
+import http_cache
+import json_codec
+import metrics
+import npi_index
+import org_replica
+import samples_cache
+import sf_deadline
+import sf_http
+import sf_limits
+import sync_state
+import tenants
+
+log = app_logging.get_logger("asgi")
+
+ASGI_UPSTREAM_CONCURRENCY = int(os.environ.get("ASGI_UPSTREAM_CONCURRENCY", 50))  # calls in flight per route
+ASGI_UPSTREAM_LIMITS = os.environ.get("ASGI_UPSTREAM_LIMITS", "")  # per-route overrides, "route=n,..."
+ASGI_UPSTREAM_CONNECTIONS = int(os.environ.get("ASGI_UPSTREAM_CONNECTIONS", 200))  # per process
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", 32))  # threads running the Flask routes
+ASGI_PARSE_INLINE_BYTES = 64 * 1024  # larger Salesforce bodies are parsed off the event loop
+
+upstream_in_flight = metrics.Gauge(
+    "mercybio_asgi_upstream_in_flight", "Async Salesforce calls in flight", ("tenant", "route"))
+upstream_shed = metrics.Counter(
+    "mercybio_asgi_upstream_shed_total", "Async Salesforce calls refused for want of a slot", ("tenant", "route"))
+
+_priority = ContextVar("asgi_priority", default=sf_limits.NORMAL)
+
+
+def parse_limits(value):
+    """'samples=10, getAll=2' -> {'samples': 10, 'getAll': 2}"""
+    limits = {}
+    for item in value.split(","):
+        route, _, n = item.partition("=")
+        if route.strip() and n.strip():
+            limits[route.strip()] = int(n)
+    return limits
+
+
+class Upstream:
+    """Salesforce calls on the event loop, bounded per tenant and route.
+
+    Mirrors sf_http.HttpClient.request: the route's breaker is checked
+    before every attempt and fed its outcome, every attempt takes a slot of
+    the adaptive limiter (quota shedding, Sforce-Limit-Info usage, AIMD
+    concurrency), failed idempotent calls are retried with jittered backoff
+    while the shared retry budget allows, and no attempt outlives the
+    task's sf_deadline. Breakers, limiter and budget are those of the
+    current tenant's sync client.
+    """
+
+    def __init__(self, concurrency=ASGI_UPSTREAM_CONCURRENCY, limits=None):
+        self.concurrency = concurrency
+        self.limits = parse_limits(ASGI_UPSTREAM_LIMITS) if limits is None else limits
+        self.http = None
+        self._slots = {}
+
+    def open(self):
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=ASGI_UPSTREAM_CONNECTIONS,
+                                max_keepalive_connections=sf_http.SF_POOL_MAXSIZE),
+            timeout=httpx.Timeout(sf_http.SF_READ_TIMEOUT, connect=sf_http.SF_CONNECT_TIMEOUT),
+        )
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+
+    def _client(self):
+        # Opened at lifespan startup; servers run without lifespan open it here
+        if self.http is None:
+            self.open()
+        return self.http
+
+    def _slot(self, tenant, route):
+        slot = self._slots.get((tenant, route))
+        if slot is None:
+            slot = self._slots[tenant, route] = asyncio.Semaphore(self.limits.get(route, self.concurrency))
+        return slot
+
+    async def request(self, method, url, route, idempotent=None, **kwargs):
+        """Send a request; raises sf_limits.Overloaded when it is shed"""
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in sf_http.IDEMPOTENT_METHODS
+        sync_client = tenants.current().http
+        breaker = sync_client.breakers.get(route)
+        budget = sync_client.budget
+
+        budget.deposit()
+        attempt = 0
+        while True:
+            breaker.check()
+            try:
+                response = await self._send(method, url, route, breaker, sync_client.limiter, **kwargs)
+            except httpx.TimeoutException as e:
+                if not sf_deadline.allows(0):
+                    raise sf_deadline.DeadlineExceeded() from e
+                connect_failed = isinstance(e, httpx.ConnectTimeout)
+                if not (idempotent or connect_failed) or not self._may_retry(attempt, budget):
+                    raise
+            except httpx.TransportError:
+                if not idempotent or not self._may_retry(attempt, budget):
+                    raise
+            else:
+                metrics.note_upstream_status(response.status_code)
+                if response.status_code not in sf_http.RETRY_STATUSES or not idempotent:
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                delay = (min(int(retry_after), sf_http.SF_RETRY_BACKOFF_MAX) if retry_after and retry_after.isdigit()
+                         else self._backoff(attempt))
+                if not sf_deadline.allows(delay) or not self._may_retry(attempt, budget):
+                    return response
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            delay = self._backoff(attempt)
+            if not sf_deadline.allows(delay):
+                raise sf_deadline.DeadlineExceeded()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _send(self, method, url, route, breaker, limiter, **kwargs):
+        """One attempt: wait for a slot of the tenant's route and its limiter, send, feed back the outcome"""
+        tenant = tenants.current().name
+        slot = self._slot(tenant, route)
+        priority = _priority.get()
+        wait = sf_limits.SF_LIMIT_WAIT[priority]
+        left = sf_deadline.remaining()
+        try:
+            await asyncio.wait_for(slot.acquire(), wait if left is None else min(wait, left))
+        except asyncio.TimeoutError:
+            if not sf_deadline.allows(0):
+                raise sf_deadline.DeadlineExceeded()
+            upstream_shed.inc(tenant=tenant, route=route)
+            raise sf_limits.Overloaded(f"Too many Salesforce {route} calls in flight")
+        upstream_in_flight.inc(tenant=tenant, route=route)
+        try:
+            started = await limiter.acquire_async(priority, wait=sf_deadline.remaining())
+            try:
+                # The whole exchange, not each read, must fit in what is left
+                response = await asyncio.wait_for(self._client().request(method, url, **kwargs),
+                                                  sf_deadline.remaining())
+            except asyncio.TimeoutError:
+                # Cut short for the deadline: says nothing about Salesforce
+                limiter.release(started)
+                raise sf_deadline.DeadlineExceeded()
+            except httpx.TransportError as e:
+                limiter.release(started, overloaded=isinstance(e, httpx.TimeoutException))
+                breaker.record(False)
+                raise
+            except BaseException:
+                limiter.release(started)
+                raise
+        finally:
+            slot.release()
+            upstream_in_flight.dec(tenant=tenant, route=route)
+        retry_after = response.headers.get("Retry-After")
+        limiter.note_usage(response.headers.get("Sforce-Limit-Info"))
+        limiter.release(
+            started,
+            overloaded=response.status_code in (429, 503),
+            retry_after=int(retry_after) if retry_after and retry_after.isdigit() else None,
+        )
+        breaker.record(response.status_code < 500 and response.status_code != 429)
+        return response
+
+    def _may_retry(self, attempt, budget):
+        return attempt < sf_http.SF_RETRIES and budget.withdraw()
+
+    def _backoff(self, attempt):
+        # "Full jitter", as in sf_http
+        return random.uniform(0, min(sf_http.SF_RETRY_BACKOFF_MAX, sf_http.SF_RETRY_BACKOFF * (2 ** attempt)))
+
+
+upstream = Upstream()
+
+
+# Salesforce calls: async counterparts of the helpers in app.py
+
+async def salesforce_token(stale_token=None):
+    """(access_token, instance_url) from memory, minted on a thread when needed"""
+    pair = tenants.current().token_manager.peek(stale_token)
+    if pair is None:
+        pair = await asyncio.to_thread(wsgi.jwt_authenticate_HUB, stale_token)
+    return pair
+
+
+async def refresh_auth_header(headers):
+    stale_token = headers.get('Authorization', '').replace('Bearer ', '', 1)
+    if not stale_token:
+        return False
+    access_token, _ = await salesforce_token(stale_token)
+    if access_token == stale_token:
+        return False
+    headers['Authorization'] = f'Bearer {access_token}'
+    return True
+
+
+async def call(method, endpoint, headers, instance_url, route, data=None):
+    """app.get/post/put: one call, repeated once with a fresh token after a 401"""
+    url = f"{instance_url}{endpoint}"
+    content = json_codec.dumps(data) if data is not None else None
+    response = await upstream.request(method, url, route, headers=headers, content=content)
+    if response.status_code == 401 and await refresh_auth_header(headers):
+        response = await upstream.request(method, url, route, headers=headers, content=content)
+    return response
+
+
+async def parse(response):
+    """json_codec.parse_response, off the event loop for large bodies"""
+    if len(response.content) > ASGI_PARSE_INLINE_BYTES:
+        return await asyncio.to_thread(json_codec.parse_response, response)
+    return json_codec.parse_response(response)
+
+
+async def auth_headers():
+    with metrics.stage("auth"):
+        access_token, instance_url = await salesforce_token()
+    return {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }, instance_url
+
+
+# Webhook: app.process_webhook and friends with one await per Salesforce
+# call; every decision and all bookkeeping are app.py's (app.WebhookRun)
+
+async def resolve_record_id(headers, instance_url, npi, attempts=3):
+    """app.resolve_record_id"""
+    record_id = await asyncio.to_thread(lambda: npi_index.lookup(npi) or org_replica.lookup_npi(npi))
+    if record_id:
+        return record_id
+
+    for _ in range(attempts):
+        response = await call("GET", f"/services/apexrest/MercyHealthOrgAPI/npi/{npi}", headers, instance_url,
+                              route="getByNPI")
+        existing_records = await parse(response) if response.status_code == 200 else None
+        log.debug("webhook.lookup", npi=npi, matches=len(existing_records) if existing_records else 0)
+        if existing_records and len(existing_records) > 0:
+            record_id = existing_records[0]['Id']
+            await asyncio.to_thread(npi_index.store, npi, record_id)
+            return record_id
+        if await asyncio.to_thread(npi_index.claim_create, npi):
+            return None
+        record_id = await asyncio.to_thread(npi_index.wait_for_create, npi, timeout=sf_deadline.remaining())
+        if record_id:
+            return record_id
+    raise npi_index.CreatePending(f"The record for NPI {npi} is still being created")
+
+
+async def process_webhook(webhook_data, mapped=None, queue_shed=False):
+    """app.process_webhook; returns (result, status_code)"""
+    run = wsgi.WebhookRun(webhook_data, queue_shed)
+    try:
+        answer = await asyncio.to_thread(run.prepare, mapped)
+        if answer is not None:
+            return answer
+
+        headers, instance_url = await auth_headers()
+        with metrics.stage("lookup"):
+            record_id = await resolve_record_id(headers, instance_url, run.npi)
+
+        if record_id:
+            log.debug("webhook.updating", npi=run.npi, record_id=record_id, fields=list(run.changes))
+            with metrics.stage("write"):
+                response = await call("PUT", f"/services/apexrest/MercyHealthOrgAPI/{record_id}",
+                                      headers, instance_url, "update", run.changes)
+            if response.status_code == 404:
+                await asyncio.to_thread(run.stale, record_id)
+                with metrics.stage("lookup"):
+                    record_id = await resolve_record_id(headers, instance_url, run.npi)
+                if record_id:
+                    with metrics.stage("write"):
+                        response = await call("PUT", f"/services/apexrest/MercyHealthOrgAPI/{record_id}",
+                                              headers, instance_url, "update", run.record_data)
+            if record_id:
+                if response.status_code == 200:
+                    return await asyncio.to_thread(run.updated, record_id, await parse(response))
+                return await asyncio.to_thread(run.update_failed, record_id, response)
+
+        run.creating = True
+        log.debug("webhook.creating", npi=run.npi)
+        with metrics.stage("write"):
+            response = await call("POST", "/services/apexrest/MercyHealthOrgAPI",
+                                  headers, instance_url, "create", run.record_data)
+        if response.status_code in [200, 201]:
+            return await asyncio.to_thread(run.created, await parse(response))
+        return await asyncio.to_thread(run.create_failed, response)
+
+    except sf_limits.Overloaded as e:
+        return await asyncio.to_thread(run.shed, e)
+    except Exception as e:
+        return await asyncio.to_thread(run.failed, e)
+    finally:
+        # Also when the request is cancelled (deadline, client gone); not
+        # awaited, so a second cancellation can't leave the claim behind
+        run.release_claim()
+
+
+async def handle_webhook(webhook_data, mapped=None):
+    """app.handle_webhook"""
+    if wsgi.queues_webhooks():
+        return await asyncio.to_thread(wsgi.enqueue_webhook, webhook_data, mapped)
+    return await process_webhook(webhook_data, mapped, queue_shed=True)
+
+
+async def handle_webhook_batch(events):
+    """app.handle_webhook_batch"""
+    results = []
+    for index, (event, mapped) in enumerate(zip(events, field_mapping.mapping.transform_many(events))):
+        if isinstance(event, dict):
+            result, status_code, replayed = await run_idempotent(wsgi.event_key(event), handle_webhook, event, mapped)
+        else:
+            result, status_code = await asyncio.to_thread(wsgi.process_webhook, event, mapped)
+            replayed = False
+        results.append(dict(result, index=index, status_code=status_code, replayed=replayed))
+    return wsgi.webhook_batch_result(results)
+
+
+async def run_idempotent(key, handler, *args):
+    """app.run_idempotent for a coroutine `handler`"""
+    if not key:
+        return await handler(*args) + (False,)
+
+    answer = await asyncio.to_thread(wsgi.claim_delivery, key)
+    if answer is not None:
+        return answer
+
+    try:
+        result, status_code = await handler(*args)
+    except BaseException:
+        sync_state.release_key(key)
+        raise
+
+    await asyncio.to_thread(wsgi.finish_delivery, key, result, status_code)
+    return result, status_code, False
+
+
+# Native routes. Each returns (status, headers, body), body being bytes, a
+# list of chunks or an async iterator of chunks.
+
+class Request:
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.args = MultiDict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+        self.headers = Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]])
+
+    async def body(self):
+        return await read_body(self.receive)
+
+    async def get_json(self):
+        """Like Flask's get_json(silent=True): None unless a JSON body parses"""
+        mimetype = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if not (mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))):
+            return None
+        try:
+            return json_codec.loads(await self.body())
+        except ValueError:
+            return None
+
+
+def json_reply(payload, status=200, headers=()):
+    return status, [("Content-Type", "application/json"), *headers], json_codec.dumps(payload) + b"\n"
+
+
+def cached_reply(request, body, headers=()):
+    """http_cache.encoded_response for an ASGI request"""
+    status, cache_headers, body = http_cache.prepare(
+        body, 200,
+        parse_accept_header(request.headers.get("Accept-Encoding")),
+        parse_etags(request.headers.get("If-None-Match")),
+    )
+    content_type = [("Content-Type", "application/json")] if body else []
+    return status, [*content_type, *cache_headers, *headers], body
+
+
+def overloaded_reply(e):
+    return json_reply({
+        "status": "error",
+        "message": str(e)
+    }, 503, [("Retry-After", str(e.retry_after))])
+
+
+async def hubspot_webhook(request):
+    webhook_data = await request.get_json()
+    if isinstance(webhook_data, list):
+        if not webhook_data or len(webhook_data) > wsgi.WEBHOOK_MAX_EVENTS:
+            return json_reply({
+                "status": "error",
+                "message": f"A batch must contain 1 to {wsgi.WEBHOOK_MAX_EVENTS} events"
+            }, 400)
+        handler = handle_webhook_batch
+    elif isinstance(webhook_data, dict):
+        handler = handle_webhook
+    else:
+        return json_reply({
+            "status": "error",
+            "message": "Request body must be a JSON object or an array of objects"
+        }, 400)
+
+    result, status_code, replayed = await run_idempotent(
+        wsgi.idempotency_key(webhook_data, request.headers), handler, webhook_data)
+    headers = []
+    if replayed:
+        headers.append(("Idempotent-Replayed", "true"))
+    if status_code == 503 and result.get("retry_after"):
+        headers.append(("Retry-After", str(result["retry_after"])))
+    return json_reply(wsgi.webhook_response_body(result, request.args.get('verbose') == '1'), status_code, headers)
+
+
+def records_stream(records, from_replica, limit, offset, stream_format):
+    """The streamed end of app.all_records; records are read and encoded as the body is sent"""
+    mimetype = "application/x-ndjson" if stream_format == "ndjson" else "application/json"
+    records = wsgi.slice_records((record for record in records), offset, offset + limit if limit else None)
+    return 200, [("Content-Type", mimetype)], iterate_on_thread(
+        wsgi.stream_records(records, stream_format, encoded=from_replica))
+
+
+def records_reply(request, records, from_replica, limit, cursor, offset):
+    """The unstreamed end of app.all_records, run on a thread"""
+    if limit is not None or cursor:
+        records = (record for record in records)  # slice_records closes what it reads
+    fields, records = wsgi.all_records_body(records, limit, cursor, offset, from_replica)
+    items = records if from_replica else [json_codec.dumps(r) for r in records]
+    return cached_reply(request, json_codec.envelope(fields, "data", items))
+
+
+async def all_records(request):
+    try:
+        limit, cursor, offset, stream_format = wsgi.all_records_args(request.args)
+    except wsgi.InvalidArguments as e:
+        return json_reply(e.body, 400)
+
+    try:
+        live = request.args.get('live') == '1'
+        complete = not live and await asyncio.to_thread(org_replica.is_complete)
+        from_replica = complete and await asyncio.to_thread(org_replica.is_fresh)
+        stale = False
+        if not from_replica:
+            try:
+                headers, instance_url = await auth_headers()
+                with metrics.stage("fetch"):
+                    response = await call("GET", "/services/apexrest/MercyHealthOrgAPI", headers, instance_url,
+                                          route="getAll")
+                    records = await parse(response) if response.status_code == 200 else False
+            except sf_limits.Overloaded:
+                if not complete or await asyncio.to_thread(org_replica.synced_at) is None:
+                    raise
+                stale = from_replica = True
+            else:
+                if records is False:
+                    return json_reply({
+                        "status": "error",
+                        "message": "Failed to retrieve records"
+                    }, 500)
+        if from_replica:
+            with metrics.stage("replica"):
+                # Read lazily, on the thread that encodes the body
+                records = org_replica.iter_records(raw=True)
+
+        if stream_format:
+            status, headers, body = records_stream(records, from_replica, limit, offset, stream_format)
+        else:
+            status, headers, body = await asyncio.to_thread(
+                records_reply, request, records, from_replica, limit, cursor, offset)
+        headers.append(("X-Data-Source", "replica" if from_replica else "salesforce"))
+        if stale:
+            headers.append(("X-Replica-Synced-At", datetime.fromtimestamp(
+                await asyncio.to_thread(org_replica.synced_at)).strftime("%Y-%m-%d %H:%M:%S")))
+        return status, headers, body
+
+    except sf_limits.Overloaded as e:
+        return overloaded_reply(e)
+    except Exception as e:
+        log.error("api_all.exception", exc_info=e)
+        return json_reply({
+            "status": "error",
+            "message": str(e)
+        }, 500)
+
+
+def samples_reply(request, params, samples):
+    """app.samples_output rendered on a thread"""
+    mimetype, body, headers = wsgi.samples_output(params, samples)
+    if mimetype == "application/json":
+        return cached_reply(request, json_codec.dumps(body), headers)
+    chunks = [chunk.encode() if isinstance(chunk, str) else chunk for chunk in body]
+    return 200, [("Content-Type", mimetype), *headers], chunks
+
+
+async def get_samples(request):
+    try:
+        params = wsgi.samples_args(request.args)
+    except wsgi.InvalidArguments as e:
+        return json_reply(e.body, 400)
+    start_date, end_date = params["start"], params["end"]
+
+    try:
+        stale = False
+        try:
+            headers, instance_url = await auth_headers()
+
+            async def fetch_range(first_day, last_day):
+                response = await call(
+                    "GET", f"/services/apexrest/hubspotintegration/getsamplesfornoninternalbatches"
+                           f"?start={first_day}&end={wsgi.samples_day_end(last_day)}",
+                    headers, instance_url, route="samples")
+                return await parse(response) if response.status_code == 200 else False
+
+            with metrics.stage("fetch"):
+                samples = await samples_cache.get_range_async(start_date, end_date, fetch_range,
+                                                              refresh=params["refresh"])
+        except sf_limits.Overloaded:
+            samples = await asyncio.to_thread(samples_cache.get_cached_range, start_date, end_date)
+            if samples is None:
+                raise
+            stale = True
+
+        if samples is False:
+            return json_reply({
+                "status": "error",
+                "message": "Failed to retrieve samples"
+            }, 500)
+
+        status, headers, body = await asyncio.to_thread(samples_reply, request, params, samples)
+        if stale:
+            headers.append(("X-Data-Source", "stale-cache"))
+        return status, headers, body
+
+    except sf_limits.Overloaded as e:
+        return overloaded_reply(e)
+    except Exception as e:
+        log.error("api_samples.exception", exc_info=e, start=start_date, end=end_date)
+        return json_reply({
+            "status": "error",
+            "message": str(e)
+        }, 500)
+
+
+async def health_check(request):
+    return json_reply({"status": "healthy"})
+
+
+ROUTES = {
+    ("POST", "/webhook/hubspot"): hubspot_webhook,
+    ("GET", "/api/all"): all_records,
+    ("GET", "/api/samples"): get_samples,
+    ("GET", "/health"): health_check,
+}
+
+
+async def serve(tenant, route, handler, scope, receive, send):
+    """Run a native route for `tenant` under the metrics trace, its priority and the request deadline"""
+    tenants.activate(tenant)
+    with metrics.trace(route):
+        _priority.set(wsgi.ROUTE_PRIORITIES.get(route, sf_limits.NORMAL))
+        sf_deadline.set_deadline(sf_deadline.SF_REQUEST_DEADLINE)
+        try:
+            status, headers, body = await handler(Request(scope, receive))
+        except Exception as e:
+            log.error("asgi.exception", exc_info=e, route=route)
+            status, headers, body = json_reply({
+                "status": "error",
+                "message": str(e)
+            }, 500)
+        metrics.annotate(status=status)
+        await send_response(send, status, headers, body, receive)
+
+
+async def send_response(send, status, headers, body, receive=None):
+    """Send a reply; `body` is bytes, a list of chunks or an async iterator of chunks"""
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in headers],
+    })
+    if hasattr(body, "__aiter__"):
+        await send_stream(send, body, receive)
+    else:
+        for chunk in body if isinstance(body, list) else [body]:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def send_stream(send, chunks, receive=None):
+    """Send chunks as they come; stops early when the client goes away.
+
+    The status is already out, so a failure half way is logged and the body
+    cut short.
+    """
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive)) if receive else None
+    try:
+        async for chunk in chunks:
+            if disconnected is not None and disconnected.done():
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    except Exception as e:
+        log.error("asgi.stream_failed", exc_info=e)
+    finally:
+        if disconnected is not None:
+            disconnected.cancel()
+        await chunks.aclose()
+
+
+async def wait_for_disconnect(receive):
+    """Return once the client has gone; request body messages are dropped"""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def iterate_on_thread(iterable):
+    """Items of a sync iterable, all pulled on one thread of its own.
+
+    For bodies that read as they go: a SQLite cursor only works on the
+    thread that opened it, and the loop never waits on a read. Runs in the
+    caller's context (tenant, storage scope).
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asgi-stream")
+    items = iter(iterable)
+    try:
+        while True:
+            item = await loop.run_in_executor(thread, context.run, next, items, _DONE)
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        if hasattr(items, "close"):
+            await loop.run_in_executor(thread, context.run, items.close)
+        thread.shutdown(wait=False)
+
+
+async def read_body(receive):
+    body = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(body)
+
+
+# Everything else: the Flask app on a thread pool
+
+_wsgi_pool = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix="asgi-wsgi")
+_DONE = object()
+
+
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def call_wsgi(scope, receive, send):
+    """Run the Flask app for one request, passing its body on chunk by chunk.
+
+    Chunks are pulled on the pool, so a streaming route (/logs/stream) holds
+    one thread, not the loop; it is closed when the client goes away. The
+    app and its body run in one context, so the tenant (and storage scope)
+    the app picked still holds for chunks pulled on another thread.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    environ = wsgi_environ(scope, await read_body(receive))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    iterable = await loop.run_in_executor(_wsgi_pool, context.run, wsgi.app, environ, start_response)
+    disconnected = asyncio.ensure_future(receive())
+    try:
+        chunks = iter(iterable)
+        first = await loop.run_in_executor(_wsgi_pool, context.run, next, chunks, _DONE)
+        await send({
+            "type": "http.response.start",
+            "status": started["status"],
+            "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in started["headers"]],
+        })
+        chunk = first
+        while chunk is not _DONE and not disconnected.done():
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(_wsgi_pool, context.run, next, chunks, _DONE)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+        if hasattr(iterable, "close"):
+            await loop.run_in_executor(_wsgi_pool, context.run, iterable.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if httpx is None:
+                await send({"type": "lifespan.startup.failed",
+                            "message": "The ASGI entry point needs httpx: pip install httpx"})
+                return
+            upstream.open()
+            metrics.start_flusher()
+            for tenant in tenants.all():
+                wsgi.start_replica_sync(tenant)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await upstream.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    name, path = tenants.split_path(scope["path"])
+    handler = ROUTES.get((scope["method"], path))
+    if handler is None:
+        # The Flask app picks its tenant itself (tenants.Middleware)
+        await call_wsgi(scope, receive, send)
+        return
+    if name is None:
+        name = Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]]).get(
+            tenants.TENANT_HEADER)
+    try:
+        tenant = tenants.get(name)
+    except tenants.UnknownTenant as e:
+        await send_response(send, *json_reply({
+            "status": "error",
+            "message": str(e)
+        }, 404))
+        return
+    await serve(tenant, path, handler, scope, receive, send)
@@ -0,0 +1,390 @@
+"""Bulk backfill: stream a HubSpot export into Salesforce through Bulk API 2.0.
+
+Reads a CSV or JSONL export row by row, maps every row with the same field
+mapping as /webhook/hubspot and upserts them on NPI__c in chunked ingest
+jobs, several uploading at once. Needs SF_ORG_SOBJECT (the object behind
+MercyHealthOrgAPI) and the usual HUB_* credentials; --tenant picks the org
+when several are configured (see tenants.py):
+
+    python backfill.py providers.csv --chunk-size 10000 --parallel 4
+    python backfill.py providers.csv --tenant sandbox
+
+Every NPI is upserted once, in the chunk of its last row: earlier rows for
+it are merged into that one (later values win), so parallel jobs never
+race on a provider. Finding the last rows takes a first pass over the
+export (stdin is spooled to a temporary file for it) and one entry per NPI
+in memory.
+
+Finished chunks are recorded in a checkpoint file, so running the same
+command again after a crash resumes with the first unfinished chunk. Rows
+rejected by the mapping or by Salesforce are appended to a reject CSV.
+Successful rows also warm the NPI index and the sync state, so later
+webhooks for those providers skip the lookup and unchanged updates.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+import requests
+
+import app_logging
+import field_mapping
+import json_codec
+import npi_index
+import sf_limits
+import sync_state
+import tenants
+from sf_http import SF_API_VERSION
+
+BACKFILL_CHUNK_SIZE = int(os.environ.get("BACKFILL_CHUNK_SIZE", 10000))  # rows per ingest job
+BACKFILL_PARALLEL = int(os.environ.get("BACKFILL_PARALLEL", 4))  # jobs in flight
+BACKFILL_POLL_INTERVAL = float(os.environ.get("BACKFILL_POLL_INTERVAL", 2))  # seconds
+BACKFILL_JOB_TIMEOUT = float(os.environ.get("BACKFILL_JOB_TIMEOUT", 3600))  # seconds per job
+
+REJECT_COLUMNS = ["row", "NPI__c", "source", "error", "data"]
+FINAL_STATES = ("JobComplete", "Failed", "Aborted")
+
+log = app_logging.get_logger("backfill")
+
+
+class BulkJobError(Exception):
+    pass
+
+
+def read_rows(path, fmt):
+    """Yield (row_number, row) from the export, streaming; bad JSONL lines yield their error"""
+    stream = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8-sig")
+    try:
+        if fmt == "csv":
+            for number, row in enumerate(csv.DictReader(stream), 1):
+                yield number, row
+        else:
+            for number, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield number, json_codec.loads(line)
+                except ValueError as e:
+                    yield number, ValueError(f"invalid JSON: {e}")
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def map_row(row):
+    """(record_data, errors) for one input row"""
+    if isinstance(row, Exception):
+        return {}, [str(row)]
+    if not isinstance(row, dict):
+        return {}, ["Row must be a JSON object"]
+    return field_mapping.mapping.transform(row)
+
+
+def last_rows(rows):
+    """{NPI: number of the last valid row carrying it}"""
+    last = {}
+    for number, row in rows:
+        record_data, errors = map_row(row)
+        if not errors:
+            last[record_data["NPI__c"]] = number
+    return last
+
+
+def read_chunks(rows, chunk_size, done, last):
+    """Group rows into fixed chunks of input rows, mapped and ready to upload.
+
+    Chunk k always covers the same input rows, so a resumed run can skip the
+    chunks in `done`. Yields (index, row_count, records, rejects), where
+    records are (row_number, record_data). An NPI is only uploaded with its
+    last row (`last`, see last_rows), merged with every earlier row for it
+    (later values win): an ingest job rejects duplicate external ids, and
+    parallel jobs must not race on the same record.
+    """
+    pending = {}  # NPI -> merged fields of its rows before the last
+    index = 0
+    while True:
+        batch = list(islice(rows, chunk_size))
+        if not batch:
+            return
+        records, rejects = [], []
+        for number, row in batch:
+            record_data, errors = map_row(row)
+            if errors:
+                data = None if isinstance(row, Exception) else row
+                rejects.append(reject_row(number, record_data.get("NPI__c"), "mapping", "; ".join(errors), data))
+                continue
+            npi = record_data["NPI__c"]
+            if last.get(npi, number) != number:
+                pending[npi] = {**pending.get(npi, {}), **record_data}
+                continue
+            records.append((number, {**pending.pop(npi, {}), **record_data}))
+        if index not in done:
+            yield index, len(batch), records, rejects
+        index += 1
+
+
+def reject_row(number, npi, source, error, data):
+    return {
+        "row": number,
+        "NPI__c": npi or "",
+        "source": source,
+        "error": error,
+        "data": json_codec.dumps(data).decode() if data is not None else "",
+    }
+
+
+def to_csv(records):
+    """Bulk API CSV for the records; empty cells leave a field unchanged"""
+    columns = [field for field, *_ in field_mapping.mapping.fields
+               if any(field in record_data for _, record_data in records)]
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=columns, lineterminator="\n")
+    writer.writeheader()
+    for _, record_data in records:
+        writer.writerow(record_data)
+    return out.getvalue().encode("utf-8")
+
+
+class Checkpoint:
+    """Finished chunk numbers, saved atomically after every chunk"""
+
+    def __init__(self, path, source, chunk_size):
+        self.path = path
+        self.source = source
+        self.chunk_size = chunk_size
+        self.done = set()
+        self.totals = {"rows": 0, "upserted": 0, "rejected": 0}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get("source") != source or state.get("chunk_size") != chunk_size:
+                raise SystemExit(
+                    f"{path} belongs to a run of {state.get('source')} with chunk size "
+                    f"{state.get('chunk_size')}; delete it or pass the same arguments"
+                )
+            self.done = set(state.get("done", []))
+            self.totals.update(state.get("totals", {}))
+
+    def finish(self, index, rows, upserted, rejected):
+        with self._lock:
+            self.done.add(index)
+            self.totals["rows"] += rows
+            self.totals["upserted"] += upserted
+            self.totals["rejected"] += rejected
+            if not self.path:
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({
+                    "source": self.source,
+                    "chunk_size": self.chunk_size,
+                    "done": sorted(self.done),
+                    "totals": self.totals,
+                }, f)
+            os.replace(tmp_path, self.path)
+
+
+class RejectWriter:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, rows):
+        if not rows:
+            return
+        with self._lock:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, "a", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=REJECT_COLUMNS)
+                if new:
+                    writer.writeheader()
+                writer.writerows(rows)
+
+
+class BulkClient:
+    """Bulk API 2.0 ingest calls for the current tenant, sharing one auth header across threads"""
+
+    def __init__(self):
+        self.tenant = tenants.current()
+        access_token, self.instance_url = tenants.authenticate()
+        self.headers = {"Authorization": f"Bearer {access_token}"}
+        self.base = f"/services/data/v{SF_API_VERSION}/jobs/ingest"
+
+    def request(self, method, endpoint, **kwargs):
+        url = f"{self.instance_url}{self.base}{endpoint}"
+        extra = kwargs.pop("headers", {})
+        response = self.tenant.http.request(method, url, headers={**self.headers, **extra}, route="bulk", **kwargs)
+        if response.status_code == 401 and tenants.refresh_auth_header(self.headers):
+            response = self.tenant.http.request(method, url, headers={**self.headers, **extra}, route="bulk", **kwargs)
+        if response.status_code >= 400:
+            raise BulkJobError(f"{method} {self.base}{endpoint} returned {response.status_code}: {response.text}")
+        return response
+
+    def upsert(self, body, poll_interval, timeout):
+        """Run one upsert job to completion; returns its final job info"""
+        job = json_codec.parse_response(self.request("POST", "/", json={
+            "object": self.tenant.org_sobject,
+            "externalIdFieldName": "NPI__c",
+            "contentType": "CSV",
+            "operation": "upsert",
+            "lineEnding": "LF",
+        }))
+        job_id = job["id"]
+        try:
+            self.request("PUT", f"/{job_id}/batches", data=body, headers={"Content-Type": "text/csv"})
+            self.request("PATCH", f"/{job_id}", json={"state": "UploadComplete"})
+        except BulkJobError:
+            self.abort(job_id)
+            raise
+
+        deadline = time.time() + timeout
+        delay = poll_interval
+        while True:
+            job = json_codec.parse_response(self.request("GET", f"/{job_id}"))
+            if job.get("state") in FINAL_STATES:
+                return job
+            if time.time() > deadline:
+                self.abort(job_id)
+                raise BulkJobError(f"job {job_id} did not finish within {timeout:.0f}s")
+            time.sleep(delay)
+            delay = min(delay * 1.5, poll_interval * 5)
+
+    def abort(self, job_id):
+        try:
+            self.request("PATCH", f"/{job_id}", json={"state": "Aborted"})
+        except (BulkJobError, sf_limits.Overloaded, requests.RequestException) as e:
+            log.warning("backfill.abort_failed", job_id=job_id, error=str(e))
+
+    def results(self, job_id, kind):
+        """Rows of successfulResults / failedResults as dicts"""
+        response = self.request("GET", f"/{job_id}/{kind}/")
+        return list(csv.DictReader(io.StringIO(response.content.decode("utf-8"))))
+
+
+def run_chunk(bulk, index, records, rejects, args):
+    """Upload one chunk; returns (upserted, rejects) once Salesforce has processed it"""
+    if not records:
+        return 0, rejects
+    job = bulk.upsert(to_csv(records), args.poll_interval, args.job_timeout)
+    if job.get("state") != "JobComplete":
+        raise BulkJobError(f"job {job['id']} ended {job.get('state')}: {job.get('errorMessage', '')}")
+
+    # Salesforce results carry the original columns, not row numbers: match on NPI
+    row_numbers = {record_data["NPI__c"]: number for number, record_data in records}
+    by_npi = {record_data["NPI__c"]: record_data for _, record_data in records}
+    for row in bulk.results(job["id"], "failedResults"):
+        npi = row.get("NPI__c")
+        rejects.append(reject_row(row_numbers.get(npi, ""), npi, "salesforce", row.get("sf__Error"),
+                                  by_npi.get(npi, row)))
+    succeeded = [(row.get("NPI__c"), row.get("sf__Id")) for row in bulk.results(job["id"], "successfulResults")]
+    npi_index.store_many(succeeded)
+    sync_state.remember_many([(npi, by_npi[npi]) for npi, _ in succeeded if npi in by_npi])
+    log.info("backfill.chunk_done", chunk=index, job_id=job["id"], upserted=len(succeeded),
+             rejected=len(rejects))
+    return len(succeeded), rejects
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("path", help="CSV or JSONL export, or - for stdin")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="default: from the file extension")
+    parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE, help="input rows per ingest job")
+    parser.add_argument("--parallel", type=int, default=BACKFILL_PARALLEL, help="ingest jobs in flight")
+    parser.add_argument("--checkpoint", help="default: <path>.checkpoint.json")
+    parser.add_argument("--rejects", help="default: <path>.rejects.csv")
+    parser.add_argument("--poll-interval", type=float, default=BACKFILL_POLL_INTERVAL)
+    parser.add_argument("--job-timeout", type=float, default=BACKFILL_JOB_TIMEOUT)
+    parser.add_argument("--dry-run", action="store_true", help="map and validate only; write rejects")
+    parser.add_argument("--tenant", help="org to load into (default: the first of TENANTS)")
+    args = parser.parse_args(argv)
+
+    try:
+        tenant = tenants.get(args.tenant)
+    except tenants.UnknownTenant as e:
+        parser.error(str(e))
+    tenants.activate(tenant)
+
+    fmt = args.format or ("jsonl" if args.path.endswith((".jsonl", ".ndjson", ".json")) else "csv")
+    if args.path == "-" and not args.format:
+        parser.error("--format is required when reading stdin")
+    path = args.path
+    if path == "-":
+        # Read twice (last_rows, then the upload): keep a copy
+        spool = tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="", suffix=f".{fmt}")
+        shutil.copyfileobj(sys.stdin, spool)
+        spool.flush()
+        path = spool.name
+    if not tenant.org_sobject and not args.dry_run:
+        parser.error("SF_ORG_SOBJECT must name the object to upsert into")
+    base = "backfill-stdin" if args.path == "-" else args.path
+    if args.tenant:
+        base = f"{base}.{tenant.name}"
+    source = os.path.abspath(args.path) if args.path != "-" else "-"
+    checkpoint = Checkpoint(None if args.dry_run else args.checkpoint or f"{base}.checkpoint.json",
+                            source, args.chunk_size)
+    rejects = RejectWriter(args.rejects or f"{base}.rejects.csv")
+    if checkpoint.done:
+        print(f"resuming: {len(checkpoint.done)} chunks already done")
+
+    chunks = read_chunks(read_rows(path, fmt), args.chunk_size, checkpoint.done, last_rows(read_rows(path, fmt)))
+    started = time.time()
+    failed = []
+
+    if args.dry_run:
+        for index, row_count, records, chunk_rejects in chunks:
+            rejects.write(chunk_rejects)
+            checkpoint.finish(index, row_count, 0, len(chunk_rejects))
+    else:
+        bulk = BulkClient()
+        with ThreadPoolExecutor(max_workers=args.parallel, thread_name_prefix="backfill") as pool:
+            pending = {}
+            for index, row_count, records, chunk_rejects in chunks:
+                # Keep reading ahead bounded so memory stays flat on big exports
+                while len(pending) >= args.parallel * 2:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        collect(future, pending.pop(future), rejects, checkpoint, failed)
+                future = pool.submit(tenants.bind(run_chunk), bulk, index, records, list(chunk_rejects), args)
+                pending[future] = (index, row_count)
+            for future in list(pending):
+                collect(future, pending.pop(future), rejects, checkpoint, failed)
+
+    totals = checkpoint.totals
+    print(f"{totals['rows']} rows, {totals['upserted']} upserted, {totals['rejected']} rejected "
+          f"in {time.time() - started:.1f}s (rejects: {rejects.path})")
+    if failed:
+        print(f"{len(failed)} chunks failed and will be retried on the next run: {sorted(failed)}")
+        return 1
+    return 0
+
+
+def collect(future, chunk, rejects, checkpoint, failed):
+    index, rows = chunk
+    try:
+        upserted, chunk_rejects = future.result()
+    except (BulkJobError, sf_limits.Overloaded, requests.RequestException) as e:
+        log.error("backfill.chunk_failed", chunk=index, error=str(e))
+        failed.append(index)
+        return
+    except Exception as e:
+        # Whatever went wrong, the other chunks still get checkpointed
+        log.error("backfill.chunk_failed", chunk=index, exc_info=e)
+        failed.append(index)
+        return
+    # Rejects first: a crash before the checkpoint only repeats reject lines
+    rejects.write(chunk_rejects)
+    checkpoint.finish(index, rows, upserted, len(chunk_rejects))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""Offline load test for the webhook and read endpoints.
+
+Starts bench/sf_stub.py and the Flask app under gunicorn, pointed at the
+stub with a throwaway key and state directory. It then drives each scenario
+at the given concurrency and reports latency percentiles, throughput,
+errors and Salesforce calls per request. Exits non-zero when a threshold is
+exceeded, so it can gate CI:
+
+    python bench/run_benchmark.py --concurrency 16 --duration 20 --max-p95-ms 250
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("webhook", "all", "samples")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def private_key_pem():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def make_request(scenario, base_url, session, rng, records):
+    if scenario == "webhook":
+        # Mostly updates of known NPIs, with some new providers
+        if rng.random() < 0.9:
+            npi = str(1000000000 + rng.randrange(records))
+        else:
+            npi = str(2000000000 + rng.randrange(10 ** 8))
+        payload = {
+            "npi": npi,
+            "organization_name": f"Clinic {npi}",
+            "city": rng.choice(["Austin", "Dallas", "Miami"]),
+            "state": "TX",
+            "phone": f"555{rng.randint(1000000, 9999999)}",
+        }
+        return session.post(f"{base_url}/webhook/hubspot", json=payload, timeout=60)
+    if scenario == "all":
+        return session.get(f"{base_url}/api/all", timeout=60)
+    end = date.today() - timedelta(days=rng.randrange(30))
+    start = end - timedelta(days=29)
+    return session.get(f"{base_url}/api/samples?start={start}&end={end}", timeout=60)
+
+
+def run_scenario(scenario, base_url, stub_url, concurrency, duration, records):
+    requests.post(f"{stub_url}/_stub/reset")
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def worker(seed):
+        rng = random.Random(seed)
+        session = requests.Session()
+        while time.time() < stop_at:
+            started = time.perf_counter()
+            try:
+                response = make_request(scenario, base_url, session, rng, records)
+                ok = response.status_code < 400
+                response.content
+            except requests.RequestException:
+                ok = False
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors.append(elapsed)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - started
+
+    upstream = requests.get(f"{stub_url}/_stub/stats").json()["calls"]
+    latencies.sort()
+    total = len(latencies)
+    return {
+        "scenario": scenario,
+        "requests": total,
+        "errors": len(errors),
+        "rps": round(total / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "upstream_calls_per_request": round(sum(upstream.values()) / total, 2) if total else 0.0,
+        "upstream_calls": upstream,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--records", type=int, default=1000, help="stub dataset size")
+    parser.add_argument("--latency-ms", type=float, default=50, help="stub base latency")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="stub random extra latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="stub 503 rate")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the app, e.g. WEBHOOK_MODE=async")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="fail if any scenario's p95 is higher")
+    parser.add_argument("--max-error-rate", type=float, help="fail if any scenario's error rate is higher")
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    state_dir = tempfile.mkdtemp(prefix="mercybio-bench-")
+    stub_port, app_port = free_port(), free_port()
+    stub_url, base_url = f"http://127.0.0.1:{stub_port}", f"http://127.0.0.1:{app_port}"
+    processes = []
+    try:
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "bench", "sf_stub.py"), "--port", str(stub_port),
+             "--records", str(args.records), "--latency-ms", str(args.latency_ms),
+             "--jitter-ms", str(args.jitter_ms), "--error-rate", str(args.error_rate)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ))
+        wait_for(f"{stub_url}/_stub/stats")
+
+        env = dict(os.environ)
+        env.update({
+            "HUB_CLIENT_ID": "bench",
+            "HUB_USERNAME": "bench@example.com",
+            "HUB_PRIVATE_KEY": private_key_pem(),
+            "HUB_AUTH_URL": f"{stub_url}/services/oauth2/token",
+            "HUB_TOKEN_CACHE_FILE": os.path.join(state_dir, "token.json"),
+            "STATE_DIR": state_dir,
+            "LOG_LEVEL": "WARNING",
+        })
+        env.update(kv.split("=", 1) for kv in args.app_env)
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{app_port}",
+             "--workers", str(args.workers), "--threads", str(args.threads), "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        ))
+        wait_for(f"{base_url}/health")
+
+        results = []
+        for scenario in scenarios:
+            result = run_scenario(scenario, base_url, stub_url, args.concurrency, args.duration, args.records)
+            results.append(result)
+            print(f"{scenario:>8}: {result['requests']:>6} req  {result['rps']:>7} req/s  "
+                  f"p50 {result['p50_ms']:>7} ms  p95 {result['p95_ms']:>7} ms  p99 {result['p99_ms']:>7} ms  "
+                  f"errors {result['errors']:>4}  upstream/req {result['upstream_calls_per_request']}")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    for result in results:
+        if args.max_p95_ms is not None and result["p95_ms"] > args.max_p95_ms:
+            print(f"FAIL {result['scenario']}: p95 {result['p95_ms']} ms > {args.max_p95_ms} ms")
+            failed = True
+        error_rate = result["errors"] / result["requests"] if result["requests"] else 1.0
+        if args.max_error_rate is not None and error_rate > args.max_error_rate:
+            print(f"FAIL {result['scenario']}: error rate {error_rate:.3f} > {args.max_error_rate}")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
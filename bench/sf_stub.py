@@ -0,0 +1,370 @@
+"""Local stand-in for the Salesforce endpoints the service calls.
+
+Serves the OAuth token endpoint, the MercyHealthOrgAPI Apex routes, the
+sObject Collections upsert, Bulk API 2.0 ingest jobs, a minimal SOQL
+queryAll and the hubspotintegration samples query from an in-memory
+dataset, with configurable latency and error rates. Call counts per route
+are available at /_stub/stats so benchmarks can report upstream calls per
+request.
+
+    python bench/sf_stub.py --port 8801 --records 5000 --latency-ms 80 --error-rate 0.01
+"""
+import argparse
+import csv
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+from flask import Flask, Response, jsonify, request
+
+stub = Flask(__name__)
+
+config = {
+    "latency_ms": 0.0,
+    "jitter_ms": 0.0,
+    "error_rate": 0.0,
+    "samples_per_day": 20,
+    "api_limit": 1000000,
+}
+records = {}  # Id -> record
+by_npi = {}  # NPI -> Id
+query_cursors = {}  # queryAll locator -> remaining rows
+ingest_jobs = {}  # Bulk API 2.0 job id -> {"info", "data", "success", "failed"}
+calls = Counter()
+lock = threading.Lock()
+
+STATES = ["TX", "CA", "NY", "FL", "IL", "OH", "GA", "WA"]
+SOQL = re.compile(r"SELECT (.+?) FROM \w+(?: WHERE LastModifiedDate >= (\S+))?", re.IGNORECASE)
+QUERY_PAGE_SIZE = 2000
+CITIES = ["Austin", "Dallas", "Houston", "Miami", "Chicago", "Seattle", "Atlanta", "Columbus"]
+
+
+def make_npi(i):
+    return str(1000000000 + i)
+
+
+def load_dataset(count, seed=42):
+    rng = random.Random(seed)
+    records.clear()
+    by_npi.clear()
+    for i in range(count):
+        record_id = f"a0B{i:015d}"
+        npi = make_npi(i)
+        records[record_id] = {
+            "Id": record_id,
+            "NPI__c": npi,
+            "Healthcare_Organization_Name__c": f"Clinic {i}",
+            "Provider_Name__c": f"Provider {i}",
+            "City__c": rng.choice(CITIES),
+            "State__c": rng.choice(STATES),
+            "ZipCode__c": f"{rng.randint(10000, 99999)}",
+            "Phone_Number__c": f"555{rng.randint(1000000, 9999999)}",
+            "LastModifiedDate": "2025-01-01T00:00:00.000Z",
+        }
+        by_npi[npi] = record_id
+
+
+def modified_stamp():
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000+0000")
+
+
+def simulate(route):
+    """Count the call, sleep for the configured latency, maybe fail"""
+    with lock:
+        calls[route] += 1
+    delay = config["latency_ms"] + random.uniform(0, config["jitter_ms"])
+    if delay:
+        time.sleep(delay / 1000)
+    if config["error_rate"] and random.random() < config["error_rate"]:
+        return jsonify([{"errorCode": "SERVER_UNAVAILABLE", "message": "stub injected error"}]), 503
+    return None
+
+
+@stub.after_request
+def api_usage(response):
+    # Like Salesforce, report org-wide API usage on every REST response
+    if request.path.startswith("/services/") and not request.path.startswith("/services/oauth2/"):
+        with lock:
+            used = sum(n for route, n in calls.items() if route != "oauth_token")
+        response.headers["Sforce-Limit-Info"] = f"api-usage={used}/{config['api_limit']}"
+    return response
+
+
+@stub.route("/services/oauth2/token", methods=["POST"])
+def token():
+    failure = simulate("oauth_token")
+    if failure:
+        return failure
+    return jsonify({
+        "access_token": uuid.uuid4().hex,
+        "instance_url": request.host_url.rstrip("/"),
+        "token_type": "Bearer",
+        "issued_at": str(int(time.time() * 1000)),
+    })
+
+
+@stub.route("/services/apexrest/MercyHealthOrgAPI", methods=["GET"])
+def get_all():
+    failure = simulate("org_get_all")
+    if failure:
+        return failure
+    with lock:
+        body = json.dumps(list(records.values()))
+    return Response(body, mimetype="application/json")
+
+
+@stub.route("/services/apexrest/MercyHealthOrgAPI/npi/<npi>", methods=["GET"])
+def get_by_npi(npi):
+    failure = simulate("org_get_by_npi")
+    if failure:
+        return failure
+    with lock:
+        record_id = by_npi.get(npi)
+        return jsonify([records[record_id]] if record_id else [])
+
+
+@stub.route("/services/apexrest/MercyHealthOrgAPI", methods=["POST"])
+def create():
+    failure = simulate("org_create")
+    if failure:
+        return failure
+    data = request.get_json()
+    with lock:
+        if data.get("NPI__c") in by_npi:
+            return jsonify([{"errorCode": "DUPLICATE_VALUE", "message": "duplicate NPI__c"}]), 400
+        record_id = f"a0N{uuid.uuid4().hex[:15]}"
+        records[record_id] = dict(data, Id=record_id, LastModifiedDate=modified_stamp())
+        by_npi[data.get("NPI__c")] = record_id
+    return jsonify({"Id": record_id, "success": True}), 201
+
+
+@stub.route("/services/apexrest/MercyHealthOrgAPI/<record_id>", methods=["PUT"])
+def update(record_id):
+    failure = simulate("org_update")
+    if failure:
+        return failure
+    with lock:
+        if record_id not in records:
+            return jsonify([{"errorCode": "NOT_FOUND", "message": "record not found"}]), 404
+        records[record_id].update(request.get_json(), LastModifiedDate=modified_stamp())
+    return jsonify({"Id": record_id, "success": True})
+
+
+@stub.route("/services/data/<version>/composite/sobjects/<sobject>/<external_id>", methods=["PATCH"])
+def upsert_collection(version, sobject, external_id):
+    failure = simulate("composite_upsert")
+    if failure:
+        return failure
+    results = []
+    with lock:
+        for item in request.get_json()["records"]:
+            data = {k: v for k, v in item.items() if k != "attributes"}
+            record_id = by_npi.get(data.get(external_id))
+            created = record_id is None
+            if created:
+                record_id = f"a0N{uuid.uuid4().hex[:15]}"
+                records[record_id] = {"Id": record_id}
+                by_npi[data.get(external_id)] = record_id
+            records[record_id].update(data, LastModifiedDate=modified_stamp())
+            results.append({"id": record_id, "success": True, "created": created, "errors": []})
+    return jsonify(results)
+
+
+@stub.route("/services/data/<version>/jobs/ingest/", methods=["POST"])
+def create_ingest_job(version):
+    failure = simulate("bulk_create_job")
+    if failure:
+        return failure
+    job = dict(request.get_json(), id=f"750{uuid.uuid4().hex[:15]}", state="Open")
+    with lock:
+        ingest_jobs[job["id"]] = {"info": job, "data": b"", "success": [], "failed": []}
+    return jsonify(job)
+
+
+@stub.route("/services/data/<version>/jobs/ingest/<job_id>/batches", methods=["PUT"])
+def upload_ingest_data(version, job_id):
+    failure = simulate("bulk_upload")
+    if failure:
+        return failure
+    with lock:
+        job = ingest_jobs.get(job_id)
+        if job is None or job["info"]["state"] != "Open":
+            return jsonify([{"errorCode": "INVALIDJOB", "message": "job is not open"}]), 400
+        job["data"] += request.get_data()
+    return "", 201
+
+
+@stub.route("/services/data/<version>/jobs/ingest/<job_id>", methods=["PATCH"])
+def close_ingest_job(version, job_id):
+    failure = simulate("bulk_close_job")
+    if failure:
+        return failure
+    state = request.get_json().get("state")
+    with lock:
+        job = ingest_jobs.get(job_id)
+        if job is None:
+            return jsonify([{"errorCode": "NOT_FOUND", "message": "job not found"}]), 404
+        if state == "UploadComplete":
+            # Process the upload right away; rows without an NPI fail
+            external_id = job["info"]["externalIdFieldName"]
+            for row in csv.DictReader(io.StringIO(job["data"].decode("utf-8"))):
+                data = {k: v for k, v in row.items() if v != ""}
+                if not data.get(external_id):
+                    job["failed"].append(dict(row, sf__Id="", sf__Error=f"MISSING_ARGUMENT:{external_id} not specified"))
+                    continue
+                record_id = by_npi.get(data[external_id])
+                created = record_id is None
+                if created:
+                    record_id = f"a0N{uuid.uuid4().hex[:15]}"
+                    records[record_id] = {"Id": record_id}
+                    by_npi[data[external_id]] = record_id
+                records[record_id].update(data, LastModifiedDate=modified_stamp())
+                job["success"].append(dict(row, sf__Id=record_id, sf__Created=str(created).lower()))
+            job["info"].update(state="JobComplete", numberRecordsProcessed=len(job["success"]) + len(job["failed"]),
+                               numberRecordsFailed=len(job["failed"]))
+        else:
+            job["info"]["state"] = state
+        return jsonify(job["info"])
+
+
+@stub.route("/services/data/<version>/jobs/ingest/<job_id>", methods=["GET"])
+def get_ingest_job(version, job_id):
+    failure = simulate("bulk_job_status")
+    if failure:
+        return failure
+    with lock:
+        job = ingest_jobs.get(job_id)
+        if job is None:
+            return jsonify([{"errorCode": "NOT_FOUND", "message": "job not found"}]), 404
+        return jsonify(job["info"])
+
+
+@stub.route("/services/data/<version>/jobs/ingest/<job_id>/<kind>/", methods=["GET"])
+def get_ingest_results(version, job_id, kind):
+    failure = simulate("bulk_results")
+    if failure:
+        return failure
+    with lock:
+        job = ingest_jobs.get(job_id)
+        rows = job and {"successfulResults": job["success"], "failedResults": job["failed"]}.get(kind)
+        if rows is None:
+            return jsonify([{"errorCode": "NOT_FOUND", "message": "job or result set not found"}]), 404
+        prefix = ["sf__Id", "sf__Created"] if kind == "successfulResults" else ["sf__Id", "sf__Error"]
+        columns = prefix + [c for c in (rows[0] if rows else {}) if c not in prefix]
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=columns, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    return Response(out.getvalue(), mimetype="text/csv")
+
+
+@stub.route("/services/data/<version>/queryAll", methods=["GET"])
+def query_all(version):
+    """Just enough SOQL for replica deltas: SELECT f, ... FROM o [WHERE LastModifiedDate >= t]"""
+    failure = simulate("query_all")
+    if failure:
+        return failure
+    match = SOQL.match(request.args.get("q", ""))
+    if not match:
+        return jsonify([{"errorCode": "MALFORMED_QUERY", "message": "unsupported query"}]), 400
+    fields = [f.strip() for f in match.group(1).split(",")]
+    since = match.group(2)
+    with lock:
+        rows = [
+            {f: (False if f == "IsDeleted" else record.get(f)) for f in fields}
+            for record in records.values()
+            if not since or record.get("LastModifiedDate", "")[:19] >= since[:19]
+        ]
+    rows.sort(key=lambda r: r.get("LastModifiedDate") or "")
+    return query_page(version, rows)
+
+
+@stub.route("/services/data/<version>/queryAll/<locator>", methods=["GET"])
+def query_more(version, locator):
+    failure = simulate("query_all")
+    if failure:
+        return failure
+    with lock:
+        rows = query_cursors.pop(locator, None)
+    if rows is None:
+        return jsonify([{"errorCode": "INVALID_QUERY_LOCATOR", "message": "invalid query locator"}]), 400
+    return query_page(version, rows)
+
+
+def query_page(version, rows):
+    page, rest = rows[:QUERY_PAGE_SIZE], rows[QUERY_PAGE_SIZE:]
+    body = {"totalSize": len(rows), "done": not rest, "records": page}
+    if rest:
+        locator = uuid.uuid4().hex
+        with lock:
+            query_cursors[locator] = rest
+        body["nextRecordsUrl"] = f"/services/data/{version}/queryAll/{locator}"
+    return jsonify(body)
+
+
+@stub.route("/services/apexrest/hubspotintegration/getsamplesfornoninternalbatches", methods=["GET"])
+def samples():
+    failure = simulate("samples")
+    if failure:
+        return failure
+    start = datetime.strptime(request.args["start"], "%Y-%m-%d")
+    end = datetime.strptime(request.args["end"], "%Y-%m-%d")
+    out = []
+    day = start
+    while day <= end:
+        for i in range(config["samples_per_day"]):
+            out.append({
+                "Sample_Id__c": f"S-{day:%Y%m%d}-{i:04d}",
+                "Batch__c": f"B-{day:%Y%m%d}-{i % 5}",
+                "Client__c": f"Client {i % 7}",
+                "Collected_Date__c": f"{day:%Y-%m-%d}",
+                "Amount__c": i * 1.5,
+            })
+        day += timedelta(days=1)
+    return jsonify(out)
+
+
+@stub.route("/_stub/stats", methods=["GET"])
+def stats():
+    with lock:
+        return jsonify({"calls": dict(calls), "records": len(records)})
+
+
+@stub.route("/_stub/reset", methods=["POST"])
+def reset():
+    with lock:
+        calls.clear()
+    return jsonify({"status": "ok"})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8801)
+    parser.add_argument("--records", type=int, default=1000, help="organization records to serve")
+    parser.add_argument("--samples-per-day", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0, help="base latency of every call")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="extra random latency, uniform")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of calls answered with 503")
+    parser.add_argument("--api-limit", type=int, default=1000000, help="daily API calls reported in Sforce-Limit-Info")
+    args = parser.parse_args(argv)
+
+    config.update(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        samples_per_day=args.samples_per_day,
+        api_limit=args.api_limit,
+    )
+    load_dataset(args.records)
+    stub.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
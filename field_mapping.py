@@ -0,0 +1,201 @@
+"""HubSpot -> Salesforce field mapping, loaded once and compiled.
+
+The mapping lives in field_mapping.json (or FIELD_MAPPING_FILE):
+
+    {"fields": {"City__c": {"sources": ["City__c", "city"], "type": "string"}, ...}}
+
+Each Salesforce field takes the first non-empty source value, coerced by its
+type (string, npi, phone, zip, email, country). `required` fields must be
+present and `max_length` caps strings. Phone numbers are sent as given;
+one that doesn't look like a phone number is logged, not rejected. ZIP
+codes are only checked (and normalised) for US addresses: those whose
+`country` field is empty or names the US. The spec is validated and
+compiled into a tuple of (field, sources, coerce) at import, so a transform
+is one pass over it.
+"""
+import json
+import os
+import re
+
+import app_logging
+
+FIELD_MAPPING_FILE = os.environ.get(
+    "FIELD_MAPPING_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "field_mapping.json")
+)
+
+_NON_DIGITS = re.compile(r"\D")
+_ZIP = re.compile(r"^(\d{5})-?(\d{4})?$")
+_EMAIL = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+US_COUNTRIES = {"us", "usa", "u.s.", "u.s.a.", "united states", "united states of america"}
+
+log = app_logging.get_logger("field_mapping")
+
+
+class Unrecognized(Exception):
+    """The value doesn't look like its type; it is kept as `value`"""
+
+    def __init__(self, message, value):
+        super().__init__(message)
+        self.value = value
+
+
+def _as_text(value):
+    if isinstance(value, bool):
+        raise ValueError("must be text, not a boolean")
+    if isinstance(value, (dict, list)):
+        raise ValueError("must be text, not an object or array")
+    return str(value).strip()
+
+
+def _string(value):
+    return _as_text(value)
+
+
+def _npi(value):
+    text = _as_text(value)
+    if len(text) != 10 or not text.isdigit():
+        raise ValueError("must be 10 digits")
+    return text
+
+
+def _phone(value):
+    text = _as_text(value)
+    digits = _NON_DIGITS.sub("", text)
+    if len(digits) == 10 or (len(digits) == 11 and digits.startswith("1")):
+        return text
+    if text.startswith("+") and 8 <= len(digits) <= 15:
+        return text
+    raise Unrecognized("is not a recognised phone number", text)
+
+
+def _zip(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        # A numeric ZIP loses its leading zeros in JSON
+        value = str(value).zfill(5)
+    match = _ZIP.match(_as_text(value))
+    if not match:
+        raise ValueError("must be a 5-digit or ZIP+4 code")
+    return f"{match.group(1)}-{match.group(2)}" if match.group(2) else match.group(1)
+
+
+def _email(value):
+    text = _as_text(value).lower()
+    if not _EMAIL.match(text):
+        raise ValueError("is not a valid email address")
+    return text
+
+
+TYPES = {
+    "string": _string,
+    "npi": _npi,
+    "phone": _phone,
+    "zip": _zip,
+    "email": _email,
+    "country": _string,
+}
+
+# Types only checked for US addresses; anywhere else the text is kept
+US_ONLY_TYPES = {"zip"}
+
+
+def _with_max_length(coerce, max_length):
+    def check(value):
+        if len(value) > max_length:
+            raise ValueError(f"is longer than {max_length} characters")
+        return value
+
+    def coerce_and_check(value):
+        try:
+            return check(coerce(value))
+        except Unrecognized as e:
+            check(e.value)
+            raise
+    return coerce_and_check
+
+
+class Mapping:
+    def __init__(self, fields, country_sources=()):
+        # ((field, label, sources, coerce, required, us_only), ...)
+        self.fields = tuple(fields)
+        self.country_sources = tuple(country_sources)
+
+    def in_us(self, payload):
+        """True unless the payload's country names somewhere other than the US"""
+        for source in self.country_sources:
+            value = payload.get(source)
+            if isinstance(value, str) and value.strip():
+                return value.strip().lower() in US_COUNTRIES
+        return True
+
+    def transform(self, payload):
+        """Map one payload; returns (record_data, errors)"""
+        record_data = {}
+        errors = []
+        in_us = None
+        for field, label, sources, coerce, required, us_only in self.fields:
+            for source in sources:
+                value = payload.get(source)
+                if value is not None and value != "":
+                    break
+            else:
+                if required:
+                    errors.append(f"{label} is required")
+                continue
+            if us_only:
+                if in_us is None:
+                    in_us = self.in_us(payload)
+                if not in_us:
+                    coerce = _string
+            try:
+                value = coerce(value)
+            except Unrecognized as e:
+                log.warning("field_mapping.unrecognized", field=field, problem=f"{label} {e}", value=e.value)
+                value = e.value
+            except ValueError as e:
+                errors.append(f"{label} {e}")
+                continue
+            if value != "":
+                record_data[field] = value
+            elif required:
+                errors.append(f"{label} is required")
+        return record_data, errors
+
+    def transform_many(self, payloads):
+        """Map a batch of events; non-object events get an error instead"""
+        transform = self.transform
+        return [
+            transform(payload) if isinstance(payload, dict) else ({}, ["Event must be a JSON object"])
+            for payload in payloads
+        ]
+
+
+def compile_mapping(spec):
+    """Validate a mapping spec and compile it; raises ValueError when invalid"""
+    fields = spec.get("fields") if isinstance(spec, dict) else None
+    if not isinstance(fields, dict) or not fields:
+        raise ValueError("field mapping needs a non-empty 'fields' object")
+    compiled = []
+    country_sources = []
+    for field, options in fields.items():
+        sources = options.get("sources") or [field]
+        if not isinstance(sources, list) or not all(isinstance(s, str) for s in sources):
+            raise ValueError(f"{field}: 'sources' must be a list of field names")
+        type_name = options.get("type", "string")
+        if type_name not in TYPES:
+            raise ValueError(f"{field}: unknown type {type_name!r}")
+        coerce = TYPES[type_name]
+        if options.get("max_length") is not None:
+            coerce = _with_max_length(coerce, int(options["max_length"]))
+        if type_name == "country":
+            country_sources.extend(sources)
+        compiled.append((field, options.get("label", field), tuple(sources), coerce, bool(options.get("required")),
+                         type_name in US_ONLY_TYPES))
+    return Mapping(compiled, country_sources)
+
+
+def load(path=FIELD_MAPPING_FILE):
+    with open(path) as f:
+        return compile_mapping(json.load(f))
+
+
+mapping = load()
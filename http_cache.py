@@ -0,0 +1,149 @@
+"""Conditional GET and compression for JSON read endpoints.
+
+`json_response(payload)` serializes like jsonify (through json_codec), or
+`encoded_response(body)` takes JSON bytes that are already encoded; both tag
+the body with a strong ETag (content hash) and answers 304 when the client's If-None-Match
+already has it. Bodies of at least COMPRESS_MIN_BYTES are sent brotli- or
+gzip-encoded per Accept-Encoding; brotli needs the optional `brotli`
+package. Compressed bodies are kept in a byte-bounded LRU keyed by ETag, so
+a dashboard polling the same query pays for compression once.
+
+Each encoding is its own representation with its own ETag ("<hash>-gzip"),
+and all of them match the same content in If-None-Match (weak comparison).
+
+Every storage scope (tenant) has its own LRU of COMPRESSED_CACHE_BYTES and
+its own counters, so one org's large bodies can't evict another's.
+
+`prepare` does the work without Flask, for the ASGI entry point.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+
+import json_codec
+import storage
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))  # gzip 1-9
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 5))  # 0-11
+COMPRESSED_CACHE_BYTES = int(os.environ.get("COMPRESSED_CACHE_BYTES", 32 * 1024 * 1024))  # per tenant
+
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+class _Cache:
+    """Compressed bodies of one scope, keyed by (content_hash, encoding)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.counters = {"hits": 0, "misses": 0, "not_modified": 0, "evictions": 0}
+        self.lock = threading.Lock()
+
+
+_caches = {}  # storage scope -> _Cache
+_caches_lock = threading.Lock()
+
+
+def _scope_cache():
+    scope = storage.current_scope()
+    cache = _caches.get(scope)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.setdefault(scope, _Cache(COMPRESSED_CACHE_BYTES))
+    return cache
+
+
+def content_hash(body):
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def _compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+def compressed(body, digest, encoding):
+    """`body` compressed with `encoding`, from the scope's LRU when possible"""
+    cache = _scope_cache()
+    key = (digest, encoding)
+    with cache.lock:
+        data = cache.entries.get(key)
+        if data is not None:
+            cache.entries.move_to_end(key)
+            cache.counters["hits"] += 1
+            return data
+        cache.counters["misses"] += 1
+    data = _compress(body, encoding)
+    if len(data) > cache.max_bytes:
+        return data
+    with cache.lock:
+        if key not in cache.entries:
+            cache.entries[key] = data
+            cache.bytes += len(data)
+            while cache.bytes > cache.max_bytes:
+                _, evicted = cache.entries.popitem(last=False)
+                cache.bytes -= len(evicted)
+                cache.counters["evictions"] += 1
+    return data
+
+
+def negotiate(size, accept_encodings):
+    """Content-Encoding to use for a body of `size` bytes, or None"""
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    encoding = accept_encodings.best_match(ENCODINGS)
+    return encoding if encoding and accept_encodings[encoding] > 0 else None
+
+
+def json_response(payload, status=200):
+    """jsonify(payload) with ETag, If-None-Match and compression"""
+    return encoded_response(json_codec.dumps(payload), status)
+
+
+def encoded_response(body, status=200):
+    """json_response for a body that is already JSON bytes"""
+    status, headers, body = prepare(body, status, request.accept_encodings, request.if_none_match)
+    response = Response(body, status=status, mimetype="application/json" if body else None)
+    response.headers.extend(headers)
+    return response
+
+
+def prepare(body, status, accept_encodings, if_none_match):
+    """(status, headers, body) for JSON `body` given the request's parsed
+    Accept-Encoding and If-None-Match (werkzeug Accept and ETags)"""
+    digest = content_hash(body)
+    encoding = negotiate(len(body), accept_encodings) if status == 200 else None
+    etag = f"{digest}-{encoding}" if encoding else digest
+    headers = [("ETag", f'"{etag}"'), ("Vary", "Accept-Encoding"), ("Cache-Control", "no-cache")]
+
+    if status == 200 and any(if_none_match.contains_weak(tag)
+                             for tag in [digest] + [f"{digest}-{e}" for e in ENCODINGS]):
+        cache = _scope_cache()
+        with cache.lock:
+            cache.counters["not_modified"] += 1
+        return 304, headers, b""
+    if encoding:
+        body = compressed(body, digest, encoding)
+        headers.append(("Content-Encoding", encoding))
+    return status, headers, body
+
+
+def stats():
+    """The current scope's cache counters"""
+    cache = _scope_cache()
+    with cache.lock:
+        stats = dict(cache.counters)
+        stats.update(entries=len(cache.entries), bytes=cache.bytes, encodings=list(ENCODINGS))
+    return stats
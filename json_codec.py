@@ -0,0 +1,73 @@
+"""The one JSON codec for Salesforce bodies, the local stores and responses.
+
+Uses orjson when it is installed (optional, several times faster both
+ways) and the standard library otherwise. Everything works on bytes:
+upstream bodies are parsed straight from `response.content` without
+decoding them to str first, and encoded output is ready to write.
+
+Output is compact with sorted keys, like jsonify, so equal payloads encode
+to equal bytes (and ETags). `envelope` splices records that are already
+encoded, e.g. rows of the local replica, into a response without parsing
+them again.
+"""
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional: standard library json
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+_MISSING = object()
+
+
+def _default(value):
+    return str(value)
+
+
+def loads(data):
+    """Parse JSON from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """Compact, key-sorted JSON bytes; unknown types are written as str"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def parse_response(response):
+    """JSON body of a requests Response, parsed once from its raw bytes"""
+    parsed = getattr(response, "_parsed_json", _MISSING)
+    if parsed is _MISSING:
+        parsed = response._parsed_json = loads(response.content)
+    return parsed
+
+
+def envelope(fields, data_key, items):
+    """JSON object bytes of `fields` plus `data_key`: a list of already-encoded `items`"""
+    parts = []
+    for key in sorted([*fields, data_key]):
+        value = b"[" + b",".join(items) + b"]" if key == data_key else dumps(fields[key])
+        parts.append(dumps(key) + b":" + value)
+    return b"{" + b",".join(parts) + b"}"
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider (jsonify, request.get_json, |tojson) backed by this codec"""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj) + b"\n", mimetype=self.mimetype)
@@ -0,0 +1,58 @@
+"""Incremental parsing of large JSON array bodies."""
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def iter_json_array(chunks):
+    """Yield the items of a top-level JSON array from an iterable of byte chunks.
+
+    Only the item being parsed is held in memory, so a response can be
+    consumed with `response.iter_content()` without buffering the whole body.
+    """
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    buf = ""
+    pos = 0
+    started = False
+    chunks = iter(chunks)
+    exhausted = False
+
+    while True:
+        # Skip separators between items
+        while pos < len(buf) and buf[pos] in _WHITESPACE + ",":
+            if buf[pos] == "," and not started:
+                raise ValueError("Expected '[' at start of JSON array")
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Expected '[' at start of JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                end = None
+            # A value that ends exactly at the buffer edge may be a truncated
+            # number, so wait for more input unless the body is complete.
+            if end is not None and (end < len(buf) or exhausted):
+                yield item
+                pos = end
+                if pos > 65536:
+                    buf = buf[pos:]
+                    pos = 0
+                continue
+        if exhausted:
+            raise ValueError("Unexpected end of JSON array")
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            exhausted = True
+            buf += decode(b"", final=True)
+            continue
+        buf += decode(chunk)
@@ -0,0 +1,212 @@
+"""Persistent webhook log shared by every worker.
+
+Requests only put entries on an in-memory queue (the only copy a worker
+keeps in memory, at most LOG_QUEUE_MAX entries); a background thread writes
+them to SQLite in batches, each to the log of the tenant (storage scope)
+that wrote it. The table is indexed for the /logs filters
+(time, NPI, status, action) and trimmed to the newest LOG_RETENTION rows.
+"""
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import app_logging
+import json_codec
+import metrics
+import storage
+
+DB_NAME = "webhook_logs.db"
+LOG_RETENTION = int(os.environ.get("LOG_RETENTION", 100000))  # rows kept on disk
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", 0.5))  # seconds
+LOG_QUEUE_MAX = int(os.environ.get("LOG_QUEUE_MAX", 10000))  # entries waiting to be written
+LOG_BATCH_SIZE = 500
+SUMMARY_MESSAGE_CHARS = 300
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS webhook_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        npi TEXT,
+        status TEXT,
+        action TEXT,
+        entry TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_webhook_logs_ts ON webhook_logs(ts);
+    CREATE INDEX IF NOT EXISTS idx_webhook_logs_npi ON webhook_logs(npi, ts);
+    CREATE INDEX IF NOT EXISTS idx_webhook_logs_status ON webhook_logs(status, ts);
+    CREATE INDEX IF NOT EXISTS idx_webhook_logs_action ON webhook_logs(action, ts);
+"""
+
+_pending = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+log = app_logging.get_logger("log_store")
+dropped_entries = metrics.Counter(
+    "mercybio_log_store_dropped_total", "Webhook log entries dropped because the write queue was full")
+
+
+def _db():
+    return storage.connect(DB_NAME, SCHEMA)
+
+
+def entry_npi(entry):
+    for key in ("processed_data", "received_data"):
+        data = entry.get(key)
+        if isinstance(data, dict):
+            npi = data.get("NPI__c") or data.get("npi")
+            if npi:
+                return str(npi)
+    return None
+
+
+def write(entry):
+    """Queue an entry for the background writer; never blocks the caller"""
+    _ensure_writer()
+    try:
+        _pending.put_nowait((storage.current_scope(), time.time(), entry))
+    except queue.Full:
+        dropped_entries.inc()
+
+
+def _ensure_writer():
+    global _writer_pid, _pending
+    if _writer_pid == os.getpid():
+        return
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        if _writer_pid is not None:
+            # Forked child: the parent's queue and writer thread don't exist here
+            _pending = queue.Queue(maxsize=LOG_QUEUE_MAX)
+        _writer_pid = os.getpid()
+        threading.Thread(target=_writer_loop, name="log-writer", daemon=True).start()
+
+
+def _writer_loop():
+    while True:
+        batch = [_pending.get()]
+        deadline = time.time() + LOG_FLUSH_INTERVAL
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(_pending.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        by_scope = {}
+        for scope, ts, entry in batch:
+            by_scope.setdefault(scope, []).append((ts, entry))
+        for scope, entries in by_scope.items():
+            try:
+                with storage.scoped(scope):
+                    _write_batch(entries)
+            except Exception as e:
+                log.error("log_store.write_failed", exc_info=e, scope=scope, entries=len(entries))
+
+
+def _write_batch(batch):
+    rows = [
+        (ts, entry_npi(entry), entry.get("status"), entry.get("action"), json_codec.dumps(entry).decode())
+        for ts, entry in batch
+    ]
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT INTO webhook_logs (ts, npi, status, action, entry) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.execute(
+            "DELETE FROM webhook_logs WHERE id <= (SELECT MAX(id) FROM webhook_logs) - ?",
+            (LOG_RETENTION,),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def parse_time(value):
+    """Epoch seconds for 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' (local time)"""
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid time '{value}'. Use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+
+
+def _where(npi=None, status=None, action=None, since=None, until=None):
+    where, params = [], []
+    for column, value in (("npi", npi), ("status", status), ("action", action)):
+        if value is not None:
+            where.append(f"{column} = ?")
+            params.append(value)
+    if since is not None:
+        where.append("ts >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("ts < ?")
+        params.append(until)
+    return where, params
+
+
+# Summary rows leave the payloads in SQLite; the message is cut short
+SUMMARY_COLUMNS = (
+    "id, npi, status, action, json_extract(entry, '$.timestamp') AS timestamp, "
+    f"substr(json_extract(entry, '$.message'), 1, {SUMMARY_MESSAGE_CHARS}) AS message"
+)
+
+
+def _summary(row):
+    return {key: row[key] for key in ("id", "timestamp", "npi", "status", "action", "message")}
+
+
+def query(npi=None, status=None, action=None, since=None, until=None, limit=50, offset=0, summary=False):
+    """Newest-first log entries matching every given filter.
+
+    Returns (entries, has_more). `since`/`until` are epoch seconds. With
+    `summary`, entries carry only id, timestamp, NPI, status, action and a
+    shortened message; get() loads the full entry.
+    """
+    where, params = _where(npi, status, action, since, until)
+    sql = f"SELECT {SUMMARY_COLUMNS if summary else 'id, entry'} FROM webhook_logs"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?"
+    rows = _db().execute(sql, params + [limit + 1, offset]).fetchall()
+    entries = []
+    for row in rows[:limit]:
+        if summary:
+            entries.append(_summary(row))
+            continue
+        entry = json_codec.loads(row["entry"])
+        entry["id"] = row["id"]
+        entries.append(entry)
+    return entries, len(rows) > limit
+
+
+def get(entry_id):
+    """One full log entry by id, or None"""
+    row = _db().execute("SELECT id, entry FROM webhook_logs WHERE id = ?", (entry_id,)).fetchone()
+    if row is None:
+        return None
+    entry = json_codec.loads(row["entry"])
+    entry["id"] = row["id"]
+    return entry
+
+
+def latest_id():
+    return _db().execute("SELECT COALESCE(MAX(id), 0) FROM webhook_logs").fetchone()[0]
+
+
+def summaries_after(after_id, npi=None, status=None, action=None, limit=100):
+    """Oldest-first summaries of entries written after `after_id`, for live tails"""
+    where, params = _where(npi, status, action)
+    where.insert(0, "id > ?")
+    params.insert(0, after_id)
+    rows = _db().execute(
+        f"SELECT {SUMMARY_COLUMNS} FROM webhook_logs WHERE {' AND '.join(where)} ORDER BY id LIMIT ?",
+        params + [limit],
+    ).fetchall()
+    return [_summary(row) for row in rows]
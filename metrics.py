@@ -0,0 +1,374 @@
+"""Request/stage latency metrics in Prometheus text format.
+
+Each worker keeps its own counters and periodically writes a snapshot to
+STATE_DIR/metrics/<pid>.json; /metrics merges the snapshots of every live
+worker, so a scrape through the load balancer sees the whole host. When a
+worker is gone its last counter and histogram values are folded into
+retired.json before its snapshot is dropped, so host-wide counters never go
+backwards when gunicorn recycles a worker; its gauges are dropped with it.
+
+Handlers time their work with `stage("auth")` etc. inside a request
+`trace`; requests slower than SLOW_REQUEST_MS are logged with their stage
+breakdown and kept for /metrics/slow.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import app_logging
+import storage
+
+METRICS_DIR = os.path.join(storage.STATE_DIR, "metrics")
+RETIRED_FILE = "retired.json"  # in METRICS_DIR: totals of workers that are gone
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))  # seconds
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 2000))  # 0 disables slow tracing
+SLOW_REQUEST_KEEP = 50
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+log = app_logging.get_logger("metrics")
+_registry = []
+_collectors = []
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [count per bucket..., +Inf count, sum]
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            else:
+                data[len(self.buckets)] += 1
+            data[-1] += value
+
+
+request_seconds = Histogram(
+    "mercybio_request_duration_seconds", "Request latency by route, HTTP status and webhook action",
+    ("route", "status", "action"),
+)
+stage_seconds = Histogram(
+    "mercybio_stage_duration_seconds", "Latency of each request stage by upstream Salesforce status",
+    ("route", "stage", "upstream_status"),
+)
+in_flight = Gauge("mercybio_requests_in_flight", "Requests currently being handled", ("route",))
+slow_requests = Counter("mercybio_slow_requests_total", "Requests slower than SLOW_REQUEST_MS", ("route",))
+
+# Per thread under WSGI, per task under asyncio (asgi.py)
+_trace = ContextVar("metrics_trace", default=None)
+_stage = ContextVar("metrics_stage", default=None)
+slow_traces = deque(maxlen=SLOW_REQUEST_KEEP)
+
+
+class Trace:
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.stages = []
+        self.status = ""
+        self.action = ""
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.upstream_status = ""
+
+
+def begin(route):
+    """Start timing a request (or background job) on this thread"""
+    _trace.set(Trace(route))
+    in_flight.inc(route=route)
+
+
+def annotate(status=None, action=None):
+    trace = _trace.get()
+    if trace is None:
+        return
+    if status is not None:
+        trace.status = str(status)
+    if action is not None:
+        trace.action = action
+
+
+def end():
+    trace = _trace.get()
+    if trace is None:
+        return
+    _trace.set(None)
+    elapsed = time.perf_counter() - trace.started
+    in_flight.dec(route=trace.route)
+    request_seconds.observe(elapsed, route=trace.route, status=trace.status, action=trace.action)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        slow_requests.inc(route=trace.route)
+        record = {
+            "route": trace.route,
+            "status": trace.status,
+            "action": trace.action,
+            "duration_ms": round(elapsed * 1000, 1),
+            "stages": trace.stages,
+            "at": time.time(),
+        }
+        slow_traces.appendleft(record)
+        log.warning("request.slow", **record)
+
+
+@contextmanager
+def trace(route):
+    begin(route)
+    try:
+        yield
+    finally:
+        end()
+
+
+@contextmanager
+def stage(name):
+    """Time one stage of the current request"""
+    current = _Stage(name)
+    token = _stage.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        elapsed = time.perf_counter() - started
+        _stage.reset(token)
+        trace = _trace.get()
+        route = trace.route if trace else ""
+        stage_seconds.observe(elapsed, route=route, stage=name, upstream_status=current.upstream_status)
+        if trace is not None:
+            trace.stages.append({
+                "stage": name,
+                "ms": round(elapsed * 1000, 1),
+                "upstream_status": current.upstream_status,
+            })
+
+
+def note_upstream_status(status_code):
+    """Called by the HTTP layer; labels the enclosing stage with the last status"""
+    current = _stage.get()
+    if current is not None:
+        current.upstream_status = str(status_code)
+
+
+def register_collector(fn):
+    """`fn()` returns extra exposition lines computed at scrape time (host-wide gauges)"""
+    _collectors.append(fn)
+
+
+def _snapshot():
+    return {m.name: m.snapshot() for m in _registry}
+
+
+def write_snapshot():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write_json(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), _snapshot())
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _retire(paths):
+    """Fold the counters and histograms of dead workers' snapshots into the
+    retired totals, then remove the snapshots. Serialised across workers so
+    a snapshot is never counted twice."""
+    cumulative = {m.name for m in _registry if m.kind in ("counter", "histogram")}
+    retired_path = os.path.join(METRICS_DIR, RETIRED_FILE)
+    with open(retired_path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            snapshots = [_read_json(retired_path) or {}]
+            for path in paths:
+                if not os.path.exists(path):
+                    continue  # retired by another worker meanwhile
+                snapshot = _read_json(path) or {}
+                snapshots.append({name: series for name, series in snapshot.items() if name in cumulative})
+            retired = _merge(snapshots)
+            _write_json(retired_path, {name: [[list(key), value] for key, value in series.items()]
+                                       for name, series in retired.items()})
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_snapshots():
+    write_snapshot()
+    cutoff = time.time() - max(METRICS_FLUSH_INTERVAL * 3, 30)
+    snapshots = []
+    dead = []
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith(".json") or filename == RETIRED_FILE:
+            continue
+        path = os.path.join(METRICS_DIR, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                # Worker is gone, or stuck: a live one would be counted twice
+                if not _alive(filename[:-len(".json")]):
+                    dead.append(path)
+                continue
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    if dead:
+        _retire(dead)
+    retired = _read_json(os.path.join(METRICS_DIR, RETIRED_FILE))
+    if retired:
+        snapshots.append(retired)
+    return snapshots
+
+
+def _merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, series in snapshot.items():
+            target = merged.setdefault(name, {})
+            for key, value in series:
+                key = tuple(key)
+                if isinstance(value, list):
+                    current = target.get(key) or [0] * len(value)
+                    target[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target[key] = target.get(key, 0) + value
+    return merged
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """Prometheus text exposition of every worker's metrics plus collectors"""
+    merged = _merge(_read_snapshots())
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in sorted(merged.get(metric.name, {}).items()):
+            if metric.kind == "histogram":
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f"{metric.name}_bucket{_labels(metric.labelnames, key, le)} {cumulative}")
+                lines.append(f"{metric.name}_sum{_labels(metric.labelnames, key)} {value[-1]}")
+                lines.append(f"{metric.name}_count{_labels(metric.labelnames, key)} {cumulative}")
+            else:
+                suffix = "_total" if metric.kind == "counter" and not metric.name.endswith("_total") else ""
+                lines.append(f"{metric.name}{suffix}{_labels(metric.labelnames, key)} {value}")
+    for collector in _collectors:
+        try:
+            lines.extend(collector())
+        except Exception as e:
+            log.warning("metrics.collector_failed", error=str(e))
+    return "\n".join(lines) + "\n"
+
+
+_flusher_pid = None
+
+
+def start_flusher():
+    """Write this worker's snapshot every METRICS_FLUSH_INTERVAL seconds"""
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+
+    def loop():
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                write_snapshot()
+            except OSError as e:
+                log.warning("metrics.snapshot_failed", error=str(e))
+
+    threading.Thread(target=loop, name="metrics-flusher", daemon=True).start()
@@ -0,0 +1,146 @@
+"""Persistent NPI -> Salesforce record Id index shared by every worker.
+
+Entries are learnt from create/update responses and from full /api/all
+loads, expire after NPI_INDEX_TTL, and the least recently used ones are
+evicted once the index grows past NPI_INDEX_MAX_ENTRIES. A row without a
+record Id is a create claim: the worker holding it is creating the record,
+and everyone else waits for the Id instead of creating a duplicate.
+"""
+import os
+import time
+
+import sf_limits
+import storage
+
+DB_NAME = "npi_index.db"
+NPI_INDEX_TTL = float(os.environ.get("NPI_INDEX_TTL", 7 * 24 * 3600))  # seconds
+NPI_INDEX_MAX_ENTRIES = int(os.environ.get("NPI_INDEX_MAX_ENTRIES", 200000))
+NPI_CREATE_CLAIM_TTL = float(os.environ.get("NPI_CREATE_CLAIM_TTL", 30))  # seconds
+TOUCH_INTERVAL = 60  # don't rewrite last_used more often than this
+EVICT_EVERY = 500  # stores between eviction passes
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS npi_index (
+        npi TEXT PRIMARY KEY,
+        record_id TEXT,
+        updated_at REAL NOT NULL,
+        last_used REAL NOT NULL,
+        claim_until REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_npi_index_last_used ON npi_index(last_used);
+"""
+
+
+class CreatePending(sf_limits.Overloaded):
+    """Someone else still holds the create claim on the NPI; retry after `retry_after` seconds"""
+
+_stores = 0
+
+
+def _db():
+    return storage.connect(DB_NAME, SCHEMA)
+
+
+def lookup(npi):
+    """Cached record Id for `npi`, or None"""
+    now = time.time()
+    conn = _db()
+    row = conn.execute(
+        "SELECT record_id FROM npi_index WHERE npi = ? AND record_id IS NOT NULL AND updated_at > ?",
+        (npi, now - NPI_INDEX_TTL),
+    ).fetchone()
+    if row is None:
+        return None
+    conn.execute(
+        "UPDATE npi_index SET last_used = ? WHERE npi = ? AND last_used < ?",
+        (now, npi, now - TOUCH_INTERVAL),
+    )
+    return row["record_id"]
+
+
+def store(npi, record_id):
+    store_many([(npi, record_id)])
+
+
+def store_many(pairs):
+    """Record (npi, record_id) pairs, replacing any claim or stale entry"""
+    global _stores
+    now = time.time()
+    rows = [(str(npi), record_id, now, now) for npi, record_id in pairs if npi and record_id]
+    if not rows:
+        return
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT INTO npi_index (npi, record_id, updated_at, last_used, claim_until) VALUES (?, ?, ?, ?, NULL) "
+            "ON CONFLICT(npi) DO UPDATE SET record_id = excluded.record_id, updated_at = excluded.updated_at, "
+            "last_used = excluded.last_used, claim_until = NULL",
+            rows,
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    _stores += len(rows)
+    if _stores >= EVICT_EVERY:
+        _stores = 0
+        evict()
+
+
+def invalidate(npi):
+    _db().execute("DELETE FROM npi_index WHERE npi = ?", (npi,))
+
+
+def evict():
+    """Drop expired entries and the least recently used ones over the limit"""
+    conn = _db()
+    conn.execute(
+        "DELETE FROM npi_index WHERE record_id IS NOT NULL AND updated_at <= ?",
+        (time.time() - NPI_INDEX_TTL,),
+    )
+    conn.execute(
+        "DELETE FROM npi_index WHERE npi IN ("
+        "SELECT npi FROM npi_index ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+        (NPI_INDEX_MAX_ENTRIES,),
+    )
+
+
+def claim_create(npi):
+    """Try to become the only worker creating `npi`; True if the claim is ours"""
+    now = time.time()
+    cursor = _db().execute(
+        "INSERT INTO npi_index (npi, record_id, updated_at, last_used, claim_until) VALUES (?, NULL, ?, ?, ?) "
+        "ON CONFLICT(npi) DO UPDATE SET updated_at = excluded.updated_at, claim_until = excluded.claim_until "
+        "WHERE npi_index.record_id IS NULL AND npi_index.claim_until <= ?",
+        (npi, now, now, now + NPI_CREATE_CLAIM_TTL, now),
+    )
+    return cursor.rowcount == 1
+
+
+def release_claim(npi):
+    """Give up a create claim without recording an Id"""
+    _db().execute("DELETE FROM npi_index WHERE npi = ? AND record_id IS NULL", (npi,))
+
+
+def wait_for_create(npi, poll_interval=0.1, timeout=None):
+    """Wait for whoever holds the create claim on `npi`; returns its record Id.
+
+    Returns None if the claim was released or expired without an Id, or
+    once `timeout` seconds (e.g. what is left of the request deadline) have
+    passed.
+    """
+    give_up = None if timeout is None else time.monotonic() + timeout
+    while True:
+        row = _db().execute(
+            "SELECT record_id, claim_until FROM npi_index WHERE npi = ?", (npi,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row["record_id"]:
+            return row["record_id"]
+        if row["claim_until"] is None or row["claim_until"] <= time.time():
+            return None
+        if give_up is not None and time.monotonic() + poll_interval > give_up:
+            return None
+        time.sleep(poll_interval)
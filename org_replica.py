@@ -0,0 +1,419 @@
+"""Local SQLite replica of the MercyHealthOrgAPI records.
+
+Off unless REPLICA_SYNC_INTERVAL is set. A background thread then keeps
+org_replica.db (one per tenant, in its storage scope) in step with
+Salesforce: a full load first (and every REPLICA_FULL_INTERVAL to catch
+anything the deltas missed), then every REPLICA_SYNC_INTERVAL only the
+records modified since the newest LastModifiedDate seen, deletions
+included. Deltas need a `fetch_changes` source (a SOQL queryAll, which
+needs SF_ORG_SOBJECT); without one the replica is only reloaded every
+REPLICA_FULL_INTERVAL, and is only used for that long if
+REPLICA_MAX_STALENESS allows it.
+
+Readers only use the replica while it is fresh, i.e. synced within
+REPLICA_MAX_STALENESS. Every worker runs the thread, but an flock makes
+sure only one of them syncs at a time and the shared sync stamps make the
+others skip work that was just done.
+
+Loads are written in short transactions of REPLICA_WRITE_BATCH rows, so
+the download never holds the write lock: a full load writes its records
+under a new generation and drops the previous one in a last, short
+transaction. Until then readers see every record once, old or reloaded.
+
+Records are stored whole, exactly as the Apex API returns them, as
+json_codec output, so readers can send them on as they are (`raw=True`)
+instead of parsing and encoding them again. A delta (SOQL) only carries
+some fields: they are applied onto the stored record. A change that can't
+be (a new record, or a value for a field the stored record doesn't have) is
+replaced by the whole record from `fetch_record` when there is one;
+otherwise the row is kept as it is and marked partial until the next full
+load, and is_complete() is False meanwhile.
+"""
+import fcntl
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import app_logging
+import json_codec
+import sf_limits
+import storage
+
+DB_NAME = "org_replica.db"
+REPLICA_SYNC_INTERVAL = float(os.environ.get("REPLICA_SYNC_INTERVAL", 0))  # seconds, 0 = off
+REPLICA_FULL_INTERVAL = float(os.environ.get("REPLICA_FULL_INTERVAL", 24 * 3600))  # seconds
+REPLICA_MAX_STALENESS = float(os.environ.get("REPLICA_MAX_STALENESS", 300))  # seconds
+REPLICA_WRITE_BATCH = 1000  # rows per write transaction during a load
+REPLICA_CLOCK_SKEW = 300  # seconds re-read by the first delta when records carry no LastModifiedDate
+RECORD_FORMAT = "apex"  # replicas loaded before records were stored whole are reloaded
+DELTA_ONLY_FIELDS = ("Id", "LastModifiedDate", "IsDeleted", "attributes")  # never decide a merge
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS org_records (
+        id TEXT PRIMARY KEY,
+        npi TEXT,
+        name TEXT COLLATE NOCASE,
+        city TEXT COLLATE NOCASE,
+        state TEXT COLLATE NOCASE,
+        last_modified TEXT,
+        generation INTEGER NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_org_records_npi ON org_records(npi);
+    CREATE INDEX IF NOT EXISTS idx_org_records_state_city ON org_records(state, city);
+    CREATE INDEX IF NOT EXISTS idx_org_records_city ON org_records(city);
+    CREATE INDEX IF NOT EXISTS idx_org_records_name ON org_records(name);
+    CREATE TABLE IF NOT EXISTS partial_records (
+        id TEXT PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS replica_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+
+log = app_logging.get_logger("org_replica")
+
+
+def _db():
+    return storage.connect(DB_NAME, SCHEMA)
+
+
+def _meta():
+    return {row["key"]: row["value"] for row in _db().execute("SELECT key, value FROM replica_meta")}
+
+
+def _set_meta(conn, **values):
+    conn.executemany(
+        "INSERT OR REPLACE INTO replica_meta (key, value) VALUES (?, ?)",
+        [(k, None if v is None else str(v)) for k, v in values.items()],
+    )
+
+
+def _row(record, generation, last_modified=None):
+    return (
+        record.get("Id"),
+        record.get("NPI__c"),
+        record.get("Healthcare_Organization_Name__c"),
+        record.get("City__c"),
+        record.get("State__c"),
+        last_modified or record.get("LastModifiedDate"),
+        generation,
+        json_codec.dumps(record).decode(),
+    )
+
+
+def _upsert(conn, rows):
+    conn.executemany(
+        "INSERT OR REPLACE INTO org_records (id, npi, name, city, state, last_modified, generation, data) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+
+
+def synced_at():
+    """Unix time of the last successful sync, or None"""
+    value = _meta().get("synced_at")
+    return float(value) if value else None
+
+
+def is_fresh(max_staleness=REPLICA_MAX_STALENESS):
+    if not REPLICA_SYNC_INTERVAL:
+        return False
+    stamp = synced_at()
+    return stamp is not None and time.time() - stamp <= max_staleness
+
+
+def is_complete():
+    """True when every record is stored whole, so the replica can stand in
+    for the Apex API's record list"""
+    if _meta().get("record_format") != RECORD_FORMAT:
+        return False
+    return _db().execute("SELECT 1 FROM partial_records LIMIT 1").fetchone() is None
+
+
+def _batches(records, strip_attributes=False):
+    """Lists of up to REPLICA_WRITE_BATCH records (dicts with an Id)"""
+    batch = []
+    for record in records:
+        if not isinstance(record, dict) or not record.get("Id"):
+            continue
+        if strip_attributes:
+            record = {k: v for k, v in record.items() if k != "attributes"}
+        batch.append(record)
+        if len(batch) >= REPLICA_WRITE_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _write(conn, statements):
+    """Run `statements` (callables taking the connection) in one short transaction"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for statement in statements:
+            statement(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _newer(high_water, records):
+    for record in records:
+        modified = record.get("LastModifiedDate")
+        if modified and (high_water is None or modified > high_water):
+            high_water = modified
+    return high_water
+
+
+def _iso(stamp):
+    return datetime.fromtimestamp(stamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def full_load(records):
+    """Replace the replica with `records` (an iterable, consumed in batches)"""
+    conn = _db()
+    started = time.time()
+    meta = _meta()
+    # Past any generation a failed load left rows under
+    generation = max(int(meta.get("generation") or 0), int(meta.get("loading_generation") or 0)) + 1
+    _write(conn, [lambda c: _set_meta(c, loading_generation=generation)])
+    high_water = None
+    count = 0
+    for batch in _batches(records):
+        rows = [_row(record, generation) for record in batch]
+        _write(conn, [lambda c: _upsert(c, rows)])
+        high_water = _newer(high_water, batch)
+        count += len(batch)
+    # Without LastModifiedDate, deltas start from when this load began
+    high_water = high_water or _iso(started - REPLICA_CLOCK_SKEW)
+    now = time.time()
+    _write(conn, [
+        # Anything not in this load is gone from Salesforce
+        lambda c: c.execute("DELETE FROM org_records WHERE generation < ?", (generation,)),
+        lambda c: c.execute("DELETE FROM partial_records"),
+        lambda c: _set_meta(c, generation=generation, high_water=high_water, synced_at=now, full_load_at=now,
+                            record_format=RECORD_FORMAT),
+    ])
+    return count
+
+
+def _merge(stored, change):
+    """`stored` updated with the fields of `change`, or None when it can't be"""
+    if stored is None:
+        return None
+    merged = dict(stored)
+    for key, value in change.items():
+        if key in merged:
+            merged[key] = value
+        elif key not in DELTA_ONLY_FIELDS and value is not None:
+            return None
+    return merged
+
+
+def _stored(conn, ids):
+    rows = conn.execute(
+        f"SELECT id, data FROM org_records WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall()
+    return {row["id"]: json_codec.loads(row["data"]) for row in rows}
+
+
+def apply_changes(records, fetch_record=None):
+    """Apply changed records onto the stored ones and drop deleted ones (IsDeleted = true).
+
+    `fetch_record(change)` returns the whole record for a change that can't
+    be merged, or None (the row is then marked partial).
+    """
+    conn = _db()
+    meta = _meta()
+    generation = int(meta.get("generation") or 0)
+    high_water = meta.get("high_water")
+    changed = deleted = 0
+    for batch in _batches(records, strip_attributes=True):
+        stored = _stored(conn, [record["Id"] for record in batch])
+        gone, rows, whole, partial = [], [], [], []
+        for record in batch:
+            if record.pop("IsDeleted", False):
+                gone.append((record["Id"],))
+                continue
+            merged = _merge(stored.get(record["Id"]), record)
+            if merged is None and fetch_record is not None:
+                merged = fetch_record(record)
+            if merged is None:
+                merged = dict(stored.get(record["Id"]) or {}, **record)
+                partial.append((record["Id"],))
+            else:
+                whole.append((record["Id"],))
+            rows.append(_row(merged, generation, record.get("LastModifiedDate")))
+        _write(conn, [
+            lambda c: c.executemany("DELETE FROM org_records WHERE id = ?", gone),
+            lambda c: _upsert(c, rows),
+            lambda c: c.executemany("DELETE FROM partial_records WHERE id = ?", gone + whole),
+            lambda c: c.executemany("INSERT OR IGNORE INTO partial_records (id) VALUES (?)", partial),
+        ])
+        high_water = _newer(high_water, batch)
+        changed += len(rows)
+        deleted += len(gone)
+    # The high-water mark only moves once every change up to it is stored
+    _write(conn, [lambda c: _set_meta(c, high_water=high_water, synced_at=time.time())])
+    return changed, deleted
+
+
+def _due(meta, fetch_changes, force_full, now):
+    """"full", "delta" or None when nothing is due"""
+    full_load_at = float(meta.get("full_load_at") or 0)
+    if (force_full or not meta.get("high_water") or meta.get("record_format") != RECORD_FORMAT
+            or now - full_load_at >= REPLICA_FULL_INTERVAL):
+        return "full"
+    return "delta" if fetch_changes is not None else None
+
+
+def sync(fetch_all, fetch_changes=None, force_full=False, fetch_record=None):
+    """Full load or delta, whichever is due; returns a summary dict, or None
+    when nothing is due (no deltas and the next full load isn't either)"""
+    meta = _meta()
+    started = time.time()
+    mode = _due(meta, fetch_changes, force_full, started)
+    if mode is None:
+        return None
+    if mode == "full":
+        records = fetch_all()
+        if records is False:
+            raise RuntimeError("Full load from Salesforce failed")
+        summary = {"mode": "full", "records": full_load(records)}
+    else:
+        changed, deleted = apply_changes(fetch_changes(meta["high_water"]), fetch_record)
+        summary = {"mode": "delta", "changed": changed, "deleted": deleted}
+    summary["seconds"] = round(time.time() - started, 3)
+    return summary
+
+
+def lookup_npi(npi):
+    """Record Id for `npi` from a fresh replica, or None"""
+    if not is_fresh():
+        return None
+    row = _db().execute("SELECT id FROM org_records WHERE npi = ? LIMIT 1", (str(npi),)).fetchone()
+    return row["id"] if row else None
+
+
+def invalidate(record_id):
+    """Drop a record Salesforce says no longer exists (until it changes or the next full load)"""
+    conn = _db()
+    conn.execute("DELETE FROM org_records WHERE id = ?", (record_id,))
+    conn.execute("DELETE FROM partial_records WHERE id = ?", (record_id,))
+
+
+def _decode(row, raw):
+    return row["data"].encode() if raw else json_codec.loads(row["data"])
+
+
+def iter_records(raw=False):
+    """Every replicated record in Id order; JSON bytes with `raw`"""
+    for row in _db().execute("SELECT data FROM org_records ORDER BY id"):
+        yield _decode(row, raw)
+
+
+def _prefix_bounds(prefix):
+    # "abc" -> ["abc", "abd"): a range scan the index can serve, unlike LIKE
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def search(state=None, city=None, name=None, npi_prefix=None, limit=50, offset=0, raw=False):
+    """Records matching every given filter, in Id order.
+
+    `state` and `city` match exactly, `name` and `npi_prefix` by prefix; all
+    but the NPI ignore case. Returns (records, has_more); records are JSON
+    bytes with `raw`.
+    """
+    clauses, params = [], []
+    if state:
+        clauses.append("state = ?")
+        params.append(state)
+    if city:
+        clauses.append("city = ?")
+        params.append(city)
+    if name:
+        clauses.append("name >= ? AND name < ?")
+        params.extend(_prefix_bounds(name.lower()))
+    if npi_prefix:
+        clauses.append("npi >= ? AND npi < ?")
+        params.extend(_prefix_bounds(npi_prefix))
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = _db().execute(
+        f"SELECT data FROM org_records {where} ORDER BY id LIMIT ? OFFSET ?",
+        params + [limit + 1, offset],
+    ).fetchall()
+    return [_decode(row, raw) for row in rows[:limit]], len(rows) > limit
+
+
+def stats():
+    meta = _meta()
+    count = _db().execute("SELECT COUNT(*) FROM org_records").fetchone()[0]
+
+    def iso(value):
+        return datetime.fromtimestamp(float(value), timezone.utc).isoformat() if value else None
+
+    return {
+        "enabled": bool(REPLICA_SYNC_INTERVAL),
+        "fresh": is_fresh(),
+        "complete": is_complete(),
+        "records": count,
+        "synced_at": iso(meta.get("synced_at")),
+        "full_load_at": iso(meta.get("full_load_at")),
+        "high_water": meta.get("high_water"),
+        "last_error": meta.get("last_error"),
+    }
+
+
+_sync_pids = {}  # storage scope -> pid running its sync loop
+
+
+def start(fetch_all, fetch_changes=None, fetch_record=None):
+    """Run the sync loop of the current storage scope in this process.
+
+    Once per scope and pid; no-op when disabled. The fetchers run in the
+    loop's thread, so they must not rely on the caller's context (bind them
+    to their tenant, see tenants.bind).
+    """
+    scope = storage.current_scope()
+    if not REPLICA_SYNC_INTERVAL or _sync_pids.get(scope) == os.getpid():
+        return
+    _sync_pids[scope] = os.getpid()
+    directory = storage.state_dir()
+    os.makedirs(directory, exist_ok=True)
+    lock_path = os.path.join(directory, "org_replica.lock")
+
+    def loop():
+        storage.set_scope(scope)
+        sf_limits.set_priority(sf_limits.LOW)
+        while True:
+            try:
+                with open(lock_path, "a") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        pass  # another worker is syncing
+                    else:
+                        stamp = synced_at()
+                        if stamp is None or time.time() - stamp >= REPLICA_SYNC_INTERVAL:
+                            run_sync(fetch_all, fetch_changes, fetch_record=fetch_record)
+            except Exception as e:
+                log.error("replica.sync_loop_failed", exc_info=e)
+            time.sleep(REPLICA_SYNC_INTERVAL)
+
+    threading.Thread(target=loop, name="org-replica-sync", daemon=True).start()
+
+
+def run_sync(fetch_all, fetch_changes=None, force_full=False, fetch_record=None):
+    try:
+        summary = sync(fetch_all, fetch_changes, force_full, fetch_record)
+    except Exception as e:
+        conn = _db()
+        _set_meta(conn, last_error=f"{datetime.now(timezone.utc).isoformat()} {e}")
+        log.warning("replica.sync_failed", error=str(e))
+        return None
+    if summary is not None:
+        log.info("replica.synced", **summary)
+    return summary
@@ -0,0 +1,310 @@
+"""Day-bucketed cache for /api/samples results, shared by every worker.
+
+A date range is split into one bucket per day. Days that were already over
+(in UTC) when they were fetched never change and are kept until
+SAMPLES_CACHE_MAX_AGE, or until the cache holds more than
+SAMPLES_CACHE_MAX_DAYS buckets; today's (or a future) bucket is refetched
+once it is older than SAMPLES_TODAY_TTL.
+
+Missing days are fetched as runs of consecutive days, one Salesforce query
+per run. Only a single-day query can be bucketed as it is; a longer run is
+cached whole, as one entry for exactly those days, unless SAMPLES_DAY_FIELD
+names the field holding each sample's date: then runs are at most
+SAMPLES_RANGE_DAYS long and split into day buckets by that field (a run
+whose samples can't all be placed is still cached whole). Runs are fetched
+in parallel, capped at SAMPLES_FETCH_CONCURRENCY Salesforce calls per
+process (get_range_async: by the caller's upstream limit).
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+import json_codec
+import storage
+
+DB_NAME = "samples_cache.db"
+SAMPLES_TODAY_TTL = float(os.environ.get("SAMPLES_TODAY_TTL", 60))  # seconds
+SAMPLES_FETCH_CONCURRENCY = int(os.environ.get("SAMPLES_FETCH_CONCURRENCY", 4))
+SAMPLES_DAY_FIELD = os.environ.get("SAMPLES_DAY_FIELD", "")  # date (or datetime) of a sample, "" = don't split
+SAMPLES_RANGE_DAYS = int(os.environ.get("SAMPLES_RANGE_DAYS", 31))  # days per query split by SAMPLES_DAY_FIELD
+SAMPLES_CACHE_MAX_AGE = float(os.environ.get("SAMPLES_CACHE_MAX_AGE", 30 * 24 * 3600))  # seconds since fetched
+SAMPLES_CACHE_MAX_DAYS = int(os.environ.get("SAMPLES_CACHE_MAX_DAYS", 5000))  # buckets kept
+SAMPLES_CACHE_MAX_RANGES = int(os.environ.get("SAMPLES_CACHE_MAX_RANGES", 500))  # unsplit runs kept
+EVICT_EVERY = 100  # stored entries between eviction passes
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS samples_cache (
+        day TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        fetched_at REAL NOT NULL,
+        final INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS samples_ranges (
+        first_day TEXT NOT NULL,
+        last_day TEXT NOT NULL,
+        data TEXT NOT NULL,
+        fetched_at REAL NOT NULL,
+        final INTEGER NOT NULL,
+        PRIMARY KEY (first_day, last_day)
+    );
+"""
+
+_fetch_slots = threading.BoundedSemaphore(SAMPLES_FETCH_CONCURRENCY)
+_stats = {"hits": 0, "misses": 0, "bypassed": 0, "fetch_errors": 0, "stale_hits": 0,
+          "range_queries": 0, "split_fallbacks": 0, "evicted": 0}
+_stats_lock = threading.Lock()
+_stores = 0
+
+
+def _db():
+    return storage.connect(DB_NAME, SCHEMA)
+
+
+def _count(name, n=1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def days_between(start_date, end_date):
+    """Every YYYY-MM-DD from start_date to end_date inclusive"""
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    return [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+
+def _cached(days, any_age=False):
+    rows = _db().execute(
+        f"SELECT day, data, fetched_at, final FROM samples_cache WHERE day IN ({','.join('?' * len(days))})",
+        days,
+    ).fetchall()
+    now = time.time()
+    return {
+        row["day"]: json_codec.loads(row["data"])
+        for row in rows
+        if any_age or row["final"] or row["fetched_at"] + SAMPLES_TODAY_TTL > now
+    }
+
+
+def _cached_ranges(pending, any_age=False):
+    """{(first_day, last_day): samples} of the runs in `pending` cached whole"""
+    conn = _db()
+    now = time.time()
+    found = {}
+    for run in pending:
+        row = conn.execute(
+            "SELECT data, fetched_at, final FROM samples_ranges WHERE first_day = ? AND last_day = ?",
+            (run[0], run[-1]),
+        ).fetchone()
+        if row is not None and (any_age or row["final"] or row["fetched_at"] + SAMPLES_TODAY_TTL > now):
+            found[(run[0], run[-1])] = json_codec.loads(row["data"])
+    return found
+
+
+def _today():
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def _store(fetched):
+    """Cache {day or (first_day, last_day): samples}; days before today (UTC) are final"""
+    global _stores
+    today = _today()
+    now = time.time()
+    days, ranges = [], []
+    for key, data in fetched.items():
+        encoded = json_codec.dumps(data).decode()
+        if isinstance(key, tuple):
+            ranges.append((*key, encoded, now, int(key[1] < today)))
+        else:
+            days.append((key, encoded, now, int(key < today)))
+    if not days and not ranges:
+        return
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO samples_cache (day, data, fetched_at, final) VALUES (?, ?, ?, ?)", days)
+        conn.executemany(
+            "INSERT OR REPLACE INTO samples_ranges (first_day, last_day, data, fetched_at, final) "
+            "VALUES (?, ?, ?, ?, ?)", ranges)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    _stores += len(days) + len(ranges)
+    if _stores >= EVICT_EVERY:
+        _stores = 0
+        evict()
+
+
+def evict():
+    """Drop entries fetched more than SAMPLES_CACHE_MAX_AGE ago and the oldest over
+    SAMPLES_CACHE_MAX_DAYS buckets (SAMPLES_CACHE_MAX_RANGES unsplit runs)"""
+    conn = _db()
+    expired = time.time() - SAMPLES_CACHE_MAX_AGE
+    evicted = conn.execute("DELETE FROM samples_cache WHERE fetched_at <= ?", (expired,)).rowcount
+    evicted += conn.execute(
+        "DELETE FROM samples_cache WHERE day IN ("
+        "SELECT day FROM samples_cache ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+        (SAMPLES_CACHE_MAX_DAYS,),
+    ).rowcount
+    evicted += conn.execute("DELETE FROM samples_ranges WHERE fetched_at <= ?", (expired,)).rowcount
+    evicted += conn.execute(
+        "DELETE FROM samples_ranges WHERE rowid IN ("
+        "SELECT rowid FROM samples_ranges ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+        (SAMPLES_CACHE_MAX_RANGES,),
+    ).rowcount
+    _count("evicted", evicted)
+
+
+def runs(days):
+    """`days` (in order) as runs of consecutive days; runs split by day are at
+    most SAMPLES_RANGE_DAYS long"""
+    result = []
+    previous = None
+    for day in days:
+        current = date.fromisoformat(day)
+        if (result and current - previous == timedelta(days=1)
+                and not (SAMPLES_DAY_FIELD and len(result[-1]) >= SAMPLES_RANGE_DAYS)):
+            result[-1].append(day)
+        else:
+            result.append([day])
+        previous = current
+    return result
+
+
+def split_by_day(samples, days):
+    """{day: samples} for `days`, or None when a sample can't be placed in one of them"""
+    buckets = {day: [] for day in days}
+    for sample in samples:
+        value = sample.get(SAMPLES_DAY_FIELD) if isinstance(sample, dict) else None
+        bucket = buckets.get(value[:10]) if isinstance(value, str) else None
+        if bucket is None:
+            return None
+        bucket.append(sample)
+    return buckets
+
+
+def _split(run, data):
+    """{day or (first_day, last_day): samples or False} from one query of `run`"""
+    if len(run) == 1:
+        return {run[0]: data if data is False else data or []}
+    _count("range_queries")
+    if data is not False and SAMPLES_DAY_FIELD:
+        buckets = split_by_day(data or [], run)
+        if buckets is not None:
+            return buckets
+        _count("split_fallbacks")
+    return {(run[0], run[-1]): data if data is False else data or []}
+
+
+def _fetch_run(fetch_range, run):
+    with _fetch_slots:
+        return _split(run, fetch_range(run[0], run[-1]))
+
+
+def _assemble(days, entries):
+    """Samples of `days` in date order from {day or (first_day, last_day): samples}"""
+    by_first_day = {key[0] if isinstance(key, tuple) else key: data for key, data in entries.items()}
+    merged = []
+    for day in days:
+        merged.extend(by_first_day.get(day) or [])
+    return merged
+
+
+def get_cached_range(start_date, end_date):
+    """Samples from the cache alone, expired entries included; None if a day is missing"""
+    days = days_between(start_date, end_date)
+    cached = _cached(days, any_age=True) if days else {}
+    pending = runs([day for day in days if day not in cached])
+    cached.update(_cached_ranges(pending, any_age=True))
+    if any((run[0], run[-1]) not in cached for run in pending):
+        return None
+    _count("stale_hits", len(days))
+    return _assemble(days, cached)
+
+
+def _lookup(days, refresh):
+    """(cached, runs to fetch) for `days`"""
+    if refresh:
+        _count("bypassed", len(days))
+        return {}, runs(days)
+    cached = _cached(days)
+    pending = runs([day for day in days if day not in cached])
+    cached.update(_cached_ranges([run for run in pending if len(run) > 1]))
+    pending = [run for run in pending if (run[0], run[-1]) not in cached]
+    missing = sum(len(run) for run in pending)
+    _count("hits", len(days) - missing)
+    _count("misses", missing)
+    return cached, pending
+
+
+def _merge(days, cached, fetched):
+    """Store what was fetched and merge the range; False if any run failed"""
+    _store({key: data for key, data in fetched.items() if data is not False})
+    if any(data is False for data in fetched.values()):
+        _count("fetch_errors")
+        return False
+    cached.update(fetched)
+    return _assemble(days, cached)
+
+
+def get_range(start_date, end_date, fetch_range, refresh=False):
+    """Samples from start_date to end_date (inclusive), in date order.
+
+    `fetch_range(first_day, last_day)` loads those days (inclusive) from
+    Salesforce and returns a list, or False on failure, in which case the
+    whole range returns False. With `refresh` every bucket is refetched and
+    the cache updated.
+    """
+    days = days_between(start_date, end_date)
+    if not days:
+        return []
+
+    cached, pending = _lookup(days, refresh)
+    fetched = {}
+    if pending:
+        workers = min(len(pending), SAMPLES_FETCH_CONCURRENCY)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for result in pool.map(lambda run: _fetch_run(fetch_range, run), pending):
+                fetched.update(result)
+    return _merge(days, cached, fetched)
+
+
+async def _gather(coroutines):
+    """asyncio.gather that cancels the rest as soon as one raises"""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        raise
+
+
+async def _fetch_run_async(fetch_range, run):
+    return _split(run, await fetch_range(run[0], run[-1]))
+
+
+async def get_range_async(start_date, end_date, fetch_range, refresh=False):
+    """get_range for a coroutine `fetch_range`; runs of missing days are fetched
+    concurrently (the caller bounds how many reach Salesforce at once). When
+    one fetch raises (e.g. sf_limits.Overloaded) the others are cancelled."""
+    days = days_between(start_date, end_date)
+    if not days:
+        return []
+
+    cached, pending = await asyncio.to_thread(_lookup, days, refresh)
+    fetched = {}
+    for result in await _gather(_fetch_run_async(fetch_range, run) for run in pending):
+        fetched.update(result)
+    return await asyncio.to_thread(_merge, days, cached, fetched)
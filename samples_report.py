@@ -0,0 +1,105 @@
+"""Projection, aggregation and streamed encodings for /api/samples.
+
+Samples come back from Salesforce as a list of flat dicts. These helpers
+turn them into what a report needs without building a second copy:
+`project` keeps only the requested fields, `aggregate` counts and sums per
+group in one pass, and `iter_ndjson`/`iter_csv` encode rows lazily for a
+streamed response.
+"""
+import csv
+import io
+from numbers import Number
+
+import json_codec
+
+CSV_FLUSH_ROWS = 500  # rows per streamed CSV chunk
+
+
+def parse_fields(value):
+    """'a, b,,c' -> ['a', 'b', 'c']; None/'' -> []"""
+    return [f.strip() for f in (value or "").split(",") if f.strip()]
+
+
+def project(rows, fields):
+    """Rows with only `fields` (missing ones as None); all fields when empty"""
+    if not fields:
+        yield from rows
+        return
+    for row in rows:
+        yield {field: row.get(field) for field in fields}
+
+
+def _is_number(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def aggregate(samples, group_by, sum_fields=None):
+    """Count samples (and sum numeric fields) per distinct `group_by` values.
+
+    Without `sum_fields`, every numeric field outside `group_by` is summed.
+    Returns rows like {"Batch__c": "B-1", "count": 3, "sum_Amount__c": 4.5},
+    sorted by group.
+    """
+    groups = {}
+    auto_sum = not sum_fields
+    sum_fields = list(sum_fields or [])
+    group_set = set(group_by)
+    for sample in samples:
+        key = tuple(sample.get(field) for field in group_by)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, {}]
+        group[0] += 1
+        sums = group[1]
+        if auto_sum:
+            for field, value in sample.items():
+                if field not in group_set and _is_number(value):
+                    sums[field] = sums.get(field, 0) + value
+                    if field not in sum_fields:
+                        sum_fields.append(field)
+        else:
+            for field in sum_fields:
+                value = sample.get(field)
+                if _is_number(value):
+                    sums[field] = sums.get(field, 0) + value
+
+    rows = []
+    for key in sorted(groups, key=lambda k: tuple("" if v is None else str(v) for v in k)):
+        count, sums = groups[key]
+        row = dict(zip(group_by, key))
+        row["count"] = count
+        for field in sum_fields:
+            row[f"sum_{field}"] = sums.get(field, 0)
+        rows.append(row)
+    return rows
+
+
+def iter_ndjson(rows):
+    for row in rows:
+        yield json_codec.dumps(row) + b"\n"
+
+
+def columns_of(rows):
+    """Every key of `rows`, in order of first appearance"""
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns.setdefault(key, None)
+    return list(columns)
+
+
+def iter_csv(rows, columns):
+    """CSV with a header row; nested values are written as JSON"""
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(columns)
+    for i, row in enumerate(rows, 1):
+        writer.writerow([
+            json_codec.dumps(v).decode() if isinstance(v, (dict, list)) else ("" if v is None else v)
+            for v in (row.get(c) for c in columns)
+        ])
+        if i % CSV_FLUSH_ROWS == 0:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
@@ -0,0 +1,154 @@
+"""Salesforce access-token cache shared by every thread and gunicorn worker.
+
+Tokens are kept in memory and mirrored to a small JSON file so that forked
+workers reuse the same token instead of each minting their own. Only one
+thread per process, and one process per host, refreshes at a time; everyone
+else waits for that refresh and picks up its result.
+
+build_jwt and load_private_key make the signed assertion of the OAuth JWT
+bearer flow that mints the tokens (see tenants.Tenant.request_access_token).
+"""
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+
+
+def build_jwt(client_id: str, username: str, private_key, domain: str = "test") -> str:
+    payload = {
+        "iss": client_id,
+        "sub": username,
+        "aud": f"https://{domain}.salesforce.com",
+        "exp": int(time.time()) + 300,
+    }
+    return jwt.encode(payload, private_key, algorithm="RS256")
+
+
+def load_private_key(pem):
+    """Parse a PEM private key (parse once, sign many JWTs with it)"""
+    return serialization.load_pem_private_key(pem.encode(), password=None)
+
+
+def default_cache_path(*parts):
+    """Per-credential cache file in the system temp dir"""
+    digest = hashlib.sha256("|".join(p or "" for p in parts).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"mercybio-sf-token-{digest}.json")
+
+
+class TokenManager:
+    """Caches (access_token, instance_url) until shortly before it expires.
+
+    `fetch` is called to mint a new token and must return the decoded OAuth
+    response (a dict with at least access_token and instance_url).
+    """
+
+    def __init__(self, fetch, cache_path=None, ttl=3600, refresh_margin=300):
+        self.fetch = fetch
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._lock = threading.Lock()
+
+    def get(self, stale_token=None):
+        """Return a valid (access_token, instance_url) pair.
+
+        Pass `stale_token` after Salesforce rejected it with a 401; the token is
+        only refreshed if nobody else has replaced it in the meantime.
+        """
+        token = self._token
+        if self._usable(token, stale_token):
+            return token["access_token"], token["instance_url"]
+
+        with self._lock:
+            token = self._token
+            if not self._usable(token, stale_token):
+                token = self._read_file()
+                if not self._usable(token, stale_token):
+                    token = self._refresh(stale_token)
+                self._token = token
+        return token["access_token"], token["instance_url"]
+
+    def peek(self, stale_token=None):
+        """The in-memory pair if it is still usable, else None; never blocks"""
+        token = self._token
+        if self._usable(token, stale_token):
+            return token["access_token"], token["instance_url"]
+        return None
+
+    def invalidate(self):
+        """Drop the cached token so the next get() mints a new one"""
+        with self._lock:
+            self._token = None
+            if self.cache_path:
+                try:
+                    os.remove(self.cache_path)
+                except FileNotFoundError:
+                    pass
+
+    def _usable(self, token, stale_token=None):
+        if not token:
+            return False
+        if stale_token and token["access_token"] == stale_token:
+            return False
+        return token["expires_at"] - self.refresh_margin > time.time()
+
+    def _refresh(self, stale_token):
+        if not self.cache_path:
+            return self._mint()
+
+        # Serialise refreshes across worker processes; whoever waited on the
+        # lock re-reads the file and reuses the token the winner just wrote.
+        with open(self.cache_path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                token = self._read_file()
+                if self._usable(token, stale_token):
+                    return token
+                token = self._mint()
+                self._write_file(token)
+                return token
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _mint(self):
+        data = self.fetch()
+        now = time.time()
+        ttl = int(data.get("expires_in") or self.ttl)
+        return {
+            "access_token": data["access_token"],
+            "instance_url": data["instance_url"],
+            "expires_at": now + ttl,
+        }
+
+    def _read_file(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                token = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not all(k in token for k in ("access_token", "instance_url", "expires_at")):
+            return None
+        return token
+
+    def _write_file(self, token):
+        directory = os.path.dirname(self.cache_path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".sf-token-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(token, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -0,0 +1,136 @@
+"""Circuit breakers for outbound Salesforce calls, one per upstream route.
+
+A breaker watches the outcomes of its route over the last
+SF_BREAKER_WINDOW seconds. Once at least SF_BREAKER_MIN_CALLS calls were
+made and SF_BREAKER_FAILURE_RATIO of them failed (5xx, 429, timeouts,
+connection errors), it opens: calls fail immediately with CircuitOpen for
+SF_BREAKER_COOLDOWN seconds, so a brownout costs nothing but the fallback.
+After that one probe call is let through (half-open); its success closes
+the breaker, its failure opens it for another cooldown.
+
+Callers use `is_open(route)` to switch to a fallback (cached data, the
+queue) before even trying.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+import sf_limits
+
+SF_BREAKER_WINDOW = float(os.environ.get("SF_BREAKER_WINDOW", 30))  # seconds of outcomes considered
+SF_BREAKER_MIN_CALLS = int(os.environ.get("SF_BREAKER_MIN_CALLS", 10))  # calls in the window before tripping
+SF_BREAKER_FAILURE_RATIO = float(os.environ.get("SF_BREAKER_FAILURE_RATIO", 0.5))
+SF_BREAKER_COOLDOWN = float(os.environ.get("SF_BREAKER_COOLDOWN", 15))  # seconds open before a probe
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+breakers_open = metrics.Gauge("mercybio_sf_breaker_open", "Open Salesforce circuit breakers (summed over workers)", ("route",))
+breaker_trips = metrics.Counter("mercybio_sf_breaker_trips_total", "Salesforce circuit breaker openings", ("route",))
+
+
+class CircuitOpen(sf_limits.Overloaded):
+    """The route's breaker is open; retry after `retry_after` seconds"""
+
+
+class CircuitBreaker:
+    def __init__(self, route, window=SF_BREAKER_WINDOW, min_calls=SF_BREAKER_MIN_CALLS,
+                 failure_ratio=SF_BREAKER_FAILURE_RATIO, cooldown=SF_BREAKER_COOLDOWN):
+        self.route = route
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._outcomes = deque()  # (monotonic time, ok)
+        self._failures = 0
+        self._open_until = 0.0
+        self._trips = 0
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """True while calls would be refused (doesn't use up the probe)"""
+        with self._lock:
+            return self.state != CLOSED and time.monotonic() < self._open_until
+
+    def check(self):
+        """Raise CircuitOpen unless a call may go out now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if now < self._open_until:
+                raise CircuitOpen(f"Salesforce {self.route} is failing; circuit open", self._open_until - now)
+            # Cooldown over: this call is the probe; the rest wait for its outcome
+            # (or another cooldown, should it never report back)
+            self._set_state(HALF_OPEN)
+            self._open_until = now + self.cooldown
+
+    def record(self, ok):
+        """Outcome of a call that reached Salesforce"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                if ok:
+                    self._set_state(CLOSED)
+                    self._outcomes.clear()
+                    self._failures = 0
+                else:
+                    self._trip(now)
+                return
+            if self.state == OPEN:
+                return
+            self._outcomes.append((now, ok))
+            if not ok:
+                self._failures += 1
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                if not self._outcomes.popleft()[1]:
+                    self._failures -= 1
+            if (len(self._outcomes) >= self.min_calls
+                    and self._failures >= self.failure_ratio * len(self._outcomes)):
+                self._trip(now)
+
+    def _trip(self, now):
+        self._set_state(OPEN)
+        self._open_until = now + self.cooldown
+        self._trips += 1
+        breaker_trips.inc(route=self.route)
+
+    def _set_state(self, state):
+        if (state == CLOSED) != (self.state == CLOSED):
+            breakers_open.inc(1 if state != CLOSED else -1, route=self.route)
+        self.state = state
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": len(self._outcomes),
+                "failures": self._failures,
+                "trips": self._trips,
+                "open_for_s": round(max(0.0, self._open_until - time.monotonic()), 2) if self.state != CLOSED else 0,
+            }
+
+
+class BreakerSet:
+    """One CircuitBreaker per route name, created on first use"""
+
+    def __init__(self, **options):
+        self.options = options
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, route):
+        breaker = self._breakers.get(route)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(route, CircuitBreaker(route, **self.options))
+        return breaker
+
+    def is_open(self, *routes):
+        """True when any of `routes` is refusing calls"""
+        return any(self._breakers[r].is_open() for r in routes if r in self._breakers)
+
+    def stats(self):
+        return {route: breaker.stats() for route, breaker in sorted(self._breakers.items())}
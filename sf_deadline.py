@@ -0,0 +1,86 @@
+"""Time budgets for the Salesforce calls made on behalf of one request.
+
+Each incoming request (and each queued job) gets a deadline, kept per
+thread like the limiter priority (per task under asyncio, see asgi.py).
+Every Salesforce call it makes - token refresh, lookup, write, their
+retries and backoff - spends from that one budget: timeouts are clipped
+to what is left, and once it is gone calls fail fast with
+DeadlineExceeded instead of holding the worker until gunicorn kills it.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import sf_limits
+
+SF_REQUEST_DEADLINE = float(os.environ.get("SF_REQUEST_DEADLINE", 25))  # seconds per request, 0 = none
+SF_JOB_DEADLINE = float(os.environ.get("SF_JOB_DEADLINE", 120))  # seconds per queued job, 0 = none
+
+
+class DeadlineExceeded(sf_limits.Overloaded):
+    """The request ran out of time for Salesforce calls"""
+
+    def __init__(self, message="Request deadline exceeded before Salesforce answered"):
+        super().__init__(message, retry_after=1)
+
+
+_expires_at = ContextVar("sf_deadline", default=None)
+
+
+def expires_at():
+    """Monotonic expiry of this thread's deadline, or None"""
+    return _expires_at.get()
+
+
+def set_deadline(seconds):
+    """Give this thread `seconds` from now (0/None clears the deadline)"""
+    _expires_at.set(time.monotonic() + seconds if seconds else None)
+
+
+@contextmanager
+def until(expiry):
+    """Run with the deadline `expiry` (from expires_at()), e.g. in a pool thread"""
+    token = _expires_at.set(expiry)
+    try:
+        yield
+    finally:
+        _expires_at.reset(token)
+
+
+@contextmanager
+def deadline(seconds):
+    """Run with at most `seconds` left; an earlier outer deadline still wins"""
+    expiry = time.monotonic() + seconds if seconds else None
+    outer = expires_at()
+    if expiry is None or (outer is not None and outer < expiry):
+        expiry = outer
+    with until(expiry):
+        yield
+
+
+def remaining():
+    """Seconds left (never negative), or None without a deadline"""
+    expiry = expires_at()
+    return None if expiry is None else max(0.0, expiry - time.monotonic())
+
+
+def allows(seconds):
+    """True when `seconds` more can be spent without running out"""
+    left = remaining()
+    return left is None or left > seconds
+
+
+def clip(timeout):
+    """(connect, read) timeout cut down to the time left, and whether it was cut.
+
+    Raises DeadlineExceeded when nothing is left.
+    """
+    left = remaining()
+    if left is None:
+        return timeout, False
+    if left <= 0:
+        raise DeadlineExceeded()
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    clipped = (min(connect, left), min(read, left))
+    return clipped, clipped != (connect, read)
@@ -0,0 +1,339 @@
+"""Pooled keep-alive HTTP client used for every outbound Salesforce call.
+
+One requests.Session per client keeps TCP+TLS connections open between
+calls. Every call passes the adaptive limiter in sf_limits, gets
+connect/read deadlines (clipped to the request's sf_deadline), and
+failed idempotent calls are retried with jittered exponential backoff as
+long as the retry budget and the deadline allow it. Calls are grouped into
+routes, each with its own circuit breaker (sf_breaker) and latency window;
+idempotent reads can be hedged against their route's p95.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import sf_breaker
+import sf_deadline
+import sf_limits
+
+SF_API_VERSION = os.environ.get("SF_API_VERSION", "59.0")
+SF_POOL_CONNECTIONS = int(os.environ.get("SF_POOL_CONNECTIONS", 4))  # hosts kept pooled
+SF_POOL_MAXSIZE = int(os.environ.get("SF_POOL_MAXSIZE", 20))  # connections per host
+SF_CONNECT_TIMEOUT = float(os.environ.get("SF_CONNECT_TIMEOUT", 3.05))  # seconds
+SF_READ_TIMEOUT = float(os.environ.get("SF_READ_TIMEOUT", 30))  # seconds
+SF_RETRIES = int(os.environ.get("SF_RETRIES", 2))
+SF_RETRY_BACKOFF = float(os.environ.get("SF_RETRY_BACKOFF", 0.2))  # seconds
+SF_RETRY_BACKOFF_MAX = float(os.environ.get("SF_RETRY_BACKOFF_MAX", 2.0))  # seconds
+SF_RETRY_BUDGET_RATIO = float(os.environ.get("SF_RETRY_BUDGET_RATIO", 0.1))  # retries per request
+SF_RETRY_BUDGET_MIN = float(os.environ.get("SF_RETRY_BUDGET_MIN", 10))  # retries always allowed
+SF_HEDGE = os.environ.get("SF_HEDGE", "0") == "1"  # race a second GET past the route's p95
+SF_HEDGE_MIN_DELAY = float(os.environ.get("SF_HEDGE_MIN_DELAY", 0.05))  # seconds
+SF_HEDGE_MIN_SAMPLES = 20  # latencies seen on a route before it is hedged
+LATENCY_WINDOW = 200  # recent successful calls per route
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+
+class RetryBudget:
+    """Caps retries to a fraction of recent traffic so retries can't snowball.
+
+    Every request deposits `ratio` tokens and every retry withdraws one; the
+    bucket never holds more than `minimum` plus what the ratio has earned.
+    """
+
+    def __init__(self, ratio=0.1, minimum=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self._tokens = float(minimum)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.minimum + self.ratio * 1000)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class LatencyWindow:
+    """Latencies of a route's recent successful calls"""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def _sorted(self):
+        with self._lock:
+            return sorted(self._samples)
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging (the p95), or None until enough calls were seen"""
+        samples = self._sorted()
+        if len(samples) < SF_HEDGE_MIN_SAMPLES:
+            return None
+        return max(SF_HEDGE_MIN_DELAY, _percentile(samples, 0.95))
+
+    def stats(self):
+        samples = self._sorted()
+        return {
+            "calls": len(samples),
+            "p50_ms": round(_percentile(samples, 0.5) * 1000, 1) if samples else None,
+            "p95_ms": round(_percentile(samples, 0.95) * 1000, 1) if samples else None,
+        }
+
+
+def _percentile(samples, q):
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+class HttpClient:
+    def __init__(self, pool_connections=SF_POOL_CONNECTIONS, pool_maxsize=SF_POOL_MAXSIZE,
+                 connect_timeout=SF_CONNECT_TIMEOUT, read_timeout=SF_READ_TIMEOUT,
+                 retries=SF_RETRIES, backoff=SF_RETRY_BACKOFF, backoff_max=SF_RETRY_BACKOFF_MAX,
+                 budget=None, limiter=None, breakers=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.budget = budget or RetryBudget(SF_RETRY_BUDGET_RATIO, SF_RETRY_BUDGET_MIN)
+        self.limiter = limiter or sf_limits.AdaptiveLimiter()
+        self.breakers = breakers or sf_breaker.BreakerSet()
+        self.hedge_workers = 2 * pool_maxsize
+
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+        self._counters = {"requests": 0, "retries": 0, "retries_denied": 0, "timeouts": 0, "errors": 0,
+                          "hedges": 0, "hedge_wins": 0, "hedges_denied": 0}
+        self._latencies = {}  # route -> LatencyWindow
+        self._hedge_pool = None
+        self._hedge_pool_pid = None
+        self._lock = threading.Lock()
+
+    def request(self, method, url, idempotent=None, timeout=None, retries=None, priority=None,
+                route=None, hedge=False, **kwargs):
+        """Send a request through the pool, the route's breaker and the limiter.
+
+        `idempotent` defaults to the HTTP method's semantics; non-idempotent
+        calls are only retried when the connection could not be opened, since
+        the server never saw them. `timeout` is a (connect, read) tuple or a
+        single number and defaults to the client's deadlines, clipped to the
+        calling thread's sf_deadline. `priority` is an sf_limits level and
+        defaults to the calling thread's. `route` names the breaker (default:
+        method and path). With `hedge` (and SF_HEDGE on) a GET slower than
+        the route's p95 gets a second, racing request.
+
+        Raises sf_limits.Overloaded when the call is shed: by the limiter, an
+        open breaker (sf_breaker.CircuitOpen) or an expired deadline
+        (sf_deadline.DeadlineExceeded).
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        max_retries = self.retries if retries is None else retries
+        priority = sf_limits.current_priority() if priority is None else priority
+        route = route or f"{method} {urlsplit(url).path}"
+        breaker = self.breakers.get(route)
+        hedge = hedge and SF_HEDGE and method == "GET"
+
+        self._count("requests")
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            breaker.check()
+            attempt_timeout, clipped = sf_deadline.clip(timeout)
+            send = self._hedged if hedge else self._send
+            try:
+                response = send(method, url, attempt_timeout, clipped, priority, route, **kwargs)
+            except requests.exceptions.Timeout as e:
+                self._count("timeouts")
+                if clipped and not sf_deadline.allows(0):
+                    raise sf_deadline.DeadlineExceeded() from e
+                connect_failed = isinstance(e, requests.exceptions.ConnectTimeout)
+                if not (idempotent or connect_failed) or not self._may_retry(attempt, max_retries):
+                    raise
+            except requests.exceptions.ConnectionError:
+                self._count("errors")
+                if not idempotent or not self._may_retry(attempt, max_retries):
+                    raise
+            else:
+                metrics.note_upstream_status(response.status_code)
+                if response.status_code not in RETRY_STATUSES or not idempotent:
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                delay = (min(int(retry_after), self.backoff_max) if retry_after and retry_after.isdigit()
+                         else self._backoff(attempt))
+                if not sf_deadline.allows(delay) or not self._may_retry(attempt, max_retries):
+                    return response
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            delay = self._backoff(attempt)
+            if not sf_deadline.allows(delay):
+                raise sf_deadline.DeadlineExceeded()
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, method, url, timeout, clipped, priority, route, started=None, **kwargs):
+        """One attempt: take a limiter slot (unless given one), send, feed back the outcome"""
+        if started is None:
+            started = self.limiter.acquire(priority, wait=sf_deadline.remaining())
+        breaker = self.breakers.get(route)
+        try:
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.Timeout:
+            # A timeout we cut short for the deadline says nothing about Salesforce
+            self.limiter.release(started, overloaded=not clipped)
+            if not clipped:
+                breaker.record(False)
+            raise
+        except requests.exceptions.ConnectionError:
+            self.limiter.release(started)
+            breaker.record(False)
+            raise
+        except BaseException:
+            self.limiter.release(started)
+            raise
+        latency = time.monotonic() - started
+        retry_after = response.headers.get("Retry-After")
+        self.limiter.note_usage(response.headers.get("Sforce-Limit-Info"))
+        self.limiter.release(
+            started,
+            overloaded=response.status_code in (429, 503),
+            retry_after=int(retry_after) if retry_after and retry_after.isdigit() else None,
+        )
+        ok = response.status_code < 500 and response.status_code != 429
+        breaker.record(ok)
+        if ok:
+            self._latency(route).add(latency)
+        return response
+
+    def _hedged(self, method, url, timeout, clipped, priority, route, **kwargs):
+        """_send, plus a second request if the first outlives the route's p95.
+
+        The hedge only goes out when the limiter has a free slot and the retry
+        budget a token, so hedging backs off on its own when Salesforce is
+        busy. The first response wins; the other is closed when it arrives.
+        """
+        delay = self._latency(route).hedge_delay()
+        if delay is None:
+            return self._send(method, url, timeout, clipped, priority, route, **kwargs)
+
+        # Slots are taken here, where the caller's deadline is known
+        pool = self._pool()
+        started = self.limiter.acquire(priority, wait=sf_deadline.remaining())
+        primary = pool.submit(self._send, method, url, timeout, clipped, priority, route, started=started, **kwargs)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeout:
+            pass
+
+        started = self.limiter.try_acquire(priority)
+        if started is None or not self.budget.withdraw():
+            if started is not None:
+                self.limiter.release(started)
+            self._count("hedges_denied")
+            return primary.result()
+        self._count("hedges")
+        hedged = pool.submit(self._send, method, url, timeout, clipped, priority, route, started=started, **kwargs)
+
+        pending = {primary, hedged}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedged:
+                        self._count("hedge_wins")
+                    for loser in pending:
+                        loser.add_done_callback(_close_response)
+                    return future.result()
+        return primary.result()  # both failed: raise the primary's error
+
+    def _latency(self, route):
+        window = self._latencies.get(route)
+        if window is None:
+            with self._lock:
+                window = self._latencies.setdefault(route, LatencyWindow())
+        return window
+
+    def _pool(self):
+        # Worker threads don't survive fork(); each process gets its own pool
+        with self._lock:
+            if self._hedge_pool is None or self._hedge_pool_pid != os.getpid():
+                self._hedge_pool = ThreadPoolExecutor(max_workers=self.hedge_workers,
+                                                      thread_name_prefix="sf-hedge")
+                self._hedge_pool_pid = os.getpid()
+            return self._hedge_pool
+
+    def _may_retry(self, attempt, max_retries):
+        if attempt >= max_retries:
+            return False
+        if not self.budget.withdraw():
+            self._count("retries_denied")
+            return False
+        self._count("retries")
+        return True
+
+    def _backoff(self, attempt):
+        # "Full jitter": uniform over [0, capped exponential]
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        """Counters, per-host connection pool usage, limiter, breaker and route latency state"""
+        with self._lock:
+            stats = dict(self._counters)
+        pools = []
+        manager = self.adapter.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                "maxsize": pool.pool.maxsize if pool.pool else 0,
+                "idle": pool.pool.qsize() if pool.pool else 0,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+            })
+        stats["pools"] = pools
+        stats["limiter"] = self.limiter.stats()
+        stats["breakers"] = self.breakers.stats()
+        stats["routes"] = {route: window.stats() for route, window in sorted(self._latencies.items())}
+        return stats
+
+
+client = HttpClient()
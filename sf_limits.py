@@ -0,0 +1,244 @@
+"""Adaptive limiter in front of every outbound Salesforce call.
+
+Two signals decide whether a call may go out:
+
+- API quota. Salesforce reports org-wide usage on every response in
+  `Sforce-Limit-Info: api-usage=used/limit`. As usage approaches the limit,
+  low-priority calls (bulk reads such as /api/all) are shed first, then
+  normal ones; webhook writes keep going until the last SF_QUOTA_SHED_HIGH
+  of the allotment.
+- Concurrency. Each worker allows `limit` calls in flight and adjusts it
+  AIMD-style: +1/limit per call that completes at capacity with normal
+  latency, x0.7 on 429/503/timeouts, x0.9 when latency climbs well above
+  the observed baseline. A 429/503 also starts a short cooldown.
+
+Callers over the limit wait for a slot in priority order (backpressure);
+if none frees up within their priority's wait budget they get Overloaded.
+The priority comes from the calling thread (`priority(...)`, set per
+route by the app) unless the call passes one. Coroutines (asgi.py) share
+the limiter through acquire_async, which polls for a slot instead of
+blocking the event loop.
+"""
+import asyncio
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+HIGH, NORMAL, LOW = 0, 1, 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+SF_CONCURRENCY_INITIAL = float(os.environ.get("SF_CONCURRENCY_INITIAL", 8))  # calls in flight per worker
+SF_CONCURRENCY_MIN = float(os.environ.get("SF_CONCURRENCY_MIN", 1))
+SF_CONCURRENCY_MAX = float(os.environ.get("SF_CONCURRENCY_MAX", os.environ.get("SF_POOL_MAXSIZE", 20)))
+SF_LATENCY_TOLERANCE = float(os.environ.get("SF_LATENCY_TOLERANCE", 3.0))  # x baseline before backing off
+SF_QUOTA_SHED_LOW = float(os.environ.get("SF_QUOTA_SHED_LOW", 0.80))  # fraction of daily API calls used
+SF_QUOTA_SHED_NORMAL = float(os.environ.get("SF_QUOTA_SHED_NORMAL", 0.95))
+SF_QUOTA_SHED_HIGH = float(os.environ.get("SF_QUOTA_SHED_HIGH", 0.99))
+SF_QUOTA_STALE = 60  # seconds before a usage reading is ignored (lets a probe call through)
+SF_LIMIT_WAIT = {
+    HIGH: float(os.environ.get("SF_LIMIT_WAIT_HIGH", 30)),  # seconds a call may wait for a slot
+    NORMAL: float(os.environ.get("SF_LIMIT_WAIT_NORMAL", 10)),
+    LOW: float(os.environ.get("SF_LIMIT_WAIT_LOW", 1)),
+}
+SF_COOLDOWN = 1.0  # seconds after a 429/503 without Retry-After
+SF_LIMIT_POLL = 0.01  # seconds between an async caller's tries for a slot
+
+_API_USAGE = re.compile(r"api-usage=(\d+)/(\d+)")
+
+concurrency_limit = metrics.Gauge("mercybio_sf_concurrency_limit", "Adaptive Salesforce concurrency limit (summed over workers)")
+shed_calls = metrics.Counter("mercybio_sf_shed_total", "Salesforce calls refused by the limiter", ("priority", "reason"))
+
+
+class Overloaded(Exception):
+    """The limiter refused the call; retry after `retry_after` seconds"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+_current = threading.local()
+
+
+def current_priority():
+    return getattr(_current, "priority", NORMAL)
+
+
+def set_priority(level):
+    _current.priority = level
+
+
+@contextmanager
+def priority(level):
+    """Run outbound calls on this thread at `level`"""
+    previous = current_priority()
+    _current.priority = level
+    try:
+        yield
+    finally:
+        _current.priority = previous
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial=SF_CONCURRENCY_INITIAL, minimum=SF_CONCURRENCY_MIN, maximum=SF_CONCURRENCY_MAX,
+                 latency_tolerance=SF_LATENCY_TOLERANCE, waits=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.waits = waits or SF_LIMIT_WAIT
+        self.limit = min(max(initial, minimum), maximum)
+        self.in_flight = 0
+        self.baseline = None  # slowly-rising minimum latency, seconds
+        self.api_used = None
+        self.api_limit = None
+        self._usage_at = 0.0
+        self._cooldown_until = 0.0
+        self._last_decrease = 0.0
+        self._waiting = [0, 0, 0]
+        self._counters = {"calls": 0, "shed": 0, "waited": 0, "increases": 0, "decreases": 0}
+        self._cond = threading.Condition()
+        concurrency_limit.inc(self.limit)
+
+    def usage_ratio(self):
+        if not self.api_limit or time.time() - self._usage_at > SF_QUOTA_STALE:
+            return None
+        return self.api_used / self.api_limit
+
+    def _shed(self, level, reason, message, retry_after):
+        self._counters["shed"] += 1
+        shed_calls.inc(priority=PRIORITY_NAMES[level], reason=reason)
+        raise Overloaded(message, retry_after)
+
+    def _over_quota(self, level):
+        ratio = self.usage_ratio()
+        threshold = (SF_QUOTA_SHED_HIGH, SF_QUOTA_SHED_NORMAL, SF_QUOTA_SHED_LOW)[level]
+        return ratio if ratio is not None and ratio >= threshold else None
+
+    def _check_quota(self, level):
+        ratio = self._over_quota(level)
+        if ratio is not None:
+            self._shed(level, "quota", f"Salesforce API usage at {ratio:.0%}", SF_QUOTA_STALE)
+
+    def acquire(self, level=None, wait=None):
+        """Wait for a slot; returns the start time to hand back to release()
+
+        `wait` caps the priority's wait budget, e.g. to a request deadline.
+        """
+        level = current_priority() if level is None else level
+        with self._cond:
+            self._check_quota(level)
+            budget = self.waits[level] if wait is None else min(wait, self.waits[level])
+            deadline = time.monotonic() + budget
+            self._waiting[level] += 1
+            waited = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    cooling = self._cooldown_until - now
+                    if cooling > 0 and level == LOW:
+                        self._shed(level, "cooldown", "Salesforce is throttling requests", cooling)
+                    if (cooling <= 0 and self.in_flight < int(self.limit)
+                            and not any(self._waiting[:level])):
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._shed(level, "concurrency", "Too many Salesforce calls in flight", 1)
+                    waited = True
+                    self._cond.wait(min(remaining, cooling) if cooling > 0 else remaining)
+            finally:
+                self._waiting[level] -= 1
+            self.in_flight += 1
+            self._counters["calls"] += 1
+            if waited:
+                self._counters["waited"] += 1
+        return time.monotonic()
+
+    async def acquire_async(self, level, wait=None):
+        """acquire() for a coroutine: the same shedding, without blocking the loop
+
+        Threads waiting in acquire() at the same or a higher priority go first.
+        """
+        with self._cond:
+            self._check_quota(level)
+        budget = self.waits[level] if wait is None else min(wait, self.waits[level])
+        deadline = time.monotonic() + budget
+        while True:
+            started = self.try_acquire(level)
+            if started is not None:
+                return started
+            if time.monotonic() + SF_LIMIT_POLL >= deadline:
+                # Takes a slot freed just now or sheds (cooldown, concurrency) as acquire() does
+                return self.acquire(level, wait=0)
+            await asyncio.sleep(SF_LIMIT_POLL)
+
+    def try_acquire(self, level=None):
+        """A slot only if one is free right now (start time), else None; never sheds"""
+        level = current_priority() if level is None else level
+        with self._cond:
+            if (self._over_quota(level) is not None or self._cooldown_until > time.monotonic()
+                    or self.in_flight >= int(self.limit) or any(self._waiting[:level + 1])):
+                return None
+            self.in_flight += 1
+            self._counters["calls"] += 1
+        return time.monotonic()
+
+    def release(self, started, overloaded=False, retry_after=None):
+        """Finish a call and adapt the limit to how it went"""
+        latency = time.monotonic() - started
+        with self._cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            before = self.limit
+            now = time.monotonic()
+            if overloaded:
+                self._cooldown_until = max(self._cooldown_until, now + (retry_after or SF_COOLDOWN))
+                self._decrease(now, 0.7)
+            else:
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    # Let the baseline drift up so a slower steady state isn't punished forever
+                    self.baseline += (latency - self.baseline) * 0.01
+                if latency > self.baseline * self.latency_tolerance and latency > 0.05:
+                    self._decrease(now, 0.9)
+                elif saturated and self.limit < self.maximum:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                    self._counters["increases"] += 1
+            if self.limit != before:
+                concurrency_limit.inc(self.limit - before)
+            self._cond.notify_all()
+
+    def _decrease(self, now, factor):
+        # One decrease per round trip: a burst of failures is one signal
+        if now - self._last_decrease < max(self.baseline or 0, 0.1):
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * factor)
+        self._counters["decreases"] += 1
+
+    def note_usage(self, header):
+        """Record org-wide API usage from a Sforce-Limit-Info header"""
+        match = _API_USAGE.search(header or "")
+        if not match:
+            return
+        with self._cond:
+            self.api_used, self.api_limit = int(match.group(1)), int(match.group(2))
+            self._usage_at = time.time()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "waiting": {PRIORITY_NAMES[p]: n for p, n in enumerate(self._waiting)},
+                "baseline_ms": round(self.baseline * 1000, 1) if self.baseline is not None else None,
+                "cooldown_s": round(max(0.0, self._cooldown_until - time.monotonic()), 2),
+                "api_used": self.api_used,
+                "api_limit": self.api_limit,
+            })
+        return stats
@@ -0,0 +1,66 @@
+"""Shared on-disk state (SQLite) used by every gunicorn worker on the host.
+
+State is kept per scope: the tenant a thread (or asyncio task) is working
+for keeps its databases in STATE_DIR/<scope> (see tenants); the default
+scope "" is STATE_DIR itself.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+STATE_DIR = os.environ.get("STATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "var"))
+
+_local = threading.local()
+_scope = ContextVar("storage_scope", default="")
+
+
+def current_scope():
+    return _scope.get()
+
+
+def set_scope(scope):
+    """Keep this thread's (task's) state in STATE_DIR/<scope>"""
+    _scope.set(scope)
+
+
+@contextmanager
+def scoped(scope):
+    token = _scope.set(scope)
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def state_dir(scope=None):
+    """Directory of the current (or the given) scope's state"""
+    scope = _scope.get() if scope is None else scope
+    return os.path.join(STATE_DIR, scope) if scope else STATE_DIR
+
+
+def connect(name, schema=None):
+    """Return this thread's connection to <state_dir()>/<name>.
+
+    `schema` (a SQL script of CREATE ... IF NOT EXISTS statements) runs once
+    when the connection is opened. Connections are cached per thread and per
+    process, so a connection opened before gunicorn forks is never reused by
+    a child.
+    """
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    directory = state_dir()
+    key = (os.getpid(), directory, name)
+    conn = conns.get(key)
+    if conn is None:
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(directory, name), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if schema:
+            conn.executescript(schema)
+        conns[key] = conn
+    return conn
@@ -0,0 +1,133 @@
+"""What was last synced to Salesforce for each NPI, plus idempotency keys.
+
+For every NPI we keep a hash of the last payload and the field values
+Salesforce is known to hold. A resent payload with the same values needs no
+Salesforce call, and a changed one only needs the fields that differ. Known
+values expire after SYNC_STATE_TTL, so edits made directly in Salesforce
+are eventually overwritten by a full update again.
+
+Idempotency keys map a delivery key to the response it got, so a retried
+delivery gets the same answer without being processed twice.
+"""
+import hashlib
+import json
+import os
+import time
+
+import storage
+
+DB_NAME = "sync_state.db"
+SYNC_STATE_TTL = float(os.environ.get("SYNC_STATE_TTL", 24 * 3600))  # seconds
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 24 * 3600))  # seconds
+IDEMPOTENCY_CLAIM_TTL = 120  # seconds before an unfinished claim can be retaken
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sync_state (
+        npi TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        fields TEXT NOT NULL,
+        synced_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT PRIMARY KEY,
+        status_code INTEGER,
+        result TEXT,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at);
+"""
+
+
+def _db():
+    return storage.connect(DB_NAME, SCHEMA)
+
+
+def content_hash(record_data):
+    return hashlib.sha256(json.dumps(record_data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def changes(npi, record_data):
+    """Fields of `record_data` that differ from what Salesforce last accepted.
+
+    Returns all of `record_data` when nothing is known about the NPI, and an
+    empty dict when the payload would not change anything.
+    """
+    row = _db().execute(
+        "SELECT content_hash, fields FROM sync_state WHERE npi = ? AND synced_at > ?",
+        (str(npi), time.time() - SYNC_STATE_TTL),
+    ).fetchone()
+    if row is None:
+        return dict(record_data)
+    if row["content_hash"] == content_hash(record_data):
+        return {}
+    known = json.loads(row["fields"])
+    return {k: v for k, v in record_data.items() if known.get(k) != v}
+
+
+def remember(npi, record_data):
+    """Record that Salesforce now holds `record_data` for this NPI"""
+    remember_many([(npi, record_data)])
+
+
+def remember_many(items):
+    """remember() for many (npi, record_data) pairs in one transaction"""
+    conn = _db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for npi, record_data in items:
+            npi = str(npi)
+            row = conn.execute(
+                "SELECT fields FROM sync_state WHERE npi = ? AND synced_at > ?",
+                (npi, now - SYNC_STATE_TTL),
+            ).fetchone()
+            fields = json.loads(row["fields"]) if row else {}
+            fields.update(record_data)
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_state (npi, content_hash, fields, synced_at) VALUES (?, ?, ?, ?)",
+                (npi, content_hash(record_data), json.dumps(fields, default=str), now),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def forget(npi):
+    _db().execute("DELETE FROM sync_state WHERE npi = ?", (str(npi),))
+
+
+def claim_key(key):
+    """Reserve an idempotency key.
+
+    Returns (True, None) if this delivery should be processed, (False, None)
+    while another delivery with the key is still running, or (False,
+    (result, status_code)) with the stored response of a finished one.
+    """
+    now = time.time()
+    conn = _db()
+    conn.execute("DELETE FROM idempotency_keys WHERE created_at <= ?", (now - IDEMPOTENCY_TTL,))
+    cursor = conn.execute(
+        "INSERT INTO idempotency_keys (key, status_code, result, created_at) VALUES (?, NULL, NULL, ?) "
+        "ON CONFLICT(key) DO UPDATE SET created_at = excluded.created_at "
+        "WHERE idempotency_keys.status_code IS NULL AND idempotency_keys.created_at <= ?",
+        (key, now, now - IDEMPOTENCY_CLAIM_TTL),
+    )
+    if cursor.rowcount == 1:
+        return True, None
+    row = conn.execute("SELECT status_code, result FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+    if row is None or row["status_code"] is None:
+        return False, None
+    return False, (json.loads(row["result"]), row["status_code"])
+
+
+def complete_key(key, result, status_code):
+    _db().execute(
+        "UPDATE idempotency_keys SET status_code = ?, result = ? WHERE key = ?",
+        (status_code, json.dumps(result, default=str), key),
+    )
+
+
+def release_key(key):
+    """Forget a claim whose delivery failed, so a retry is processed again"""
+    _db().execute("DELETE FROM idempotency_keys WHERE key = ?", (key,))
@@ -0,0 +1,317 @@
+"""Salesforce orgs (tenants) served by one deployment.
+
+TENANTS lists the orgs, e.g. "prod,sandbox"; the first one is the default.
+Each reads its settings from the usual variables prefixed with its upper-
+cased name (PROD_HUB_CLIENT_ID, SANDBOX_HUB_PRIVATE_KEY, ...) and gets its
+own access token, pooled HTTP client (limiter, breakers, retry budget) and
+storage scope, so its caches, replica, webhook queue and logs live in
+STATE_DIR/<name>. Without TENANTS there is a single "default" tenant using
+the unprefixed variables and STATE_DIR itself, as before.
+
+A request picks its tenant with a /t/<name> path prefix or the X-Tenant
+header and falls back to the default tenant. With several tenants each
+one may have at most TENANT_MAX_IN_FLIGHT requests in flight on the host,
+all workers together, so one org's backlog can't take every worker from
+the others. The slots are lock files in the tenant's state directory
+(flock), so a worker that dies gives its slots back.
+"""
+import fcntl
+import os
+import re
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import json_codec
+import metrics
+import sf_http
+import sf_limits
+import storage
+from sf_auth import TokenManager, build_jwt, default_cache_path, load_private_key
+
+TENANT_HEADER = os.environ.get("TENANT_HEADER", "X-Tenant")
+TENANT_PATH_PREFIX = "/t/"
+TENANT_MAX_IN_FLIGHT = int(os.environ.get("TENANT_MAX_IN_FLIGHT", 16))  # requests per tenant per host, 0 = no cap
+DEFAULT_TENANT = "default"
+HUB_TOKEN_TTL = int(os.environ.get("HUB_TOKEN_TTL", 3600))  # seconds
+HUB_TOKEN_REFRESH_MARGIN = int(os.environ.get("HUB_TOKEN_REFRESH_MARGIN", 300))
+
+_NAME = re.compile(r"^[a-z0-9_-]+$")
+
+requests_in_flight = metrics.Gauge("mercybio_tenant_requests_in_flight", "Requests in flight per tenant", ("tenant",))
+rejected_requests = metrics.Counter(
+    "mercybio_tenant_rejected_total", "Requests refused because the tenant was at its in-flight share", ("tenant",))
+
+
+class UnknownTenant(LookupError):
+    """No tenant of that name is configured"""
+
+
+class TokenUnavailable(sf_limits.Overloaded):
+    """Salesforce's token endpoint is failing or throttling; retry after `retry_after` seconds"""
+
+
+class HostSlots:
+    """`limit` slots shared by every worker process on the host.
+
+    Slot i is an exclusive flock on <directory>/slot-<i>.lock, taken
+    without waiting. The files are opened per process (a forked child must
+    not share its parent's locks) and a slot held by one thread is never
+    tried by another of the same process.
+    """
+
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+        self._pid = None
+        self._files = []
+        self._free = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._files = [open(os.path.join(self.directory, f"slot-{i}.lock"), "a") for i in range(self.limit)]
+        self._free = list(range(self.limit))
+        self._pid = os.getpid()
+
+    def acquire(self):
+        """A free slot's number, or None when every slot is taken"""
+        with self._lock:
+            self._open()
+            for slot in self._free:
+                try:
+                    fcntl.flock(self._files[slot], fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                self._free.remove(slot)
+                return slot
+            return None
+
+    def release(self, slot):
+        with self._lock:
+            fcntl.flock(self._files[slot], fcntl.LOCK_UN)
+            self._free.append(slot)
+
+
+class Tenant:
+    def __init__(self, name, prefix="", scope="", http=None, max_in_flight=0):
+        def setting(key, default=None):
+            return os.environ.get(prefix + key, default)
+
+        self.name = name
+        self.scope = scope
+        self.client_id = setting("HUB_CLIENT_ID")
+        self.username = setting("HUB_USERNAME")
+        self.private_key = setting("HUB_PRIVATE_KEY")  # Store the key content directly
+        self.domain = setting("HUB_DOMAIN", os.environ.get("HUB_DOMAIN", "test"))
+        # Token endpoint override, e.g. the local stub in bench/sf_stub.py
+        self.auth_url = setting("HUB_AUTH_URL", f"https://{self.domain}.salesforce.com/services/oauth2/token")
+        # Access tokens are cached and shared across workers through this file,
+        # never shared between tenants
+        self.token_cache_file = setting("HUB_TOKEN_CACHE_FILE", default_cache_path(
+            self.auth_url, self.client_id, self.username, *([name] if scope else [])))
+        self.org_sobject = setting("SF_ORG_SOBJECT", os.environ.get("SF_ORG_SOBJECT"))
+        self.http = http or sf_http.HttpClient()
+        self.token_manager = TokenManager(
+            self.request_access_token,
+            cache_path=self.token_cache_file or None,
+            ttl=HUB_TOKEN_TTL,
+            refresh_margin=HUB_TOKEN_REFRESH_MARGIN,
+        )
+        self._signing_key = None
+        self.max_in_flight = max_in_flight
+        self._slots = HostSlots(os.path.join(storage.state_dir(scope), "in_flight"),
+                                max_in_flight) if max_in_flight else None
+        self._in_flight = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Tenant {self.name}>"
+
+    def signing_key(self):
+        """Parse the PEM private key once and reuse it for every JWT"""
+        if self._signing_key is None:
+            if not self.private_key:
+                raise RuntimeError(f"HUB_PRIVATE_KEY is not set for tenant '{self.name}'")
+            self._signing_key = load_private_key(self.private_key)
+        return self._signing_key
+
+    def request_access_token(self):
+        """Exchange a signed JWT for a new Salesforce access token of this org"""
+        jwt_token = build_jwt(self.client_id, self.username, self.signing_key(), self.domain)
+
+        # Minting a token has no side effects, so it is safe to retry like a GET
+        # Every other call needs a token, so it is never shed behind them
+        response = self.http.request("POST", self.auth_url, idempotent=True, priority=sf_limits.HIGH, route="token", data={
+            "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+            "assertion": jwt_token,
+        })
+
+        if response.status_code == 429 or response.status_code >= 500:
+            # Like any other shed call: 503 with Retry-After, queued jobs retry
+            retry_after = response.headers.get("Retry-After")
+            raise TokenUnavailable(
+                f"Salesforce token endpoint unavailable: {response.status_code}",
+                int(retry_after) if retry_after and retry_after.isdigit() else 1)
+        if response.status_code != 200:
+            raise RuntimeError(f"Salesforce JWT auth failed: {response.status_code} {response.text}")
+
+        return json_codec.parse_response(response)
+
+    def enter(self):
+        """Count a request in; returns the ticket to hand to leave(), or None
+        when the tenant's in-flight slots on this host are all taken"""
+        ticket = self._slots.acquire() if self._slots else -1
+        with self._lock:
+            if ticket is None:
+                self._rejected += 1
+            else:
+                self._in_flight += 1
+        if ticket is None:
+            rejected_requests.inc(tenant=self.name)
+        else:
+            requests_in_flight.inc(tenant=self.name)
+        return ticket
+
+    def leave(self, ticket):
+        if self._slots:
+            self._slots.release(ticket)
+        with self._lock:
+            self._in_flight -= 1
+        requests_in_flight.dec(tenant=self.name)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "scope": self.scope,
+                "org_sobject": self.org_sobject,
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "rejected": self._rejected,
+            }
+
+
+def _load():
+    names = [n.strip() for n in os.environ.get("TENANTS", "").split(",") if n.strip()]
+    if not names:
+        return {DEFAULT_TENANT: Tenant(DEFAULT_TENANT, http=sf_http.client)}
+    tenants = {}
+    for name in names:
+        if not _NAME.match(name):
+            raise ValueError(f"Invalid tenant name '{name}': use lowercase letters, digits, '-' and '_'")
+        prefix = re.sub(r"[^A-Z0-9]", "_", name.upper()) + "_"
+        max_in_flight = int(os.environ.get(f"{prefix}MAX_IN_FLIGHT", TENANT_MAX_IN_FLIGHT)) if len(names) > 1 else 0
+        tenants[name] = Tenant(name, prefix, scope=name, max_in_flight=max_in_flight)
+    return tenants
+
+
+_tenants = _load()
+default = next(iter(_tenants.values()))
+
+# Per thread under WSGI, per task under asyncio (asgi.py)
+_current = ContextVar("tenant", default=None)
+
+
+def get(name=None):
+    """The tenant called `name` (the default one for None/""); raises UnknownTenant"""
+    if not name:
+        return default
+    tenant = _tenants.get(name)
+    if tenant is None:
+        raise UnknownTenant(f"Unknown tenant '{name}'")
+    return tenant
+
+
+def all():
+    return list(_tenants.values())
+
+
+def current():
+    """The tenant this thread (task) is working for"""
+    return _current.get() or default
+
+
+def activate(tenant):
+    """Work for `tenant` from now on in this thread (task), storage included"""
+    _current.set(tenant)
+    storage.set_scope(tenant.scope)
+
+
+@contextmanager
+def use(tenant):
+    """Work for `tenant` inside the block"""
+    token = _current.set(tenant)
+    try:
+        with storage.scoped(tenant.scope):
+            yield
+    finally:
+        _current.reset(token)
+
+
+def bind(fn, tenant=None):
+    """`fn` running for `tenant` (default: the current one) in whatever thread calls it"""
+    tenant = tenant or current()
+
+    def bound(*args, **kwargs):
+        with use(tenant):
+            return fn(*args, **kwargs)
+
+    return bound
+
+
+def authenticate(stale_token=None):
+    """The current tenant's cached (access_token, instance_url), refreshing when needed"""
+    return current().token_manager.get(stale_token=stale_token)
+
+
+def refresh_auth_header(headers):
+    """Swap a rejected bearer token in `headers` for a fresh one.
+
+    Returns True when the header changed and the call is worth retrying.
+    """
+    stale_token = headers.get('Authorization', '').replace('Bearer ', '', 1)
+    if not stale_token:
+        return False
+    access_token, _ = authenticate(stale_token=stale_token)
+    if access_token == stale_token:
+        return False
+    headers['Authorization'] = f'Bearer {access_token}'
+    return True
+
+
+def split_path(path):
+    """('name', rest) for '/t/name/rest', (None, path) otherwise"""
+    if not path.startswith(TENANT_PATH_PREFIX):
+        return None, path
+    name, _, rest = path[len(TENANT_PATH_PREFIX):].partition("/")
+    return name, "/" + rest
+
+
+def stats():
+    return {tenant.name: tenant.stats() for tenant in _tenants.values()}
+
+
+class Middleware:
+    """WSGI middleware that takes the tenant off the path (or header).
+
+    '/t/prod/api/all' reaches the app as '/api/all' with '/t/prod' moved to
+    SCRIPT_NAME, so url_for keeps links under the tenant. The tenant name
+    (None when the request gave none) is left in environ["mercybio.tenant"].
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.header_key = "HTTP_" + TENANT_HEADER.upper().replace("-", "_")
+
+    def __call__(self, environ, start_response):
+        name, path = split_path(environ.get("PATH_INFO", ""))
+        if name is None:
+            name = environ.get(self.header_key)
+        else:
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + TENANT_PATH_PREFIX + name
+            environ["PATH_INFO"] = path
+        environ["mercybio.tenant"] = name
+        return self.app(environ, start_response)
@@ -0,0 +1,117 @@
+"""Shared fixtures: a throwaway STATE_DIR per test and a fake Salesforce org.
+
+The environment is set before app (and the modules it imports) is loaded,
+so nothing touches var/ or the /tmp token cache.
+"""
+import json
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("STATE_DIR", tempfile.mkdtemp(prefix="mercybio-tests-"))
+os.environ["HUB_TOKEN_CACHE_FILE"] = ""
+os.environ["WEBHOOK_MODE"] = "sync"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import storage
+import tenants
+
+INSTANCE_URL = "https://sf.test"
+API_PATH = "/services/apexrest/MercyHealthOrgAPI"
+SAMPLES_PATH = "/services/apexrest/hubspotintegration/getsamplesfornoninternalbatches"
+
+
+class FakeResponse:
+    """The parts of a requests Response the app reads"""
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode() if body is not None else b""
+        self.text = self.content.decode()
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSalesforce:
+    """MercyHealthOrgAPI in memory: records by Id, every call in `calls`.
+
+    getSamplesForNonInternalBatches answers with `samples` for any range.
+    `fail` maps a route to a status code every call on it answers with.
+    The token endpoint mints token-1, token-2, ...; calls made with a
+    token in `revoked` get a 401.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.samples = []
+        self.calls = []
+        self.fail = {}
+        self.revoked = set()
+        self._next_id = 1
+        self._next_token = 1
+
+    def add(self, record):
+        record_id = f"a0X{self._next_id:012d}"
+        self._next_id += 1
+        self.records[record_id] = dict(record, Id=record_id)
+        return record_id
+
+    def routes(self):
+        return [route for route, *_ in self.calls]
+
+    def request(self, method, url, headers=None, json=None, route=None, **kwargs):
+        self.calls.append((route, method, url, json))
+        if route in self.fail:
+            return FakeResponse(self.fail[route], [{"errorCode": "FAKE", "message": "failed"}])
+        if route == "token":
+            token = f"token-{self._next_token}"
+            self._next_token += 1
+            return FakeResponse(200, {"access_token": token, "instance_url": INSTANCE_URL})
+        if (headers or {}).get("Authorization", "").replace("Bearer ", "", 1) in self.revoked:
+            return FakeResponse(401, [{"errorCode": "INVALID_SESSION_ID", "message": "Session expired or invalid"}])
+        path = url[len(INSTANCE_URL):]
+        if method == "GET" and path.split("?")[0] == SAMPLES_PATH:
+            return FakeResponse(200, self.samples)
+        if method == "GET" and path == API_PATH:
+            return FakeResponse(200, list(self.records.values()))
+        if method == "GET" and path.startswith(API_PATH + "/npi/"):
+            npi = path.rsplit("/", 1)[1]
+            return FakeResponse(200, [r for r in self.records.values() if r.get("NPI__c") == npi])
+        if method == "PUT":
+            record_id = path.rsplit("/", 1)[1]
+            if record_id not in self.records:
+                return FakeResponse(404, [{"errorCode": "NOT_FOUND", "message": "not found"}])
+            self.records[record_id].update(json)
+            return FakeResponse(200, self.records[record_id])
+        if method == "POST" and path == API_PATH:
+            return FakeResponse(201, {"Id": self.add(json)})
+        return FakeResponse(404, [{"errorCode": "NOT_FOUND", "message": f"no route {method} {path}"}])
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    """Fresh SQLite state for every test"""
+    monkeypatch.setattr(storage, "STATE_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def salesforce(monkeypatch):
+    """Route the default tenant's Salesforce calls (token included) to a FakeSalesforce"""
+    fake = FakeSalesforce()
+    tenant = tenants.default
+    monkeypatch.setattr(tenant.http, "request", fake.request)
+    monkeypatch.setattr(tenant.token_manager, "get", lambda stale_token=None: ("token", INSTANCE_URL))
+    with tenants.use(tenant):
+        yield fake
@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+import pytest
+
+import app
+import asgi
+import sf_limits
+import tenants
+import webhook_queue
+from conftest import INSTANCE_URL
+
+NPI = "1234567893"
+
+
+@pytest.fixture
+def upstream(salesforce, monkeypatch):
+    """asgi.upstream and the token cache routed to the same FakeSalesforce"""
+    async def request(method, url, route, headers=None, content=None):
+        return salesforce.request(method, url, headers=headers, route=route,
+                                  json=json.loads(content) if content is not None else None)
+
+    monkeypatch.setattr(asgi.upstream, "request", request)
+    monkeypatch.setattr(tenants.default.token_manager, "peek", lambda stale_token=None: ("token", INSTANCE_URL))
+    return salesforce
+
+
+def post(path, payload):
+    """(status, headers, JSON body) of one request through asgi.app"""
+    messages = [{"type": "http.request", "body": json.dumps(payload).encode(), "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": path,
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+    }
+    asyncio.run(asgi.app(scope, receive, send))
+    start, *body = sent
+    headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    return start["status"], headers, json.loads(b"".join(m.get("body", b"") for m in body))
+
+
+def wsgi_post(path, payload):
+    response = app.app.test_client().post(path, json=payload)
+    return response.status_code, response.get_json()
+
+
+@pytest.mark.parametrize("payload", [
+    {"npi": "123"},
+    {"npi": NPI, "city": "Springfield"},
+])
+def test_asgi_webhook_matches_wsgi(upstream, payload):
+    # Rejected by validation, or unchanged since the last delivery
+    upstream.add({"NPI__c": NPI, "City__c": "Springfield"})
+    wsgi_post("/webhook/hubspot", {"npi": NPI, "city": "Springfield"})
+    del upstream.calls[:]
+
+    status, _, body = post("/webhook/hubspot", payload)
+
+    assert (status, body) == wsgi_post("/webhook/hubspot", payload)
+    assert "update" not in upstream.routes() and "create" not in upstream.routes()
+
+
+def test_asgi_update_matches_wsgi(upstream):
+    record_id = upstream.add({"NPI__c": NPI})
+
+    status, _, body = post("/webhook/hubspot", {"npi": NPI, "city": "Springfield"})
+    wsgi_status, wsgi_body = wsgi_post("/webhook/hubspot", {"npi": NPI, "city": "Shelbyville"})
+
+    assert (status, body["action"]) == (wsgi_status, wsgi_body["action"]) == (200, "updated")
+    assert {k for k in body if k != "message"} == {k for k in wsgi_body if k != "message"}
+    assert upstream.records[record_id]["City__c"] == "Shelbyville"
+    assert upstream.routes().count("update") == 2
+
+
+def test_asgi_creates_like_wsgi(upstream):
+    status, _, body = post("/webhook/hubspot", {"npi": NPI, "city": "Springfield"})
+    wsgi_status, wsgi_body = wsgi_post("/webhook/hubspot", {"npi": "1245319599", "city": "Springfield"})
+
+    assert (status, body["action"]) == (wsgi_status, wsgi_body["action"]) == (201, "created")
+    assert body.keys() == wsgi_body.keys()
+    assert [r["NPI__c"] for r in upstream.records.values()] == [NPI, "1245319599"]
+
+
+def test_asgi_shed_webhook_is_queued(upstream, monkeypatch):
+    async def request(method, url, route, **kwargs):
+        raise sf_limits.Overloaded(f"Too many Salesforce {route} calls in flight")
+
+    monkeypatch.setattr(asgi.upstream, "request", request)
+    monkeypatch.setattr(app, "start_webhook_workers", lambda: None)
+
+    status, _, body = post("/webhook/hubspot", {"npi": NPI})
+
+    assert (status, body["status"]) == (202, "accepted")
+    assert webhook_queue.depth()["pending"] == 1
@@ -0,0 +1,77 @@
+from datetime import date, timedelta
+
+import pytest
+
+import app
+import sf_breaker
+import tenants
+import webhook_queue
+from conftest import INSTANCE_URL
+
+NPI = "1234567893"
+
+
+@pytest.fixture
+def breakers(salesforce, monkeypatch):
+    """Fresh breakers the FakeSalesforce calls go through, as in sf_http"""
+    breakers = sf_breaker.BreakerSet()
+    fake_request = tenants.default.http.request
+
+    def request(method, url, route=None, **kwargs):
+        breaker = breakers.get(route)
+        breaker.check()
+        response = fake_request(method, url, route=route, **kwargs)
+        breaker.record(response.status_code < 500 and response.status_code != 429)
+        return response
+
+    monkeypatch.setattr(tenants.default.http, "breakers", breakers)
+    monkeypatch.setattr(tenants.default.http, "request", request)
+    monkeypatch.setattr(app, "start_webhook_workers", lambda: None)
+    return breakers
+
+
+def trip(breakers, salesforce, route):
+    """Fail calls on `route` until its breaker opens"""
+    salesforce.fail[route] = 503
+    while not breakers.is_open(route):
+        tenants.default.http.request("GET", INSTANCE_URL, route=route)
+    del salesforce.fail[route]
+    del salesforce.calls[:]
+
+
+def test_open_breaker_queues_webhooks(salesforce, breakers):
+    client = app.app.test_client()
+    trip(breakers, salesforce, "getByNPI")
+
+    response = client.post("/webhook/hubspot", json={"npi": NPI})
+
+    assert response.status_code == 202
+    assert response.get_json()["status"] == "accepted"
+    assert webhook_queue.depth()["pending"] == 1
+    assert salesforce.calls == []
+
+
+def test_open_breaker_serves_samples_from_the_stale_cache(salesforce, breakers):
+    salesforce.samples = [{"Name": "S-1"}, {"Name": "S-2"}]
+    first = date.today() - timedelta(days=20)
+    query = {"start": first.isoformat(), "end": (first + timedelta(days=6)).isoformat()}
+    client = app.app.test_client()
+    fresh = client.get("/api/samples", query_string=query)
+    assert fresh.status_code == 200
+    assert "X-Data-Source" not in fresh.headers
+
+    trip(breakers, salesforce, "samples")
+    response = client.get("/api/samples", query_string=dict(query, refresh="1"))
+
+    assert response.status_code == 200
+    assert response.headers["X-Data-Source"] == "stale-cache"
+    assert response.get_json() == fresh.get_json()
+
+
+def test_open_breaker_without_cached_samples_is_503(salesforce, breakers):
+    trip(breakers, salesforce, "samples")
+
+    response = app.app.test_client().get("/api/samples", query_string={"start": "2025-02-01", "end": "2025-02-07"})
+
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
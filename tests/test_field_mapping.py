@@ -0,0 +1,100 @@
+import pytest
+
+import app
+import field_mapping
+
+NPI = "1234567893"
+
+
+def transform(**fields):
+    return field_mapping.mapping.transform({"npi": NPI, **fields})
+
+
+def test_sources_are_mapped_to_salesforce_fields():
+    record, errors = transform(organization_name="  Mercy Clinic ", Email="x", email="Front@Mercy.ORG")
+
+    assert errors == []
+    assert record == {"NPI__c": NPI, "Healthcare_Organization_Name__c": "Mercy Clinic",
+                      "Secure_Email__c": "front@mercy.org"}
+
+
+def test_first_non_empty_source_wins():
+    record, _ = field_mapping.mapping.transform({"NPI__c": "", "npi": NPI, "City__c": "Salesforce", "city": "HubSpot"})
+
+    assert record["NPI__c"] == NPI
+    assert record["City__c"] == "Salesforce"
+
+
+@pytest.mark.parametrize("payload, error", [
+    ({}, "NPI is required"),
+    ({"npi": "   "}, "NPI must be 10 digits"),
+    ({"npi": "12345"}, "NPI must be 10 digits"),
+    ({"npi": NPI, "email": "not-an-email"}, "Secure_Email__c is not a valid email address"),
+    ({"npi": NPI, "city": True}, "City__c must be text, not a boolean"),
+    ({"npi": NPI, "city": {"name": "Springfield"}}, "City__c must be text, not an object or array"),
+    ({"npi": NPI, "city": "x" * 101}, "City__c is longer than 100 characters"),
+])
+def test_invalid_values_are_reported(payload, error):
+    _, errors = field_mapping.mapping.transform(payload)
+
+    assert errors == [error]
+
+
+@pytest.mark.parametrize("phone", ["(555) 123-4567", "+1 555 123 4567", "+44 20 7946 0958", "ext. 12", "n/a"])
+def test_phone_numbers_are_sent_as_given(phone):
+    record, errors = transform(phone=phone)
+
+    assert errors == []
+    assert record["Phone_Number__c"] == phone
+
+
+@pytest.mark.parametrize("zip_code, expected", [
+    ("12345", "12345"),
+    ("12345-6789", "12345-6789"),
+    ("123456789", "12345-6789"),
+    (2134, "02134"),
+])
+def test_us_zip_codes_are_normalised(zip_code, expected):
+    record, errors = transform(zip=zip_code)
+
+    assert errors == []
+    assert record["ZipCode__c"] == expected
+
+
+@pytest.mark.parametrize("country", [None, "", "US", "United States"])
+def test_invalid_us_zip_is_rejected(country):
+    _, errors = transform(zip="ABC 123", country=country)
+
+    assert errors == ["ZipCode__c must be a 5-digit or ZIP+4 code"]
+
+
+@pytest.mark.parametrize("country, zip_code", [("Canada", "K1A 0B1"), ("United Kingdom", "SW1A 1AA")])
+def test_zip_outside_the_us_is_kept(country, zip_code):
+    record, errors = transform(zip=zip_code, country=country)
+
+    assert errors == []
+    assert record["ZipCode__c"] == zip_code
+    assert record["Country__c"] == country
+
+
+def test_compile_rejects_invalid_specs():
+    with pytest.raises(ValueError, match="non-empty 'fields'"):
+        field_mapping.compile_mapping({"fields": {}})
+    with pytest.raises(ValueError, match="unknown type"):
+        field_mapping.compile_mapping({"fields": {"NPI__c": {"type": "uuid"}}})
+    with pytest.raises(ValueError, match="'sources' must be a list"):
+        field_mapping.compile_mapping({"fields": {"NPI__c": {"sources": "npi"}}})
+
+
+def test_non_object_batch_events_are_rejected_and_logged(salesforce, monkeypatch):
+    logged = []
+    monkeypatch.setattr(app.log_store, "write", logged.append)
+    client = app.app.test_client()
+
+    response = client.post("/webhook/hubspot", json=[{"npi": NPI}, "not an event"])
+
+    assert response.status_code == 207
+    first, second = response.get_json()["results"]
+    assert first["status_code"] == 201
+    assert (second["status_code"], second["message"]) == (400, "Event must be a JSON object")
+    assert [entry["received_data"] for entry in logged] == [{"npi": NPI}, "not an event"]
@@ -0,0 +1,51 @@
+import gzip
+
+import pytest
+
+import app
+import http_cache
+
+
+@pytest.fixture
+def samples(salesforce, monkeypatch):
+    monkeypatch.setattr(http_cache, "COMPRESS_MIN_BYTES", 100)
+    salesforce.samples = [{"Name": f"S-{i}", "Batch__c": "B-1"} for i in range(20)]
+    return {"start": "2025-01-01", "end": "2025-01-07"}
+
+
+def test_matching_etag_is_304_with_an_empty_body(samples):
+    client = app.app.test_client()
+    first = client.get("/api/samples", query_string=samples)
+    assert first.status_code == 200
+    assert first.get_json()["data"]
+
+    again = client.get("/api/samples", query_string=samples, headers={"If-None-Match": first.headers["ETag"]})
+
+    assert again.status_code == 304
+    assert again.data == b""
+    assert again.headers["ETag"] == first.headers["ETag"]
+
+
+def test_compressed_etag_matches_the_identity_body(samples):
+    client = app.app.test_client()
+    gzipped = client.get("/api/samples", query_string=samples, headers={"Accept-Encoding": "gzip"})
+    assert gzipped.headers["Content-Encoding"] == "gzip"
+    plain = client.get("/api/samples", query_string=samples)
+    assert gzip.decompress(gzipped.data) == plain.data
+
+    # A proxy may weaken the tag; the representation is still the same
+    again = client.get("/api/samples", query_string=samples,
+                       headers={"If-None-Match": "W/" + gzipped.headers["ETag"]})
+
+    assert (again.status_code, again.data) == (304, b"")
+
+
+def test_changed_body_is_sent_again(samples, salesforce):
+    client = app.app.test_client()
+    etag = client.get("/api/samples", query_string=samples).headers["ETag"]
+    salesforce.samples.append({"Name": "S-new", "Batch__c": "B-2"})
+
+    response = client.get("/api/samples", query_string=dict(samples, refresh="1"), headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
@@ -0,0 +1,55 @@
+import os
+import queue
+
+import pytest
+
+import log_store
+import metrics
+
+
+def dropped():
+    return sum(value for _, value in log_store.dropped_entries.snapshot())
+
+
+def test_entries_over_the_queue_limit_are_counted(monkeypatch):
+    monkeypatch.setattr(log_store, "_writer_pid", os.getpid())  # no writer draining the queue
+    monkeypatch.setattr(log_store, "_pending", queue.Queue(maxsize=1))
+    before = dropped()
+
+    for _ in range(3):
+        log_store.write({"status": "success"})
+
+    assert dropped() - before == 2
+    metrics.write_snapshot()
+    assert "mercybio_log_store_dropped_total " in metrics.render()
+
+
+def test_failed_batch_is_logged(monkeypatch):
+    errors = []
+    pending = queue.Queue()
+    pending.put(("", 0, {"status": "error"}))
+    gets = []
+
+    def get(timeout=None):
+        # The writer's first pass takes the entry and finds nothing more
+        gets.append(timeout)
+        if len(gets) > 2:
+            raise SystemExit
+        return queue.Queue.get(pending, timeout=timeout)
+
+    def write_batch(entries):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(pending, "get", get)
+    monkeypatch.setattr(log_store, "_pending", pending)
+    monkeypatch.setattr(log_store, "LOG_FLUSH_INTERVAL", 0)
+    monkeypatch.setattr(log_store, "_write_batch", write_batch)
+    monkeypatch.setattr(log_store.log, "error", lambda event, **fields: errors.append((event, fields)))
+
+    with pytest.raises(SystemExit):
+        log_store._writer_loop()
+
+    ((event, fields),) = errors
+    assert event == "log_store.write_failed"
+    assert isinstance(fields["exc_info"], RuntimeError)
+    assert fields["entries"] == 1
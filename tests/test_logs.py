@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+import app
+import log_store
+import tenants
+
+STREAMING = {"wsgi.multithread": True}
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def slots(tmp_path, monkeypatch):
+    """A host-wide cap of one open log stream"""
+    directory = tmp_path / "log_streams"
+    monkeypatch.setattr(app, "log_stream_slots", tenants.HostSlots(str(directory), 1))
+    return directory
+
+
+def write_logs(*actions):
+    log_store._write_batch([(time.time(), {"status": "success", "action": action}) for action in actions])
+
+
+def test_sync_workers_poll_for_new_entries(client):
+    write_logs("created")
+    after = log_store.latest_id()
+    write_logs("updated", "unchanged")
+
+    response = client.get(f"/logs/stream?after={after}")
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [e["action"] for e in body["data"]] == ["updated", "unchanged"]
+    assert body["after"] == log_store.latest_id()
+    assert client.get(f"/logs/stream?after={body['after']}").get_json()["data"] == []
+
+
+def test_threaded_workers_get_an_event_stream(client, slots):
+    response = client.get("/logs/stream", environ_overrides=STREAMING)
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    response.close()
+
+
+def test_streams_are_capped_across_workers(client, slots):
+    # Another worker on the host holds the only slot
+    other_worker = tenants.HostSlots(str(slots), 1)
+    assert other_worker.acquire() == 0
+
+    refused = client.get("/logs/stream", environ_overrides=STREAMING)
+
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"] == "10"
+
+    other_worker.release(0)
+    response = client.get("/logs/stream", environ_overrides=STREAMING)
+    assert response.status_code == 200
+    assert other_worker.acquire() is None
+    response.close()
+    assert other_worker.acquire() == 0
@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+import app
+import npi_index
+import sf_deadline
+import sf_limits
+
+NPI = "1234567893"
+
+
+def webhook(**fields):
+    return app.process_webhook({"npi": NPI, "organization_name": "Mercy Clinic", **fields})
+
+
+def test_new_npi_is_created_and_indexed(salesforce):
+    result, status = webhook()
+
+    assert status == 201
+    assert result["action"] == "created"
+    assert salesforce.routes() == ["getByNPI", "create"]
+    (record_id,) = salesforce.records
+    assert npi_index.lookup(NPI) == record_id
+
+
+def test_indexed_npi_is_updated_without_a_lookup(salesforce):
+    webhook()
+    salesforce.calls.clear()
+
+    result, status = webhook(city="Springfield")
+
+    assert status == 200
+    assert result["action"] == "updated"
+    assert salesforce.routes() == ["update"]
+
+
+def test_existing_record_is_found_by_npi_and_indexed(salesforce):
+    record_id = salesforce.add({"NPI__c": NPI})
+
+    result, status = webhook()
+
+    assert status == 200
+    assert result["record_id"] == record_id
+    assert salesforce.routes() == ["getByNPI", "update"]
+    assert npi_index.lookup(NPI) == record_id
+
+
+def test_deleted_record_is_recreated(salesforce):
+    webhook()
+    (stale_id,) = salesforce.records
+    del salesforce.records[stale_id]
+    salesforce.calls.clear()
+
+    result, status = webhook(city="Springfield")
+
+    assert status == 201
+    assert salesforce.routes() == ["update", "getByNPI", "create"]
+    (new_id,) = salesforce.records
+    assert new_id != stale_id
+    assert npi_index.lookup(NPI) == new_id
+    # The new record got the whole payload, not just the changed field
+    assert salesforce.records[new_id]["Healthcare_Organization_Name__c"] == "Mercy Clinic"
+
+
+def test_deleted_record_found_again_by_npi_gets_the_whole_payload(salesforce):
+    stale_id = salesforce.add({"NPI__c": NPI})
+    webhook()
+    del salesforce.records[stale_id]
+    record_id = salesforce.add({"NPI__c": NPI})
+    salesforce.calls.clear()
+
+    result, status = webhook(city="Springfield")
+
+    assert status == 200
+    assert result["record_id"] == record_id
+    assert salesforce.routes() == ["update", "getByNPI", "update"]
+    assert set(salesforce.calls[-1][3]) == {"NPI__c", "Healthcare_Organization_Name__c", "City__c"}
+
+
+def test_failed_create_releases_the_claim(salesforce):
+    salesforce.fail["create"] = 500
+
+    result, status = webhook()
+
+    assert status == 500
+    assert result["action"] == "create_failed"
+    assert npi_index.claim_create(NPI)
+
+
+def test_create_claimed_elsewhere_waits_for_its_id(salesforce):
+    assert npi_index.claim_create(NPI)
+    record_id = salesforce.add({"NPI__c": "0000000000"})
+    threading.Timer(0.2, npi_index.store, (NPI, record_id)).start()
+
+    result, status = webhook()
+
+    assert status == 200
+    assert result["record_id"] == record_id
+    assert "create" not in salesforce.routes()
+
+
+def test_create_claimed_elsewhere_past_the_deadline_is_shed(salesforce):
+    assert npi_index.claim_create(NPI)
+
+    with sf_deadline.deadline(0.3):
+        result, status = webhook()
+
+    assert status == 503
+    assert result["retry_after"] >= 1
+    assert "create" not in salesforce.routes()
+    # The claim is still the other worker's
+    assert not npi_index.claim_create(NPI)
+
+
+def test_queued_job_is_deferred_while_a_create_is_pending(salesforce):
+    assert npi_index.claim_create(NPI)
+
+    with sf_deadline.deadline(0.3), pytest.raises(sf_limits.Overloaded) as e:
+        app.run_webhook_job({"npi": NPI})
+
+    assert e.value.retry_after >= 1
@@ -0,0 +1,78 @@
+import pytest
+
+import app
+import org_replica
+
+
+@pytest.fixture
+def replica(salesforce, monkeypatch):
+    """A replica that counts as fresh, synced only when a test says so"""
+    monkeypatch.setattr(org_replica, "REPLICA_SYNC_INTERVAL", 60)
+    monkeypatch.setattr(app, "start_replica_sync", lambda tenant: None)
+    # Fields outside field_mapping.json, and mapped fields the Apex API left out
+    salesforce.add({"attributes": {"type": "Account"}, "NPI__c": "1234567893", "City__c": "Springfield",
+                    "Region__c": "Midwest", "Phone_Number__c": None})
+    salesforce.add({"NPI__c": "1245319599", "Healthcare_Organization_Name__c": "Mercy North", "Beds__c": 40})
+    org_replica.full_load(app.replica_full_load())
+    return salesforce
+
+
+def all_records(client, **args):
+    response = client.get("/api/all", query_string=args)
+    assert response.status_code == 200
+    return response.headers["X-Data-Source"], sorted(response.get_json()["data"], key=lambda r: r["Id"])
+
+
+def test_replica_serves_the_same_records_as_salesforce(replica):
+    client = app.app.test_client()
+
+    source, served = all_records(client)
+    live_source, live = all_records(client, live="1")
+
+    assert (source, live_source) == ("replica", "salesforce")
+    assert served == live
+
+
+def test_delta_is_applied_onto_the_whole_record(replica):
+    record_id = next(iter(replica.records))
+    replica.records[record_id].update(City__c="Shelbyville", Phone_Number__c="555-123-4567")
+    # A SOQL row: the selected fields only, null where unset
+    org_replica.apply_changes([{"attributes": {"type": "Account"}, "Id": record_id, "IsDeleted": False,
+                                "LastModifiedDate": "2026-01-01T00:00:00.000+0000", "NPI__c": "1234567893",
+                                "City__c": "Shelbyville", "Phone_Number__c": "555-123-4567", "State__c": None}])
+
+    client = app.app.test_client()
+    assert org_replica.is_complete()
+    assert all_records(client)[1] == all_records(client, live="1")[1]
+
+
+def test_new_record_in_a_delta_is_fetched_whole(replica):
+    record_id = replica.add({"NPI__c": "1982739404", "City__c": "Ogdenville", "Region__c": "West"})
+    change = {"Id": record_id, "NPI__c": "1982739404", "City__c": "Ogdenville", "IsDeleted": False}
+
+    org_replica.apply_changes([change], app.replica_record)
+
+    client = app.app.test_client()
+    assert org_replica.is_complete()
+    assert all_records(client) == ("replica", all_records(client, live="1")[1])
+
+
+def test_unmergeable_change_sends_api_all_to_salesforce(replica):
+    record_id = replica.add({"NPI__c": "1982739404", "City__c": "Ogdenville"})
+
+    org_replica.apply_changes([{"Id": record_id, "NPI__c": "1982739404", "IsDeleted": False}])
+
+    assert not org_replica.is_complete()
+    assert org_replica.lookup_npi("1982739404") == record_id
+    assert all_records(app.app.test_client())[0] == "salesforce"
+
+    org_replica.full_load(app.replica_full_load())
+    assert org_replica.is_complete()
+
+
+def test_replica_of_an_older_format_is_reloaded(replica):
+    conn = org_replica._db()
+    conn.execute("DELETE FROM replica_meta WHERE key = 'record_format'")
+
+    assert not org_replica.is_complete()
+    assert org_replica._due(org_replica._meta(), lambda since: [], False, 0) == "full"
@@ -0,0 +1,104 @@
+import asyncio
+from datetime import date, timedelta
+
+import pytest
+
+import samples_cache
+
+
+class Apex:
+    """getSamplesForNonInternalBatches: one sample per day, every call in `calls`"""
+
+    def __init__(self, day_field=None):
+        self.day_field = day_field
+        self.calls = []
+
+    def __call__(self, first_day, last_day):
+        self.calls.append((first_day, last_day))
+        days = samples_cache.days_between(first_day, last_day)
+        return [{"Name": f"S-{day}", **({self.day_field: day} if self.day_field else {})} for day in days]
+
+
+def past_days(n):
+    first = date.today() - timedelta(days=n + 10)
+    return first.isoformat(), (first + timedelta(days=n - 1)).isoformat()
+
+
+@pytest.fixture
+def day_field(monkeypatch):
+    monkeypatch.setattr(samples_cache, "SAMPLES_DAY_FIELD", "Collected__c")
+    return "Collected__c"
+
+
+def test_cold_range_without_day_field_is_one_call():
+    apex = Apex()
+    start, end = past_days(30)
+
+    samples = samples_cache.get_range(start, end, apex)
+
+    assert apex.calls == [(start, end)]
+    assert len(samples) == 30
+    assert samples_cache.get_range(start, end, apex) == samples
+    assert len(apex.calls) == 1
+
+
+def test_long_range_without_day_field_is_one_call():
+    apex = Apex()
+    start, end = past_days(90)
+
+    assert len(samples_cache.get_range(start, end, apex)) == 90
+    assert apex.calls == [(start, end)]
+
+
+def test_unsplit_range_serves_the_stale_fallback():
+    start, end = past_days(30)
+    samples = samples_cache.get_range(start, end, Apex())
+
+    assert samples_cache.get_cached_range(start, end) == samples
+    # Only that exact range was cached
+    assert samples_cache.get_cached_range(start, samples_cache.days_between(start, end)[10]) is None
+
+
+def test_failed_call_is_not_cached():
+    start, end = past_days(10)
+
+    assert samples_cache.get_range(start, end, lambda first, last: False) is False
+    assert samples_cache.get_cached_range(start, end) is None
+
+
+def test_day_field_splits_runs_into_reusable_days(day_field):
+    apex = Apex(day_field)
+    start, end = past_days(40)
+
+    assert len(samples_cache.get_range(start, end, apex)) == 40
+    assert len(apex.calls) == 2
+
+    days = samples_cache.days_between(start, end)
+    assert [s["Name"] for s in samples_cache.get_range(days[5], days[20], apex)] == \
+        [f"S-{day}" for day in days[5:21]]
+    assert len(apex.calls) == 2
+
+
+def test_run_without_day_field_values_is_cached_whole(day_field):
+    apex = Apex()
+    start, end = past_days(20)
+
+    samples = samples_cache.get_range(start, end, apex)
+    again = samples_cache.get_range(start, end, apex)
+
+    assert again == samples
+    assert apex.calls == [(start, end)]
+    assert samples_cache.stats()["split_fallbacks"] >= 1
+
+
+def test_async_cold_range_is_one_call():
+    apex = Apex()
+    start, end = past_days(30)
+
+    async def fetch_range(first_day, last_day):
+        return apex(first_day, last_day)
+
+    samples = asyncio.run(samples_cache.get_range_async(start, end, fetch_range))
+
+    assert len(samples) == 30
+    assert apex.calls == [(start, end)]
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+import app
+import tenants
+from conftest import API_PATH, INSTANCE_URL, FakeSalesforce
+from sf_auth import TokenManager
+
+THREADS = 8
+
+
+@pytest.fixture
+def salesforce(tmp_path, monkeypatch):
+    """A FakeSalesforce behind the default tenant's real token manager.
+
+    Minting is slow enough for concurrent callers to overlap.
+    """
+    fake = FakeSalesforce()
+    tenant = tenants.default
+
+    def request(method, url, route=None, **kwargs):
+        if route == "token":
+            time.sleep(0.05)
+        return fake.request(method, url, route=route, **kwargs)
+
+    monkeypatch.setattr(tenant.http, "request", request)
+    monkeypatch.setattr(tenant, "_signing_key", "private-key")
+    monkeypatch.setattr(tenants, "build_jwt", lambda *args: "signed-jwt")
+    monkeypatch.setattr(tenant, "token_manager", TokenManager(
+        tenant.request_access_token, cache_path=str(tmp_path / "token.json")))
+    with tenants.use(tenant):
+        yield fake
+
+
+def in_threads(target):
+    """Run `target` on THREADS threads started together; their results"""
+    start = threading.Barrier(THREADS)
+    results = [None] * THREADS
+
+    def run(i):
+        with tenants.use(tenants.default):
+            start.wait()
+            results[i] = target()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_concurrent_callers_mint_one_token(salesforce):
+    results = in_threads(app.jwt_authenticate_HUB)
+
+    assert results == [("token-1", INSTANCE_URL)] * THREADS
+    assert salesforce.routes() == ["token"]
+
+
+def test_workers_share_the_minted_token(salesforce, tmp_path):
+    # Another worker on the host, same cache file
+    other_worker = TokenManager(tenants.default.request_access_token, cache_path=str(tmp_path / "token.json"))
+
+    assert app.jwt_authenticate_HUB() == other_worker.get() == ("token-1", INSTANCE_URL)
+    assert salesforce.routes() == ["token"]
+
+
+def test_rejected_token_is_refreshed_once(salesforce):
+    access_token, instance_url = app.jwt_authenticate_HUB()
+    salesforce.revoked.add(access_token)
+
+    def read():
+        headers = {"Authorization": f"Bearer {access_token}"}
+        response = app.get(API_PATH, headers, instance_url, route="getAll")
+        return response.status_code, headers["Authorization"]
+
+    results = in_threads(read)
+
+    assert results == [(200, "Bearer token-2")] * THREADS
+    assert salesforce.routes().count("token") == 2
+    assert salesforce.routes().count("getAll") == 2 * THREADS
+
+
+def test_refresh_keeps_a_token_someone_else_replaced(salesforce):
+    app.jwt_authenticate_HUB()
+    fresh = app.jwt_authenticate_HUB(stale_token="token-1")
+
+    # A late 401 for token-1 must not throw token-2 away
+    assert app.jwt_authenticate_HUB(stale_token="token-1") == fresh == ("token-2", INSTANCE_URL)
+    assert salesforce.routes().count("token") == 2
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+from sf_limits import HIGH, LOW, NORMAL, AdaptiveLimiter, Overloaded
+
+WAITS = {HIGH: 0.05, NORMAL: 0.05, LOW: 0.05}
+
+
+def limiter(initial=2, **kwargs):
+    return AdaptiveLimiter(initial=initial, minimum=1, maximum=4, waits=WAITS, **kwargs)
+
+
+def test_limit_grows_by_one_over_limit_at_capacity():
+    limits = limiter()
+    started = [limits.acquire(NORMAL), limits.acquire(NORMAL)]
+
+    limits.release(started[0])
+    assert limits.limit == 2.5
+    # Below capacity: no signal to grow on
+    limits.release(started[1])
+    assert limits.limit == 2.5
+
+
+def test_overload_cuts_the_limit_and_cools_down():
+    limits = limiter(initial=4)
+
+    limits.release(limits.acquire(NORMAL), overloaded=True, retry_after=5)
+
+    assert limits.limit == pytest.approx(2.8)
+    assert limits.stats()["cooldown_s"] > 4
+    assert limits.try_acquire(HIGH) is None
+
+
+def test_burst_of_overloads_is_one_decrease():
+    limits = limiter(initial=4)
+    started = [limits.acquire(NORMAL) for _ in range(3)]
+
+    for s in started:
+        limits.release(s, overloaded=True, retry_after=0.01)
+
+    assert limits.limit == pytest.approx(2.8)
+    assert limits.stats()["decreases"] == 1
+
+
+def test_limit_never_drops_below_the_minimum():
+    limits = limiter(initial=1)
+
+    limits.release(limits.acquire(NORMAL), overloaded=True, retry_after=0.01)
+
+    assert limits.limit == 1
+
+
+def test_cooldown_sheds_low_priority_at_once():
+    limits = limiter()
+    limits.release(limits.acquire(NORMAL), overloaded=True, retry_after=5)
+
+    with pytest.raises(Overloaded) as shed:
+        limits.acquire(LOW)
+    assert shed.value.retry_after == 5
+    assert limits.stats()["shed"] == 1
+
+
+def test_full_limiter_sheds_once_the_wait_budget_is_spent():
+    limits = limiter(initial=1)
+    limits.acquire(HIGH)
+
+    with pytest.raises(Overloaded):
+        limits.acquire(HIGH)
+    assert limits.stats()["in_flight"] == 1
+
+
+@pytest.mark.parametrize("usage, shed, admitted", [
+    ("api-usage=85/100", [LOW], [NORMAL, HIGH]),
+    ("api-usage=96/100", [LOW, NORMAL], [HIGH]),
+    ("api-usage=100/100", [LOW, NORMAL, HIGH], []),
+])
+def test_quota_sheds_low_priority_first(usage, shed, admitted):
+    limits = limiter()
+    limits.note_usage(usage)
+
+    for level in shed:
+        with pytest.raises(Overloaded):
+            limits.acquire(level)
+    for level in admitted:
+        limits.release(limits.acquire(level))
+
+
+def test_waiting_high_priority_call_goes_first():
+    limits = AdaptiveLimiter(initial=1, minimum=1, maximum=1, waits={HIGH: 5, NORMAL: 5, LOW: 5})
+    started = limits.acquire(NORMAL)
+    order = []
+
+    def wait(level, name):
+        waiter = threading.Thread(target=lambda: order.append((name, limits.acquire(level))))
+        waiter.start()
+        while limits.stats()["waiting"][name] == 0:
+            time.sleep(0.001)
+        return waiter
+
+    # The normal call has waited longer
+    waiters = [wait(NORMAL, "normal"), wait(HIGH, "high")]
+
+    limits.release(started)
+    waiters[1].join(5)
+    assert [name for name, _ in order] == ["high"]
+
+    limits.release(order[0][1])
+    waiters[0].join(5)
+    assert [name for name, _ in order] == ["high", "normal"]
@@ -0,0 +1,107 @@
+import pytest
+
+import app
+
+NPI = "1234567893"
+PAYLOAD = {"npi": NPI, "organization_name": "Mercy Clinic", "city": "Springfield"}
+
+
+@pytest.fixture
+def client(salesforce):
+    return app.app.test_client()
+
+
+def test_resent_payload_skips_salesforce(salesforce):
+    app.process_webhook(PAYLOAD)
+    salesforce.calls.clear()
+
+    result, status = app.process_webhook(dict(PAYLOAD))
+
+    assert status == 200
+    assert result["action"] == "unchanged"
+    assert salesforce.calls == []
+
+
+def test_update_sends_only_changed_fields(salesforce):
+    app.process_webhook(PAYLOAD)
+    salesforce.calls.clear()
+
+    result, status = app.process_webhook(dict(PAYLOAD, city="Shelbyville"))
+
+    assert status == 200
+    assert result["changed_fields"] == ["City__c"]
+    ((route, _, _, body),) = salesforce.calls
+    assert (route, body) == ("update", {"City__c": "Shelbyville"})
+
+
+def test_failed_update_is_sent_again(salesforce):
+    app.process_webhook(PAYLOAD)
+    salesforce.fail["update"] = 500
+    assert app.process_webhook(dict(PAYLOAD, city="Shelbyville"))[1] == 500
+    del salesforce.fail["update"]
+    salesforce.calls.clear()
+
+    result, status = app.process_webhook(dict(PAYLOAD, city="Shelbyville"))
+
+    assert status == 200
+    assert result["action"] == "updated"
+    assert salesforce.routes() == ["update"]
+
+
+def test_idempotency_key_replays_the_first_answer(client, salesforce):
+    headers = {"Idempotency-Key": "delivery-1"}
+    first = client.post("/webhook/hubspot", json=PAYLOAD, headers=headers)
+    calls = len(salesforce.calls)
+
+    again = client.post("/webhook/hubspot", json=dict(PAYLOAD, city="Shelbyville"), headers=headers)
+
+    assert first.status_code == again.status_code == 201
+    assert "Idempotent-Replayed" not in first.headers
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.get_json() == first.get_json()
+    assert len(salesforce.calls) == calls
+
+
+def test_event_id_is_an_idempotency_key(client, salesforce):
+    client.post("/webhook/hubspot", json=dict(PAYLOAD, eventId=42))
+
+    again = client.post("/webhook/hubspot", json=dict(PAYLOAD, eventId=42, city="Shelbyville"))
+
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert salesforce.records[next(iter(salesforce.records))]["City__c"] == "Springfield"
+
+
+def test_transient_failure_releases_the_key(client, salesforce):
+    headers = {"Idempotency-Key": "delivery-1"}
+    salesforce.fail["create"] = 503
+    assert client.post("/webhook/hubspot", json=PAYLOAD, headers=headers).status_code == 503
+    del salesforce.fail["create"]
+
+    retried = client.post("/webhook/hubspot", json=PAYLOAD, headers=headers)
+
+    assert retried.status_code == 201
+    assert "Idempotent-Replayed" not in retried.headers
+
+
+def test_rejected_delivery_is_replayed(client, salesforce):
+    headers = {"Idempotency-Key": "delivery-1"}
+    salesforce.fail["create"] = 400
+    assert client.post("/webhook/hubspot", json=PAYLOAD, headers=headers).status_code == 400
+    del salesforce.fail["create"]
+
+    again = client.post("/webhook/hubspot", json=PAYLOAD, headers=headers)
+
+    assert again.status_code == 400
+    assert again.headers["Idempotent-Replayed"] == "true"
+
+
+def test_batch_events_are_replayed_by_event_id(client, salesforce):
+    events = [dict(PAYLOAD, eventId=1), dict(PAYLOAD, eventId=2, npi="1245319599")]
+    assert client.post("/webhook/hubspot", json=events).status_code == 200
+    calls = len(salesforce.calls)
+
+    again = client.post("/webhook/hubspot", json=events)
+
+    assert again.status_code == 200
+    assert [r["replayed"] for r in again.get_json()["results"]] == [True, True]
+    assert len(salesforce.calls) == calls
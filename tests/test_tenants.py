@@ -0,0 +1,38 @@
+import sf_http
+import tenants
+
+
+def test_host_slots_refuse_once_the_cap_is_reached(tmp_path):
+    slots = tenants.HostSlots(str(tmp_path / "slots"), 2)
+
+    assert {slots.acquire(), slots.acquire()} == {0, 1}
+    assert slots.acquire() is None
+
+    slots.release(1)
+    assert slots.acquire() == 1
+
+
+def test_host_slots_are_shared_across_workers(tmp_path):
+    # Two instances on one directory stand in for two worker processes
+    worker, other_worker = (tenants.HostSlots(str(tmp_path / "slots"), 1) for _ in range(2))
+
+    assert worker.acquire() == 0
+    assert other_worker.acquire() is None
+
+    worker.release(0)
+    assert other_worker.acquire() == 0
+    assert worker.acquire() is None
+
+
+def test_tenant_in_flight_cap_is_host_wide():
+    worker, other_worker = (tenants.Tenant("acme", scope="acme", http=sf_http.client, max_in_flight=1)
+                            for _ in range(2))
+
+    ticket = worker.enter()
+    assert ticket == 0
+    assert other_worker.enter() is None
+    assert other_worker.stats()["rejected"] == 1
+
+    worker.leave(ticket)
+    assert other_worker.enter() == 0
+    assert worker.stats()["in_flight"] == 0
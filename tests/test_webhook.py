@@ -0,0 +1,52 @@
+import pytest
+
+import app
+import sf_limits
+import tenants
+import webhook_queue
+
+NPI = "1234567893"
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    """Calls to start the queue workers, none actually started"""
+    started = []
+    monkeypatch.setattr(app, "start_webhook_workers", lambda: started.append(True))
+    return started
+
+
+@pytest.fixture
+def shedding(salesforce, monkeypatch):
+    """A limiter that refuses every Salesforce call"""
+    def request(method, url, route=None, **kwargs):
+        raise sf_limits.Overloaded(f"Too many Salesforce {route} calls in flight", 2)
+
+    monkeypatch.setattr(tenants.default.http, "request", request)
+    return salesforce
+
+
+def test_shed_webhook_is_queued(shedding, workers):
+    response = app.app.test_client().post("/webhook/hubspot", json={"npi": NPI})
+
+    assert response.status_code == 202
+    assert response.get_json()["status"] == "accepted"
+    (job_id, payload, _), = webhook_queue.claim()
+    assert (job_id, payload) == (response.get_json()["job_id"], {"npi": NPI})
+    assert workers
+
+
+def test_shed_invalid_webhook_is_still_rejected(shedding, workers):
+    response = app.app.test_client().post("/webhook/hubspot", json={"npi": "123"})
+
+    assert response.status_code == 400
+    assert webhook_queue.depth()["pending"] == 0
+
+
+def test_shed_queue_job_is_retried(shedding, workers):
+    # The workers must not queue their own payload again
+    with pytest.raises(sf_limits.Overloaded) as shed:
+        app.run_webhook_job({"npi": NPI})
+
+    assert shed.value.retry_after == 2
+    assert webhook_queue.depth()["pending"] == 0
@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+import sf_limits
+import webhook_queue
+
+
+class Pool:
+    def __init__(self, handler):
+        self.handler = handler
+
+
+def raise_(error):
+    def handler(payload):
+        raise error
+    return handler
+
+
+def available_in(job_id):
+    row = webhook_queue._db().execute("SELECT available_at FROM webhook_jobs WHERE id = ?", (job_id,)).fetchone()
+    return row["available_at"] - time.time()
+
+
+def run_next(handler):
+    (job_id, payload, attempts), = webhook_queue.claim()
+    webhook_queue._run_job(Pool(handler), job_id, payload, attempts)
+    return job_id
+
+
+def test_claimed_job_is_acked_after_success():
+    seen = []
+    job_id = webhook_queue.enqueue({"npi": "1234567893"})
+
+    assert webhook_queue.depth()["pending"] == 1
+    assert run_next(seen.append) == job_id
+    assert seen == [{"npi": "1234567893"}]
+    assert webhook_queue.depth() == {"pending": 0, "running": 0, "dead": 0}
+
+
+def test_claimed_job_is_leased():
+    webhook_queue.enqueue({"npi": "1234567893"})
+
+    assert len(webhook_queue.claim()) == 1
+    assert webhook_queue.claim() == []
+    assert webhook_queue.depth()["running"] == 1
+
+
+def test_failed_job_is_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr(webhook_queue, "WEBHOOK_RETRY_BACKOFF", 10)
+    job_id = webhook_queue.enqueue({"npi": "1234567893"})
+
+    run_next(raise_(RuntimeError("Salesforce returned 500")))
+
+    assert webhook_queue.depth()["pending"] == 1
+    assert webhook_queue.claim() == []
+    assert 9 < available_in(job_id) <= 10
+
+    webhook_queue._db().execute("UPDATE webhook_jobs SET available_at = 0")
+    run_next(raise_(RuntimeError("Salesforce returned 500")))
+    assert 19 < available_in(job_id) <= 20
+
+
+def test_overloaded_job_waits_at_least_retry_after(monkeypatch):
+    monkeypatch.setattr(webhook_queue, "WEBHOOK_RETRY_BACKOFF", 1)
+    job_id = webhook_queue.enqueue({"npi": "1234567893"})
+
+    run_next(raise_(sf_limits.Overloaded("shed", 30)))
+
+    assert webhook_queue.depth()["pending"] == 1
+    assert 29 < available_in(job_id) <= 30
+
+
+def test_job_is_dead_lettered_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(webhook_queue, "WEBHOOK_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(webhook_queue, "WEBHOOK_MAX_ATTEMPTS", 3)
+    job_id = webhook_queue.enqueue({"npi": "1234567893"})
+
+    for _ in range(3):
+        run_next(raise_(RuntimeError("Salesforce returned 500")))
+
+    assert webhook_queue.claim() == []
+    (dead,) = webhook_queue.dead_letters()
+    assert dead["id"] == job_id
+    assert dead["attempts"] == 3
+    assert dead["last_error"] == "Salesforce returned 500"
+
+
+def test_permanent_error_is_dead_lettered_at_once():
+    webhook_queue.enqueue({"npi": "1234567893"})
+
+    run_next(raise_(webhook_queue.PermanentJobError("NPI must be 10 digits")))
+
+    assert webhook_queue.depth() == {"pending": 0, "running": 0, "dead": 1}
+    assert webhook_queue.dead_letters()[0]["last_error"] == "NPI must be 10 digits"
+
+
+@pytest.mark.parametrize("ids", [None, "first"])
+def test_replay_requeues_dead_letters(ids):
+    first = webhook_queue.enqueue({"npi": "1234567893"})
+    webhook_queue.enqueue({"npi": "1245319599"})
+    for _ in range(2):
+        run_next(raise_(webhook_queue.PermanentJobError("rejected")))
+
+    replayed = webhook_queue.replay([first] if ids else None)
+
+    assert replayed == (1 if ids else 2)
+    assert webhook_queue.depth()["dead"] == 2 - replayed
+    jobs = webhook_queue.claim(10)
+    assert len(jobs) == replayed
+    assert all(attempts == 1 for _, _, attempts in jobs)
+
+
+def test_batch_outcomes_are_acked_retried_or_dead_lettered(monkeypatch):
+    monkeypatch.setattr(webhook_queue, "WEBHOOK_RETRY_BACKOFF", 1)
+    ok, retry, dead = (webhook_queue.enqueue({"n": n}) for n in range(3))
+    pool = Pool(None)
+    pool.batch_handler = lambda jobs: {
+        ok: None,
+        retry: sf_limits.Overloaded("shed", 60),
+        dead: webhook_queue.PermanentJobError("rejected"),
+    }
+
+    webhook_queue._run_batch(pool, webhook_queue.claim(10))
+
+    assert webhook_queue.depth() == {"pending": 1, "running": 0, "dead": 1}
+    assert 59 < available_in(retry) <= 60
+    assert webhook_queue.dead_letters()[0]["id"] == dead
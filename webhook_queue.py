@@ -0,0 +1,294 @@
+"""Durable webhook queue backed by SQLite, drained by background worker threads.
+
+Delivery is at-least-once: a claimed job is leased, and if its worker dies
+before acknowledging it the lease expires and another worker picks it up.
+Jobs that keep failing, or fail permanently, are parked as dead letters until
+they are replayed. Every storage scope (tenant) has its own queue and its
+own pool of workers.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+
+import app_logging
+import sf_limits
+import storage
+
+DB_NAME = "webhook_queue.db"
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))  # threads per process
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", 8))
+WEBHOOK_LEASE = float(os.environ.get("WEBHOOK_LEASE", 120))  # seconds a claimed job stays hidden
+WEBHOOK_POLL_INTERVAL = float(os.environ.get("WEBHOOK_POLL_INTERVAL", 0.5))  # seconds
+WEBHOOK_RETRY_BACKOFF = float(os.environ.get("WEBHOOK_RETRY_BACKOFF", 2))  # seconds, doubles per attempt
+WEBHOOK_RETRY_BACKOFF_MAX = float(os.environ.get("WEBHOOK_RETRY_BACKOFF_MAX", 300))  # seconds
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", 1000))  # jobs per coalesced batch
+
+
+log = app_logging.get_logger("webhook_queue")
+
+
+class PermanentJobError(Exception):
+    """Raised by a job handler when retrying the job can never succeed"""
+
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS webhook_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL,
+        created_at REAL NOT NULL,
+        last_error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_webhook_jobs_ready ON webhook_jobs(status, available_at);
+"""
+
+
+def _db():
+    return storage.connect(DB_NAME, SCHEMA)
+
+
+def enqueue(payload):
+    """Persist a payload and return its job id"""
+    now = time.time()
+    cursor = _db().execute(
+        "INSERT INTO webhook_jobs (payload, available_at, created_at) VALUES (?, ?, ?)",
+        (json.dumps(payload), now, now),
+    )
+    _pool().wakeup.set()
+    return cursor.lastrowid
+
+
+def claim(limit=1):
+    """Lease up to `limit` ready jobs; returns a list of (id, payload, attempts)"""
+    conn = _db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT id, payload, attempts FROM webhook_jobs "
+            "WHERE status IN ('pending', 'running') AND available_at <= ? ORDER BY id LIMIT ?",
+            (now, limit),
+        ).fetchall()
+        if rows:
+            conn.executemany(
+                "UPDATE webhook_jobs SET status = 'running', attempts = attempts + 1, available_at = ? WHERE id = ?",
+                [(now + WEBHOOK_LEASE, row["id"]) for row in rows],
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return [(row["id"], json.loads(row["payload"]), row["attempts"] + 1) for row in rows]
+
+
+def ack(job_id):
+    _db().execute("DELETE FROM webhook_jobs WHERE id = ?", (job_id,))
+
+
+def fail(job_id, attempts, error, permanent=False, retry_after=None):
+    """Schedule a retry with backoff (at least `retry_after` seconds), or dead-letter the job"""
+    if permanent or attempts >= WEBHOOK_MAX_ATTEMPTS:
+        _db().execute(
+            "UPDATE webhook_jobs SET status = 'dead', last_error = ? WHERE id = ?",
+            (error, job_id),
+        )
+        return
+    delay = max(min(WEBHOOK_RETRY_BACKOFF * (2 ** (attempts - 1)), WEBHOOK_RETRY_BACKOFF_MAX), retry_after or 0)
+    _db().execute(
+        "UPDATE webhook_jobs SET status = 'pending', available_at = ?, last_error = ? WHERE id = ?",
+        (time.time() + delay, error, job_id),
+    )
+
+
+def dead_letters(limit=100):
+    rows = _db().execute(
+        "SELECT id, payload, attempts, created_at, last_error FROM webhook_jobs "
+        "WHERE status = 'dead' ORDER BY id DESC LIMIT ?",
+        (limit,),
+    ).fetchall()
+    return [
+        {
+            "id": row["id"],
+            "payload": json.loads(row["payload"]),
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "last_error": row["last_error"],
+        }
+        for row in rows
+    ]
+
+
+def replay(ids=None):
+    """Move dead letters (all, or just `ids`) back onto the queue"""
+    sql = "UPDATE webhook_jobs SET status = 'pending', attempts = 0, available_at = ? WHERE status = 'dead'"
+    params = [time.time()]
+    if ids:
+        sql += f" AND id IN ({','.join('?' * len(ids))})"
+        params.extend(ids)
+    count = _db().execute(sql, params).rowcount
+    if count:
+        _pool().wakeup.set()
+    return count
+
+
+def depth():
+    """Number of jobs per status"""
+    rows = _db().execute("SELECT status, COUNT(*) AS n FROM webhook_jobs GROUP BY status").fetchall()
+    counts = {"pending": 0, "running": 0, "dead": 0}
+    counts.update({row["status"]: row["n"] for row in rows})
+    return counts
+
+
+class _Pool:
+    """Worker threads draining the queue of one storage scope"""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.wakeup = threading.Event()
+        self.workers = []
+        self.handler = None
+        self.batch_handler = None
+        self.batch_window = 0
+
+
+_pools = {}  # storage scope -> _Pool
+_pools_lock = threading.Lock()
+
+
+def _pool(scope=None):
+    scope = storage.current_scope() if scope is None else scope
+    pool = _pools.get(scope)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(scope, _Pool(scope))
+    return pool
+
+
+def _run_job(pool, job_id, payload, attempts):
+    try:
+        pool.handler(payload)
+    except PermanentJobError as e:
+        fail(job_id, attempts, str(e), permanent=True)
+    except sf_limits.Overloaded as e:
+        # Shed, breaker open, out of time: expected while Salesforce struggles
+        log.warning("webhook_queue.job_deferred", job_id=job_id, attempts=attempts,
+                    message=str(e), retry_after=e.retry_after)
+        fail(job_id, attempts, str(e), retry_after=e.retry_after)
+    except Exception as e:
+        log.error("webhook_queue.job_failed", exc_info=e, job_id=job_id, attempts=attempts)
+        fail(job_id, attempts, str(e))
+    else:
+        ack(job_id)
+
+
+def _claim_batch(pool):
+    """Claim jobs for up to the pool's batch window after the first one arrives"""
+    jobs = claim(WEBHOOK_BATCH_SIZE)
+    if not jobs:
+        return jobs
+    deadline = time.time() + pool.batch_window
+    while len(jobs) < WEBHOOK_BATCH_SIZE and time.time() < deadline:
+        pool.wakeup.wait(min(WEBHOOK_POLL_INTERVAL, max(deadline - time.time(), 0)))
+        pool.wakeup.clear()
+        jobs.extend(claim(WEBHOOK_BATCH_SIZE - len(jobs)))
+    return jobs
+
+
+def _run_batch(pool, jobs):
+    attempts = {job_id: n for job_id, _, n in jobs}
+    try:
+        outcomes = pool.batch_handler([(job_id, payload) for job_id, payload, _ in jobs])
+    except sf_limits.Overloaded as e:
+        log.warning("webhook_queue.batch_deferred", jobs=len(jobs), message=str(e), retry_after=e.retry_after)
+        outcomes = {job_id: e for job_id in attempts}
+    except Exception as e:
+        log.error("webhook_queue.batch_failed", exc_info=e, jobs=len(jobs))
+        outcomes = {job_id: e for job_id in attempts}
+    for job_id, n in attempts.items():
+        error = outcomes.get(job_id)
+        if error is None:
+            ack(job_id)
+        else:
+            fail(job_id, n, str(error), permanent=isinstance(error, PermanentJobError),
+                 retry_after=getattr(error, "retry_after", None))
+
+
+def _drain_batch(pool):
+    """Claim and flush one batch while holding the host-wide batch lock.
+
+    Batches are flushed one at a time in job order, so a later update for an
+    NPI can never be overwritten by an earlier batch finishing last.
+    """
+    directory = storage.state_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "webhook_batch.lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            jobs = _claim_batch(pool)
+            if jobs:
+                _run_batch(pool, jobs)
+            return bool(jobs)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _worker_loop(pool):
+    storage.set_scope(pool.scope)
+    while True:
+        try:
+            if pool.batch_handler:
+                found = _drain_batch(pool)
+            else:
+                jobs = claim()
+                for job_id, payload, attempts in jobs:
+                    _run_job(pool, job_id, payload, attempts)
+                found = bool(jobs)
+        except Exception as e:
+            log.error("webhook_queue.worker_error", exc_info=e)
+            found = False
+        if not found:
+            pool.wakeup.wait(WEBHOOK_POLL_INTERVAL)
+            pool.wakeup.clear()
+
+
+def start_workers(handler, count=WEBHOOK_WORKERS, batch_handler=None, batch_window=0):
+    """Start `count` daemon threads that feed queued payloads to `handler`.
+
+    The workers drain the queue of the current storage scope; the handlers
+    run in their threads, so they must not rely on the caller's context.
+    `handler` raises PermanentJobError to dead-letter a job and any other
+    exception to retry it later. With `batch_handler`, workers instead collect
+    jobs for `batch_window` seconds and pass them as a list of
+    (job_id, payload); it returns {job_id: None | exception} with the same
+    meaning per job. Only one batch is in flight per host, so batch mode runs
+    a single thread. Workers are restarted in forked children.
+    """
+    pool = _pool()
+    pool.handler = handler
+    pool.batch_handler = batch_handler
+    pool.batch_window = batch_window
+    if pool.workers:
+        return
+    if batch_handler:
+        count = 1
+    for _ in range(count):
+        thread = threading.Thread(target=_worker_loop, args=(pool,), name="webhook-worker", daemon=True)
+        thread.start()
+        pool.workers.append(thread)
+
+
+def _restart_after_fork():
+    # Threads don't survive fork(); children start their own pools
+    for pool in list(_pools.values()):
+        if pool.workers and pool.handler is not None:
+            count = len(pool.workers)
+            pool.workers.clear()
+            with storage.scoped(pool.scope):
+                start_workers(pool.handler, count, pool.batch_handler, pool.batch_window)
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)